@@ -0,0 +1,214 @@
+"""
+会战插件的性能测试
+
+使用临时数据目录与假的机器人API启动yobot，不需要连接go-cqhttp：
+
+    python scripts/benchmark.py --workers 1 lag
+    python scripts/benchmark.py queries --members 30
+    python scripts/benchmark.py --workers 0 dispatch
+
+--src 可以指向另一份代码（如旧版本的 git worktree）的 src/client 目录，用于对比改动前后的结果。
+需要安装 src/client/requirements.txt 中的依赖，绘制状态图片需要 fonts/msyh.ttf
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src", "client")
+
+
+class FakeApi:
+    """
+    假的机器人API，发送消息直接成功，群成员等信息按QQ号生成
+    """
+
+    def __getattr__(self, name: str):
+        async def call(**kwargs):
+            if name == "get_group_member_info":
+                return {"role": "member", "card": f"card{kwargs['user_id']}", "nickname": "n"}
+            if name == "get_group_member_list":
+                return []
+            if name == "get_stranger_info":
+                return {"nickname": f"stranger{kwargs['user_id']}"}
+            if name == "get_group_list":
+                return []
+            return {}
+        return call
+
+
+def start_bot(src: str, config: Dict[str, Any]):
+    """
+    在临时数据目录中启动yobot
+
+    :param src: src/client 目录
+    :param config: 覆盖默认设置的项
+    :return: (Yobot实例, 事件循环)
+    """
+    sys.path.insert(0, src)
+    from apscheduler.schedulers.asyncio import AsyncIOScheduler
+    from quart import Quart
+    import yobot
+
+    data_path = tempfile.mkdtemp(prefix="yobot_benchmark_")
+    with open(os.path.join(src, "packedfiles", "default_config.json"), encoding="utf-8") as f:
+        setting = json.load(f)
+    setting["super-admin"] = [1]
+    setting.update(config)
+    with open(os.path.join(data_path, "yobot_config.json"), "w", encoding="utf-8") as f:
+        json.dump(setting, f)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    bot = yobot.Yobot(data_path=data_path, scheduler=AsyncIOScheduler(),
+                      quart_app=Quart(__name__), bot_api=FakeApi())
+    return bot, loop, data_path
+
+
+def group_msg(text: str, qqid: int, group_id: int) -> Dict[str, Any]:
+    return {
+        "raw_message": text,
+        "message_type": "group",
+        "group_id": group_id,
+        "user_id": qqid,
+        "self_id": 999,
+        "sender": {"user_id": qqid, "card": f"u{qqid}", "nickname": f"u{qqid}", "role": "owner"},
+    }
+
+
+async def bench_lag(bot, args) -> str:
+    """
+    多个公会同时发命令、查状态时事件循环的延迟
+    """
+    groups = range(200, 200 + args.groups)
+    for group_id in groups:
+        await bot.proc_async(group_msg("创建国服公会", 1, group_id))
+        for qqid in (1, 2, 3):
+            await bot.proc_async(group_msg("加入公会", qqid, group_id))
+            await bot.proc_async(group_msg(f"申请出刀{qqid}", qqid, group_id))
+    await asyncio.sleep(0.5)
+
+    lags: List[float] = []
+    stopped = False
+
+    async def ticker():
+        while not stopped:
+            start = time.perf_counter()
+            await asyncio.sleep(0.005)
+            lags.append(time.perf_counter() - start - 0.005)
+
+    task = asyncio.ensure_future(ticker())
+    start = time.perf_counter()
+    for i in range(args.rounds):
+        # 每轮先修改一次状态，状态图片不能直接使用缓存
+        await asyncio.gather(*(bot.proc_async(group_msg("不打了", 1, g)) for g in groups))
+        await asyncio.gather(*(bot.proc_async(group_msg(f"申请出刀{i % 5 + 1}", 1, g)) for g in groups))
+        await asyncio.gather(*(bot.proc_async(group_msg("状态", 1, g)) for g in groups))
+    wall = time.perf_counter() - start
+    stopped = True
+    await task
+    lags.sort()
+    return "wall {:.2f}s  lag max {:.0f}ms  p95 {:.0f}ms  p50 {:.1f}ms".format(
+        wall, lags[-1] * 1000, lags[int(len(lags) * 0.95)] * 1000, lags[len(lags) // 2] * 1000)
+
+
+async def bench_queries(bot, args) -> str:
+    """
+    分数表与出刀记录每次调用执行的SQL语句数
+    """
+    import peewee
+
+    group_id = 300
+    await bot.proc_async(group_msg("创建国服公会", 1, group_id))
+    for qqid in range(1, args.members + 1):
+        await bot.proc_async(group_msg("加入公会", qqid, group_id))
+        for _ in range(2):
+            await bot.proc_async(group_msg("报刀 1w", qqid, group_id))
+    await asyncio.sleep(0.5)
+    clan_battle = next(p for p in bot.plug_passive if type(p).__name__ == "ClanBattle")
+
+    count = 0
+    execute_sql = peewee.Database.execute_sql
+
+    def counting_execute_sql(self, *args, **kwargs):
+        nonlocal count
+        count += 1
+        return execute_sql(self, *args, **kwargs)
+
+    peewee.Database.execute_sql = counting_execute_sql
+    results = []
+    try:
+        for name in ("score_table", "challenge_record"):
+            func = getattr(clan_battle, name)
+            func(group_id)  # 预热名字等缓存
+            count = 0
+            start = time.perf_counter()
+            for _ in range(args.calls):
+                func(group_id)
+            elapsed = (time.perf_counter() - start) / args.calls
+            results.append(f"{name} {count / args.calls:.1f} queries {elapsed * 1000:.1f}ms")
+    finally:
+        peewee.Database.execute_sql = execute_sql
+    return f"members {args.members}  " + "  ".join(results)
+
+
+DISPATCH_TEXTS = ("报刀 abc", "尾刀 x", "撤销 x", "取消 x", "ver", "帮助 x", "登录 x", "设置 x", "今天吃什么")
+
+
+async def bench_dispatch(bot, args) -> str:
+    """
+    格式不对的命令与普通聊天的分发速度
+    """
+    group_id = 100
+    await bot.proc_async(group_msg("创建国服公会", 1, group_id))
+    await bot.proc_async(group_msg("加入公会", 1, group_id))
+    messages = [group_msg(text, 1, group_id) for text in DISPATCH_TEXTS]
+    clan_battle = next(p for p in bot.plug_passive if type(p).__name__ == "ClanBattle")
+
+    start = time.perf_counter()
+    for i in range(args.messages):
+        ctx = messages[i % len(messages)]
+        match_num = clan_battle.match(ctx["raw_message"])
+        if match_num:
+            clan_battle.execute(match_num, ctx)
+    execute_rate = args.messages / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(args.messages):
+        await bot.proc_async(dict(messages[i % len(messages)]))
+    proc_rate = args.messages / (time.perf_counter() - start)
+    return f"clan_battle execute {execute_rate:,.0f}/s  proc_async {proc_rate:,.0f} msg/s"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="会战插件的性能测试")
+    parser.add_argument("--src", default=SRC, help="src/client 目录")
+    parser.add_argument("--workers", type=int, default=None, help="工作线程数（worker_threads）")
+    commands = parser.add_subparsers(dest="command", required=True)
+    lag = commands.add_parser("lag", help="事件循环延迟")
+    lag.add_argument("--groups", type=int, default=16)
+    lag.add_argument("--rounds", type=int, default=4)
+    queries = commands.add_parser("queries", help="分数表与出刀记录的SQL语句数")
+    queries.add_argument("--members", type=int, default=30)
+    queries.add_argument("--calls", type=int, default=20)
+    dispatch = commands.add_parser("dispatch", help="消息分发速度")
+    dispatch.add_argument("--messages", type=int, default=20000)
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    config = {} if args.workers is None else {"worker_threads": args.workers}
+    bot, loop, data_path = start_bot(args.src, config)
+    try:
+        bench = {"lag": bench_lag, "queries": bench_queries, "dispatch": bench_dispatch}[args.command]
+        print(args.command, loop.run_until_complete(bench(bot, args)))
+    finally:
+        shutil.rmtree(data_path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
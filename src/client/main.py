@@ -38,6 +38,7 @@ from aiocqhttp import CQHttp
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 import yobot
+from ybplugins import dispatcher
 
 
 def insert_seq(seq, x):
@@ -122,9 +123,10 @@ def main():
             to_sends = func()
         if to_sends is None:
             return
-        for kwargs in to_sends:
-            await asyncio.sleep(5)
-            await cqbot.send_msg(**kwargs)
+        await asyncio.gather(*(
+            dispatcher.send(cqbot.send_msg, kwargs.pop("self_id", None), **kwargs)
+            for kwargs in to_sends
+        ), return_exceptions=True)
 
     jobs = bot.active_jobs()
     if jobs:
@@ -28,6 +28,7 @@ if __name__ == "__main__":
     sys.exit()
 
 from .yobot import Yobot
+from .ybplugins import dispatcher
 import asyncio
 
 if "nonebot" in sys.modules:
@@ -85,9 +86,10 @@ async def send_it(func):
         to_sends = func()
     if to_sends is None:
         return
-    for kwargs in to_sends:
-        await asyncio.sleep(5)
-        await cqbot.send_msg(**kwargs)
+    await asyncio.gather(*(
+        dispatcher.send(cqbot.send_msg, kwargs.pop("self_id", None), **kwargs)
+        for kwargs in to_sends
+    ), return_exceptions=True)
 
 
 jobs = bot.active_jobs()
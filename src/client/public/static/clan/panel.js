@@ -51,6 +51,8 @@ var vm = new Vue({
         subscribeFormVisible: false,    //添加预约弹窗是否显示
         subscribeCancelVisible: false,  //取消预约弹窗是否显示
         leavePage: false,
+        statusVersion: null,    //当前boss状态的版本号
+        statusSource: null,     //boss状态推送连接
         challengersList: {1:false,2:false,3:false,4:false,5:false},     //各个正在挑战的玩家列表显示
     },
     mounted() {
@@ -63,10 +65,12 @@ var vm = new Vue({
                 thisvue.groupData = res.data.groupData;
                 thisvue.bossData = res.data.bossData;
                 thisvue.base_cycle = res.data.groupData.cycle;
+                thisvue.statusVersion = res.data.version;
                 thisvue.is_admin = res.data.selfData.is_admin;
                 thisvue.self_id = res.data.selfData.user_id;
                 thisvue.boss_num = 1;
                 document.title = res.data.groupData.group_name + ' - 公会战';
+                thisvue.status_subscribe();
             } else {
                 thisvue.$alert(res.data.message, '加载数据错误');
             }
@@ -85,7 +89,6 @@ var vm = new Vue({
         }).catch(function (error) {
             thisvue.$alert(error, '获取成员失败');
         });
-        this.status_long_polling();
     },
     beforeMount () {
         var userAgentInfo = navigator.userAgent;
@@ -99,6 +102,9 @@ var vm = new Vue({
     },
     destroyed: function () {
         this.leavePage = true;
+        if (this.statusSource) {
+            this.statusSource.close();
+        }
     },
     computed: {
         damageHint: function () {
@@ -126,27 +132,88 @@ var vm = new Vue({
             };
             return qqid;
         },
+        status_notice: function (notice) {
+            this.$notify({
+                title: '通知',
+                message: '(' + (new Date()).toLocaleTimeString('chinese', { hour12: false }) + ') ' + notice,
+                duration: 60000,
+            });
+        },
+        apply_status: function (data) {
+            // 服务器只发送变化的部分(bossDelta)，落后太多时发送完整状态(bossData)
+            if (data.bossData) {
+                this.bossData = data.bossData;
+            } else if (data.bossDelta) {
+                for (var boss_num in data.bossDelta) {
+                    var changed = data.bossDelta[boss_num];
+                    var boss = Object.assign({}, this.bossData[boss_num]);
+                    for (var field in changed) {
+                        if (field == 'challenger') {
+                            var challenger = Object.assign({}, boss.challenger || {});
+                            for (var qqid in changed.challenger) {
+                                if (changed.challenger[qqid] === null) {
+                                    delete challenger[qqid];
+                                } else {
+                                    challenger[qqid] = changed.challenger[qqid];
+                                }
+                            }
+                            boss.challenger = Object.keys(challenger).length ? challenger : 0;
+                        } else {
+                            boss[field] = changed[field];
+                        }
+                    }
+                    this.$set(this.bossData, boss_num, boss);
+                }
+            }
+            if (data.base_cycle) {
+                this.base_cycle = data.base_cycle;
+            }
+            if (data.version !== undefined) {
+                this.statusVersion = data.version;
+            }
+        },
+        status_subscribe: function () {
+            // 服务器推送boss状态，断线后浏览器自动重连并补上错过的变化
+            if (!window.EventSource) {
+                this.status_long_polling();
+                return;
+            }
+            var thisvue = this;
+            var source = new EventSource("./status/?last_event_id=" + encodeURIComponent(this.statusVersion || ""));
+            source.addEventListener('status', function (event) {
+                var data = JSON.parse(event.data);
+                thisvue.apply_status(data);
+                if (data.notice) {
+                    thisvue.status_notice(data.notice);
+                }
+            });
+            source.onerror = function () {
+                if (source.readyState == EventSource.CLOSED && !thisvue.leavePage) {
+                    // 连接被拒绝时改用长轮询
+                    thisvue.statusSource = null;
+                    thisvue.status_long_polling();
+                }
+            };
+            this.statusSource = source;
+        },
         status_long_polling: function () {
             var thisvue = this;
             axios.post("./api/", {
                 action: 'update_boss',
+                version: this.statusVersion,
                 timeout: 30,
                 csrf_token: csrf_token,
             }, {
                 timeout: 40000,
             }).then(function (res) {
                 if (res.data.code == 0) {
-                    thisvue.bossData = res.data.bossData;
-                    thisvue.base_cycle = res.data.base_cycle,
+                    thisvue.apply_status(res.data);
                     thisvue.status_long_polling();
                     if (res.data.notice) {
-                        thisvue.$notify({
-                            title: '通知',
-                            message: '(' + (new Date()).toLocaleTimeString('chinese', { hour12: false }) + ') ' + res.data.notice,
-                            duration: 60000,
-                        });
+                        thisvue.status_notice(res.data.notice);
                     }
                 } else if (res.data.code == 1) {
+                    thisvue.statusVersion = res.data.version;
                     thisvue.status_long_polling();
                 } else {
                     thisvue.$confirm(res.data.message, '刷新boss数据错误', {
@@ -179,12 +246,7 @@ var vm = new Vue({
             payload.csrf_token = csrf_token;
             axios.post("./api/", payload).then(function (res) {
                 if (res.data.code == 0) {
-                    if (res.data.bossData) {
-                        thisvue.bossData = res.data.bossData;
-                    }
-                    if (res.data.base_cycle) {
-                        thisvue.base_cycle = res.data.base_cycle;
-                    }
+                    thisvue.apply_status(res.data);
                     if (res.data.notice) {
                         thisvue.$notify({
                             title: '通知',
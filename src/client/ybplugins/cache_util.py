@@ -0,0 +1,230 @@
+import asyncio
+import functools
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+_MISSING = object()
+
+_caches: Dict[str, "LRUCache"] = {}
+
+
+class LRUCache:
+    """
+    有容量和有效期上限的LRU缓存（线程安全）
+
+    :param maxsize: 最多保存的条目数，超出时淘汰最久未使用的条目
+    :param ttl: 条目有效期（秒），None为不过期
+    """
+
+    def __init__(self, maxsize: int = 128, ttl: Optional[float] = None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.generation = 0  # 每次失效时递增
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                expire, value = item
+                if expire is None or expire > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key: Hashable, value: Any, generation: Optional[int] = None) -> None:
+        """
+        保存一个条目
+
+        :param generation: 开始计算value时的generation，
+                           计算期间发生过失效时value可能已经过时，不予保存
+        """
+        expire = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._data[key] = (expire, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> bool:
+        """
+        删除一个条目
+
+        :return: 条目是否存在
+        """
+        with self._lock:
+            self.generation += 1
+            return self._data.pop(key, _MISSING) is not _MISSING
+
+    def invalidate_if(self, predicate: Callable[[Hashable], bool]) -> int:
+        """
+        删除键满足条件的所有条目
+
+        :return: 删除的条目数
+        """
+        with self._lock:
+            self.generation += 1
+            keys = [key for key in self._data if predicate(key)]
+            for key in keys:
+                del self._data[key]
+            return len(keys)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        命中统计
+        """
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+def cache_stats() -> Dict[str, Dict[str, Any]]:
+    """
+    所有缓存函数的命中统计
+    """
+    return {name: cache.stats() for name, cache in _caches.items()}
+
+
+class CacheEvents:
+    """
+    缓存失效事件
+
+    修改数据的地方发布事件，缓存所在的模块订阅事件并删除受影响的条目，
+    这样缓存不依赖过期时间也能与数据库保持一致
+    """
+
+    def __init__(self) -> None:
+        self._handlers: Dict[str, List[Callable]] = defaultdict(list)
+
+    def subscribe(self, event: str, handler: Optional[Callable] = None):
+        """
+        订阅事件，也可以作为装饰器使用
+        """
+        if handler is None:
+            return lambda handler: self.subscribe(event, handler)
+        self._handlers[event].append(handler)
+        return handler
+
+    def publish(self, event: str, *args) -> None:
+        """
+        发布事件，订阅者在当前线程中同步执行
+        """
+        for handler in self._handlers.get(event, ()):
+            handler(*args)
+
+
+cache_events = CacheEvents()
+
+
+def _register(fn: Callable, maxsize: int, ttl: Optional[float]) -> LRUCache:
+    cache = LRUCache(maxsize, ttl)
+    _caches[f"{fn.__module__}.{fn.__qualname__}"] = cache
+    return cache
+
+
+def _attach(wrapper: Callable, cache: LRUCache) -> Callable:
+    # 失效接口的参数与调用时相同（ignore_self时不含self）
+    wrapper.cache = cache
+    wrapper.invalidate = lambda *args: cache.invalidate(tuple(args))
+    wrapper.invalidate_if = cache.invalidate_if
+    wrapper.cache_clear = cache.clear
+    wrapper.cache_stats = cache.stats
+    return wrapper
+
+
+def cached_func(maxsize: int = 128, ttl: Optional[float] = None, ignore_self: bool = False):
+    """
+    缓存函数的返回值（包括None）
+
+    被装饰的函数参数必须可哈希，调用时传入 nocache=True 可跳过缓存并刷新；
+    被装饰的函数带有 invalidate(*args)、invalidate_if(predicate)、cache_clear() 用于主动失效
+
+    :param maxsize: 最多缓存的结果数
+    :param ttl: 结果有效期（秒），None为不过期
+    :param ignore_self: 缓存键不包含第一个参数（所有实例共用缓存）
+    """
+    def decorator(fn):
+        cache = _register(fn, maxsize, ttl)
+        start = 1 if ignore_self else 0
+
+        @functools.wraps(fn)
+        def wrapper(*args, nocache=False):
+            key = args[start:]
+            if not nocache:
+                value = cache.get(key, _MISSING)
+                if value is not _MISSING:
+                    return value
+            generation = cache.generation
+            value = fn(*args)
+            cache.set(key, value, generation)
+            return value
+        return _attach(wrapper, cache)
+    return decorator
+
+
+def async_cached_func(maxsize: int = 128, ttl: Optional[float] = None, ignore_self: bool = False):
+    """
+    缓存协程函数的返回值，参数同 cached_func
+
+    同一个键同时只会执行一次，并发的未命中请求等待同一个结果
+    """
+    def decorator(fn):
+        cache = _register(fn, maxsize, ttl)
+        start = 1 if ignore_self else 0
+        inflight: Dict[Hashable, asyncio.Future] = {}
+
+        @functools.wraps(fn)
+        async def wrapper(*args, nocache=False):
+            key = args[start:]
+            if not nocache:
+                value = cache.get(key, _MISSING)
+                if value is not _MISSING:
+                    return value
+                future = inflight.get(key)
+                if future is not None:
+                    return await asyncio.shield(future)
+            future = inflight[key] = asyncio.get_event_loop().create_future()
+            generation = cache.generation
+            try:
+                value = await fn(*args)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                future.set_exception(e)
+                future.exception()  # 没有其他等待者时不再报告未取回的异常
+                raise
+            finally:
+                if inflight.get(key) is future:
+                    del inflight[key]
+            cache.set(key, value, generation)
+            future.set_result(value)
+            return value
+        return _attach(wrapper, cache)
+    return decorator
@@ -1,15 +1,17 @@
-import asyncio
 from typing import Any, Dict
 from aiocqhttp.api import Api
 
+from .components.boss_status import BossStatusChannel
+from .components.define import Commands
+from .components.nickname import NicknameService
 from .components.web_operation import register_routes
-from .components.kernel import init, execute, jobs, match
+from .components.kernel import init, execute, execute_async, jobs, match, shutdown
 from .components.score import score_table
 from .components.realize import *
 from .components.realize import (_level_by_cycle, _get_nickname_by_qqid,
 				_get_group_previous_challenge, _update_group_list_async, 
 				_fetch_member_list_async, _update_all_group_members_async,
-				_update_user_nickname_async, _boss_data_dict, _get_available_empty_battle_id,
+				_refresh_nicknames_async, _update_user_nickname_async, _boss_data_dict, _get_available_empty_battle_id,
 				_update_user_profile_image)
 
 
@@ -17,18 +19,22 @@ class ClanBattle:
 	Passive = True
 	Active = True
 	Request = True
+	Prefixes = tuple(Commands)	#命令开头，用于过滤无关消息
 
 	#### 核心
 	init = init			#初始化
 	execute = execute	#执行
+	execute_async = execute_async	#异步执行
 	jobs = jobs			#验证
 	match = match		#匹配
+	shutdown = shutdown	#退出
 	#### 核心
 
 	#构造函数/初始化
 	def __init__(self, glo_setting:Dict[str, Any], bot_api:Api, boss_id_name:Dict, *args, **kwargs):
 		# data initialize
-		self._boss_status:Dict[str, asyncio.Future] = {}
+		self._boss_status:BossStatusChannel = BossStatusChannel()	#boss状态推送
+		self._nicknames:NicknameService = NicknameService(self._refresh_nicknames_async)	#公会成员名字
 		self.init(glo_setting, bot_api, boss_id_name, args, kwargs)
 		
 	
@@ -43,6 +49,7 @@ class ClanBattle:
 	_update_group_list_async = _update_group_list_async					##更新群列表
 	_fetch_member_list_async = _fetch_member_list_async					##获取群成员列表
 	_update_all_group_members_async = _update_all_group_members_async	##更新所有群成员
+	_refresh_nicknames_async = _refresh_nicknames_async				##批量更新公会成员名字
 	_update_user_nickname_async = _update_user_nickname_async			##更新成员名字
 	_boss_data_dict = _boss_data_dict									##获取boss当前数据
 	_get_available_empty_battle_id = _get_available_empty_battle_id		##获取公会最靠前的空白档案号
@@ -56,6 +63,7 @@ class ClanBattle:
 	undo = undo												##撤销上一刀的伤害/删除上一刀的记录
 	modify = modify											##修改boss状态
 	change_game_server = change_game_server					##修改服务器
+	put_group_setting = put_group_setting					##修改公会设置
 	get_data_slot_record_count = get_data_slot_record_count	##获取当期会战数据记录档案的编号
 	clear_data_slot = clear_data_slot						##清空会战数据记录档案
 	switch_data_slot = switch_data_slot						##切换会战数据记录档案
@@ -80,8 +88,10 @@ class ClanBattle:
 	challenge_record = challenge_record						##出刀记录
 
 	get_report = get_report										##获取报告
+	get_report_page = get_report_page							##分页获取报告
 	get_battle_member_list = get_battle_member_list				##从会战记录里获取成员列表
 	get_member_list = get_member_list							##获取所有成员列表
 	
 	query_tree = query_tree                                     ##查树
-	get_clan_group = get_clan_group
\ No newline at end of file
+	get_clan_group = get_clan_group
+	get_group_state = get_group_state							##公会实时状态
\ No newline at end of file
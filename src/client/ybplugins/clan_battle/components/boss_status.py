@@ -0,0 +1,202 @@
+import asyncio
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+
+class StatusEvent:
+    """
+    一次boss状态变化
+
+    :param seq: 序号
+    :param data: 完整状态 {bossData, base_cycle, notice}
+    :param delta: 相对上一个版本的变化 {bossDelta, base_cycle, notice}，
+                  没有上一个版本可比较时为None
+    """
+
+    __slots__ = ("seq", "data", "delta", "encoded")
+
+    def __init__(self, seq: int, data: Dict[str, Any], delta: Optional[Dict[str, Any]]) -> None:
+        self.seq = seq
+        self.data = data
+        self.delta = delta
+        self.encoded: Optional[bytes] = None  # 编码后的推送内容，所有连接共用
+
+
+class _GroupChannel:
+    __slots__ = ("seq", "history", "waiter")
+
+    def __init__(self, history: int) -> None:
+        self.seq: int = 0
+        self.history: Deque[StatusEvent] = deque(maxlen=history)
+        self.waiter: Optional[asyncio.Future] = None
+
+
+def diff_boss_data(old: Dict[Any, Dict[str, Any]], new: Dict[Any, Dict[str, Any]]) -> Dict[Any, Dict[str, Any]]:
+    """
+    计算两份bossData的差异
+
+    :return: {boss编号:{变化的字段:新值}}，
+             其中challenger为 {qqid:出刀信息}，退出出刀的成员为None
+    """
+    delta = {}
+    for boss_num, boss in new.items():
+        old_boss = old.get(boss_num, {})
+        changed = {}
+        for field, value in boss.items():
+            old_value = old_boss.get(field)
+            if value == old_value:
+                continue
+            if field == "challenger":
+                old_value = old_value or {}
+                value = value or {}
+                changed[field] = {qqid: None for qqid in old_value if qqid not in value}
+                changed[field].update((qqid, info) for qqid, info in value.items() if old_value.get(qqid) != info)
+            else:
+                changed[field] = value
+        if changed:
+            delta[boss_num] = changed
+    return delta
+
+
+def merge_delta(events: List[StatusEvent]) -> Optional[Dict[str, Any]]:
+    """
+    合并连续的多次变化
+
+    :return: 合并后的变化，其中有无法计算变化的事件时返回None
+    """
+    boss_delta: Dict[Any, Dict[str, Any]] = {}
+    for event in events:
+        if event.delta is None:
+            return None
+        for boss_num, changed in event.delta["bossDelta"].items():
+            merged = boss_delta.setdefault(boss_num, {})
+            for field, value in changed.items():
+                if field == "challenger" and field in merged:
+                    merged[field] = {**merged[field], **value}
+                else:
+                    merged[field] = value
+    return {
+        "bossDelta": boss_delta,
+        "base_cycle": events[-1].data["base_cycle"],
+        "notice": "\n".join(event.data["notice"] for event in events if event.data["notice"]) or None,
+    }
+
+
+class BossStatusChannel:
+    """
+    boss状态推送频道
+
+    每个公会的状态变化按顺序编号，最近的若干条连同相对上一版本的变化保存在内存中；
+    网页端带着已有的版本号来取，只需要传输变化的部分，落后太多时才需要完整状态。
+    版本号为 "<启动时间>:<序号>"，序号在每次启动时从0开始，启动时间不同的版本号一律发送完整状态。
+    同一个公会的所有等待者共用一个future，一次变化只唤醒一次
+
+    :param history: 每个公会保留的事件数
+    """
+
+    def __init__(self, history: int = 64) -> None:
+        self.history = history
+        self.epoch = "%x" % int(time.time() * 1000)
+        self._groups: Dict[int, _GroupChannel] = {}
+
+    def version(self, seq: int) -> str:
+        """
+        序号对应的版本号
+        """
+        return f"{self.epoch}:{seq}"
+
+    def parse_version(self, version: Any) -> Optional[int]:
+        """
+        版本号对应的序号
+
+        :return: 序号，不是本次启动发出的版本号时为None
+        """
+        if not isinstance(version, str):
+            return None
+        epoch, _, seq = version.partition(":")
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        return int(seq)
+
+    def _group(self, group_id: int) -> _GroupChannel:
+        channel = self._groups.get(group_id)
+        if channel is None:
+            channel = self._groups[group_id] = _GroupChannel(self.history)
+        return channel
+
+    def publish(self, group_id: int, data: Dict[str, Any]) -> int:
+        """
+        发布一次状态变化（只能在事件循环中调用）
+
+        :param group_id: QQ群号
+        :param data: 完整状态 {bossData, base_cycle, notice}
+        :return: 这次变化的序号
+        """
+        channel = self._group(group_id)
+        delta = None
+        if channel.history:
+            delta = {
+                "bossDelta": diff_boss_data(channel.history[-1].data["bossData"], data["bossData"]),
+                "base_cycle": data["base_cycle"],
+                "notice": data["notice"],
+            }
+        channel.seq += 1
+        channel.history.append(StatusEvent(channel.seq, data, delta))
+        waiter, channel.waiter = channel.waiter, None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+        return channel.seq
+
+    def last_seq(self, group_id: int) -> int:
+        """
+        获取公会最新的事件序号，没有发生过变化时为0
+        """
+        channel = self._groups.get(group_id)
+        return 0 if channel is None else channel.seq
+
+    def events_after(self, group_id: int, seq: int) -> List[StatusEvent]:
+        """
+        获取序号之后的所有事件
+
+        序号比当前还大时（服务重启过）视为从头开始，
+        太早的事件已被丢弃，此时只能返回保留着的部分
+        """
+        channel = self._groups.get(group_id)
+        if channel is None:
+            return []
+        if seq > channel.seq:
+            seq = 0
+        return [event for event in channel.history if event.seq > seq]
+
+    def complete_after(self, group_id: int, seq: int) -> bool:
+        """
+        序号之后的事件是否都还保留着（能否只发送变化）
+        """
+        channel = self._groups.get(group_id)
+        if channel is None:
+            return seq == 0
+        if seq > channel.seq:
+            return False
+        return seq == channel.seq or (bool(channel.history) and channel.history[0].seq <= seq + 1)
+
+    async def wait(self, group_id: int, seq: int, timeout: Optional[float] = None) -> List[StatusEvent]:
+        """
+        等待序号之后的事件，已经有错过的事件时立即返回
+
+        :param group_id: QQ群号
+        :param seq: 客户端收到的最后一个序号
+        :param timeout: 最长等待时间（秒），超时返回空列表
+        :return: 事件列表
+        """
+        events = self.events_after(group_id, seq)
+        if events:
+            return events
+        channel = self._group(group_id)
+        if channel.waiter is None:
+            channel.waiter = asyncio.get_event_loop().create_future()
+        try:
+            await asyncio.wait_for(asyncio.shield(channel.waiter), timeout)
+        except asyncio.TimeoutError:
+            return []
+        return self.events_after(group_id, seq)
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+from typing import Any, Callable, Dict, Optional
+
+from ..exception import GroupError
+from . import worker
+from .group_state import GroupState
+
+_logger = logging.getLogger(__name__)
+
+
+class GroupQueue:
+    """
+    公会命令队列
+
+    同一个公会的修改命令按到达顺序依次执行，不同公会之间互不影响；
+    每个公会排队的命令数有上限，超过上限的命令直接拒绝。
+    不需要立即落盘的公会数据通过 save_later 延迟写入，
+    短时间内的多次修改合并为一次写入
+
+    :param max_pending: 每个公会最多排队（含正在执行）的命令数
+    :param flush_delay: 延迟写入的等待时间（秒）
+    """
+
+    def __init__(self, max_pending: int = 32, flush_delay: float = 1) -> None:
+        self.max_pending = max_pending
+        self.flush_delay = flush_delay
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._pending: Dict[int, int] = {}
+        self._unsaved: Dict[int, GroupState] = {}
+        self._flusher: Optional[asyncio.Future] = None
+
+    def _lock(self, group_id: int) -> asyncio.Lock:
+        lock = self._locks.get(group_id)
+        if lock is None:
+            lock = self._locks[group_id] = asyncio.Lock()
+        return lock
+
+    async def run(self, group_id: int, func: Callable, *args, **kwargs) -> Any:
+        """
+        排队执行修改公会数据的函数（在工作线程池中执行）
+
+        :param group_id: QQ群号
+        :param func: 要执行的函数
+        :return: 函数的返回值
+        """
+        pending = self._pending.get(group_id, 0)
+        if pending >= self.max_pending:
+            _logger.warning(f'群{group_id}排队的命令过多，已拒绝新命令')
+            raise GroupError('操作太频繁啦，请稍后再试')
+        self._pending[group_id] = pending + 1
+        try:
+            async with self._lock(group_id):
+                return await worker.run(func, *args, **kwargs)
+        finally:
+            self._pending[group_id] -= 1
+            if self._pending[group_id] == 0:
+                del self._pending[group_id]
+
+    async def read(self, group_id: int, func: Callable, *args, **kwargs) -> Any:
+        """
+        在两条修改命令之间读取公会数据（在工作线程池中执行），不计入排队上限
+
+        :param group_id: QQ群号
+        :param func: 读取数据的函数
+        :return: 函数的返回值
+        """
+        async with self._lock(group_id):
+            return await worker.run(func, *args, **kwargs)
+
+    def save_later(self, state: GroupState) -> None:
+        """
+        延迟写入公会数据，等待期间的多次调用只写入一次
+
+        :param state: GroupState公会实时状态实例
+        """
+        worker.call_soon(self._save_later, state)
+
+    def _save_later(self, state: GroupState) -> None:
+        self._unsaved[state.group.group_id] = state
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.flush_delay)
+        await self._save_all()
+
+    async def _save_all(self) -> None:
+        # 写入期间新到的 save_later 也在这里写入，直到没有待写入的数据
+        while self._unsaved:
+            group_id, state = self._unsaved.popitem()
+            async with self._lock(group_id):
+                await worker.run(self._save, state)
+
+    async def flush(self) -> None:
+        """
+        立即写入所有延迟写入的公会数据（退出前调用）
+        """
+        await self._save_all()
+        if self._flusher is not None:
+            await self._flusher
+
+    @staticmethod
+    def _save(state: GroupState) -> None:
+        try:
+            state.save()
+        except Exception as e:
+            _logger.exception(f'群{state.group.group_id}数据写入失败 {e}')
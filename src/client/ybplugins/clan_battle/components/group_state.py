@@ -0,0 +1,302 @@
+import json
+from contextlib import contextmanager
+from typing import Any, Dict, Optional
+
+from ...ybdata import Clan_challenger, Clan_group, Clan_subscribe, atomic
+
+
+def safe_load_json(text, back = None):
+    return text and json.loads(text) or back
+
+
+_CHALLENGER_FIELDS = ("is_continue", "behalf", "s", "damage", "tree", "msg")
+
+
+class GroupState:
+    """
+    公会实时状态
+
+    boss血量是Clan_group中的json文本，这里解码一次后常驻内存，
+    只在数据确实发生变化时才编码并写回数据库；
+    出刀成员与预约存放在Clan_challenger、Clan_subscribe表中，
+    每次修改只写入变化的那一行，内存中的数据作为这两张表的缓存
+
+    :param group: Clan_group公会实例
+    """
+
+    __slots__ = (
+        "group",
+        "now_health",
+        "next_health",
+        "challengers",
+        "subscribes",
+        "version",
+        "_dirty",
+        "_challenger_index",
+    )
+
+    def __init__(self, group: Clan_group) -> None:
+        self.group: Clan_group = group
+        self.version: int = 0
+        self.load()
+
+    def load(self) -> None:
+        """
+        从数据库重新读取所有数据（数据库被直接修改后调用）
+        """
+        group = self.group
+        # 结构 {boss_num:血量, }
+        self.now_health: Dict[str, int] = safe_load_json(group.now_cycle_boss_health, {})
+        self.next_health: Dict[str, int] = safe_load_json(group.next_cycle_boss_health, {})
+        # 结构 {boss_num:{qqid:{is_continue, behalf, s, damage, tree, msg}, }, }
+        self.challengers: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        # 结构 {qqid:boss_num, }
+        self._challenger_index: Dict[str, str] = {}
+        for row in (Clan_challenger
+                    .select()
+                    .where(Clan_challenger.group_id == group.group_id)
+                    .order_by(Clan_challenger.cid)):
+            self._cache_challenger(str(row.boss_num), str(row.qqid),
+                                   {field: getattr(row, field) for field in _CHALLENGER_FIELDS})
+        # 结构 {boss_num:{qqid:留言, }, }
+        self.subscribes: Dict[int, Dict[int, str]] = {}
+        for row in (Clan_subscribe
+                    .select()
+                    .where(Clan_subscribe.group_id == group.group_id)
+                    .order_by(Clan_subscribe.sid)):
+            self.subscribes.setdefault(row.boss_num, {})[row.qqid] = row.message
+        self._dirty = set()
+        self.version += 1
+
+    def reload(self) -> None:
+        """
+        丢弃内存中未写入的修改，从数据库重新读取Clan_group与所有数据
+        """
+        group = self.group
+        group.__data__.update(Clan_group.get_by_id(group.group_id).__data__)
+        group._dirty.clear()
+        self.load()
+
+    @contextmanager
+    def transaction(self):
+        """
+        在一个数据库事务中修改公会状态，出错时回滚数据库并恢复内存中的状态
+
+        进入事务前先写入等待延迟写入的修改，避免回滚时被一起丢弃
+        """
+        self.save()
+        try:
+            with atomic():
+                yield self
+        except Exception:
+            self.reload()
+            raise
+
+    def mark(self, *fields: str) -> None:
+        """
+        标记发生了变化的数据
+
+        :param fields: "health"
+        """
+        self._dirty.update(fields)
+        self.version += 1
+
+    def save(self) -> bool:
+        """
+        把发生了变化的数据写回数据库
+
+        :return: 是否进行了写入
+        """
+        group = self.group
+        if "health" in self._dirty:
+            group.now_cycle_boss_health = json.dumps(self.now_health)
+            group.next_cycle_boss_health = json.dumps(self.next_health)
+        self._dirty.clear()
+        if not group.is_dirty():
+            return False
+        group.save(only=group.dirty_fields)
+        self.version += 1
+        return True
+
+    def real_health(self, boss_num: str) -> int:
+        """
+        boss当前可挑战的血量（本周目已击败则为下周目血量）
+        """
+        now_health = self.now_health[boss_num]
+        return self.next_health[boss_num] if now_health == 0 else now_health
+
+    def challenger_boss(self, qqid) -> Optional[str]:
+        """
+        获取成员正在挑战的boss编号，未申请出刀返回None
+        """
+        return self._challenger_index.get(str(qqid))
+
+    def challenger(self, qqid) -> Optional[Dict[str, Any]]:
+        """
+        获取成员的出刀申请信息，未申请出刀返回None
+        """
+        boss_num = self.challenger_boss(qqid)
+        if boss_num is None:
+            return None
+        return self.challengers[boss_num][str(qqid)]
+
+    def _cache_challenger(self, boss_num: str, qqid: str, info: Dict[str, Any]) -> None:
+        self.challengers.setdefault(boss_num, {})[qqid] = info
+        self._challenger_index[qqid] = boss_num
+
+    def _uncache_challenger(self, qqid: str) -> None:
+        boss_num = self._challenger_index.pop(qqid)
+        del self.challengers[boss_num][qqid]
+        if not self.challengers[boss_num]:
+            del self.challengers[boss_num]
+
+    def add_challenger(self, boss_num, qqid, info: Dict[str, Any]) -> None:
+        """
+        新增出刀成员，成员已在挑战其他boss时会被替换
+
+        :param info: 包含 is_continue, behalf, s, damage, tree, msg 的字典
+        """
+        boss_num, qqid = str(boss_num), str(qqid)
+        info = {
+            "is_continue": bool(info.get("is_continue")),
+            "behalf": info.get("behalf"),
+            "s": info.get("s") or 0,
+            "damage": info.get("damage") or 0,
+            "tree": bool(info.get("tree")),
+            "msg": info.get("msg"),
+        }
+        Clan_challenger.insert(
+            group_id=self.group.group_id,
+            qqid=int(qqid),
+            boss_num=int(boss_num),
+            **info,
+        ).on_conflict_replace().execute()
+        if qqid in self._challenger_index:
+            self._uncache_challenger(qqid)
+        self._cache_challenger(boss_num, qqid, info)
+        self.version += 1
+
+    def update_challenger(self, qqid, **fields) -> None:
+        """
+        修改出刀成员的信息（挂树、报伤害等）
+
+        :param fields: is_continue, behalf, s, damage, tree, msg 中的一个或多个
+        """
+        info = self.challenger(qqid)
+        if info is None:
+            return
+        info.update(fields)
+        (Clan_challenger
+         .update(**fields)
+         .where(Clan_challenger.group_id == self.group.group_id,
+                Clan_challenger.qqid == int(qqid))
+         .execute())
+        self.version += 1
+
+    def remove_challenger(self, qqid) -> None:
+        """
+        移除出刀成员
+        """
+        qqid = str(qqid)
+        if qqid not in self._challenger_index:
+            return
+        (Clan_challenger
+         .delete()
+         .where(Clan_challenger.group_id == self.group.group_id,
+                Clan_challenger.qqid == int(qqid))
+         .execute())
+        self._uncache_challenger(qqid)
+        self.version += 1
+
+    def remove_boss_challengers(self, boss_num) -> None:
+        """
+        移除正在挑战某个boss的所有成员
+        """
+        boss_num = str(boss_num)
+        infos = self.challengers.pop(boss_num, None)
+        if not infos:
+            return
+        (Clan_challenger
+         .delete()
+         .where(Clan_challenger.group_id == self.group.group_id,
+                Clan_challenger.boss_num == int(boss_num))
+         .execute())
+        for qqid in infos:
+            del self._challenger_index[qqid]
+        self.version += 1
+
+    def clear_challengers(self) -> None:
+        """
+        移除所有出刀成员
+        """
+        Clan_challenger.delete().where(Clan_challenger.group_id == self.group.group_id).execute()
+        self.challengers = {}
+        self._challenger_index = {}
+        self.version += 1
+
+    def replace_challengers(self, challengers: Dict[str, Dict[str, Dict[str, Any]]]) -> None:
+        """
+        用给定的数据替换整个出刀成员表（读取存档时使用）
+        """
+        self.clear_challengers()
+        for boss_num, infos in challengers.items():
+            for qqid, info in infos.items():
+                self.add_challenger(boss_num, qqid, info)
+
+    def add_subscribe(self, boss_num: int, qqid: int, note: Optional[str]) -> None:
+        """
+        新增预约，已经预约过时更新留言
+        """
+        Clan_subscribe.insert(
+            group_id=self.group.group_id,
+            boss_num=boss_num,
+            qqid=qqid,
+            message=note,
+        ).on_conflict_replace().execute()
+        self.subscribes.setdefault(boss_num, {})[qqid] = note
+        self.version += 1
+
+    def remove_subscribe(self, boss_num: int, qqid: int) -> None:
+        """
+        取消预约
+        """
+        (Clan_subscribe
+         .delete()
+         .where(Clan_subscribe.group_id == self.group.group_id,
+                Clan_subscribe.boss_num == boss_num,
+                Clan_subscribe.qqid == qqid)
+         .execute())
+        boss_subscribes = self.subscribes.get(boss_num, {})
+        boss_subscribes.pop(qqid, None)
+        if not boss_subscribes:
+            self.subscribes.pop(boss_num, None)
+        self.version += 1
+
+    def remove_boss_subscribes(self, boss_num: int) -> None:
+        """
+        清空某个boss的所有预约
+        """
+        (Clan_subscribe
+         .delete()
+         .where(Clan_subscribe.group_id == self.group.group_id,
+                Clan_subscribe.boss_num == boss_num)
+         .execute())
+        self.subscribes.pop(boss_num, None)
+        self.version += 1
+
+    def clear_subscribes(self) -> None:
+        """
+        清空所有预约
+        """
+        Clan_subscribe.delete().where(Clan_subscribe.group_id == self.group.group_id).execute()
+        self.subscribes = {}
+        self.version += 1
+
+    def replace_subscribes(self, subscribes: Dict[Any, Dict[Any, str]]) -> None:
+        """
+        用给定的数据替换整个预约表（读取存档时使用）
+        """
+        self.clear_subscribes()
+        for boss_num, boss_subscribe_data in subscribes.items():
+            for qqid, note in boss_subscribe_data.items():
+                self.add_subscribe(int(boss_num), int(qqid), note)
@@ -1,33 +1,24 @@
 from typing import Dict, List
-import json
 
-from ...ybdata import Clan_group
+from .group_state import GroupState
 
 
 class SubscribeHandler:
-    def __init__(self, group: Clan_group) -> None:
+    def __init__(self, state: GroupState) -> None:
         """
         预约系统处理核心
 
-        :param group: Clan_group公会实例
+        :param state: GroupState公会实时状态实例
         """
+        self._state: GroupState = state
+
+    @property
+    def _data(self) -> Dict[int, Dict[int, str]]:
         """
-        转换为方便处理内部的类型
-        原始类型: Dict[str, Dict[str, str]] = {Boss编号: {预约QQ号: 留言}}
-        目标类型: Dict[int, Dict[int, str]] = {Boss编号: {预约QQ号: 留言}}
+        内存中的预约表，修改通过GroupState逐条写入Clan_subscribe表
+        类型: Dict[int, Dict[int, str]] = {Boss编号: {预约QQ号: 留言}}
         """
-        if group.subscribe_list:
-            data: Dict[str, Dict[str, str]] = json.loads(group.subscribe_list)
-        else:
-            data = {}
-        new_data: Dict[int, Dict[int, str]] = {}
-        for boss_no, boss_subscribe_data in data.items():
-            new_boss_subscribe_data = {}
-            for subscribe_qq, subscribe_note in boss_subscribe_data.items():
-                new_boss_subscribe_data[int(subscribe_qq)] = subscribe_note
-                new_data[int(boss_no)] = new_boss_subscribe_data
-        self._data: Dict[int, Dict[int, str]] = new_data
-        self._clan_group: Clan_group = group
+        return self._state.subscribes
 
     def subscribe(self, user_id: int, boss_id: int, note: str = "") -> None:
         """
@@ -37,9 +28,7 @@ class SubscribeHandler:
         :param boss_id: Boss编号
         :param note: 留言
         """
-        if boss_id not in self._data:
-            self._data[boss_id] = {}
-        self._data[boss_id][user_id] = note
+        self._state.add_subscribe(boss_id, user_id, note)
 
     def is_subscribed(self, user_id: int, boss_id: int) -> bool:
         """
@@ -54,9 +43,7 @@ class SubscribeHandler:
         return user_id in self._data[boss_id]
 
     def unsubscribe(self, user_id: int, boss_id: int) -> None:
-        self._data[boss_id].pop(user_id)
-        if not self._data[boss_id]:  # 删除没有预约的Boss
-            self._data.pop(boss_id)
+        self._state.remove_subscribe(boss_id, user_id)
 
     def unsubscribe_all(self, boss_id: int) -> None:
         """
@@ -66,7 +53,7 @@ class SubscribeHandler:
         """
         if boss_id not in self._data:
             return
-        self._data.pop(boss_id)
+        self._state.remove_boss_subscribes(boss_id)
 
     def get_subscribe_list(self, boss_id: int) -> List[int]:
         """
@@ -101,7 +88,3 @@ class SubscribeHandler:
         :return: 预约数据
         """
         return dict(sorted(self._data.items(), key=lambda i: i[0]))
-
-    def save(self) -> None:
-        self._clan_group.subscribe_list = json.dumps(self._data)
-        self._clan_group.save()
@@ -1,6 +1,13 @@
 from PIL import Image, ImageDraw, ImageFont, ImageFilter
 import os
 import sys
+import logging
+import threading
+import time
+from email.utils import formatdate
+from io import BytesIO
+from collections import OrderedDict
+from functools import lru_cache
 from typing import Tuple, List, Optional, Dict, Set, Union, Any
 from pathlib import Path
 import httpx
@@ -12,10 +19,31 @@ FONTS = os.path.join(FONTS_PATH, "msyh.ttf")
 USER_HEADERS_PATH = Path.cwd().resolve().joinpath("./yobot_data/user_profile") if "_MEIPASS" in dir(sys) else Path(__file__).parent.parent.parent.parent.joinpath("./yobot_data/user_profile")
 BOSS_ICON_PATH = Path(__file__).parent.parent.parent.parent.joinpath("./public/libs/yocool@final/princessadventure/boss_icon")
 
+_logger = logging.getLogger(__name__)
+
+IMAGE_FORMATS = {"jpeg": "jpg", "webp": "webp", "png": "png"}  # 可用的输出格式: 文件扩展名
+
 glovar_missing_user_id: Set[int] = set()
+glovar_stale_user_id: Set[int] = set()  # 头像文件已过期  等待后台刷新
+_user_id_lock = threading.Lock()  # 绘图在工作线程中进行  上面两个集合的读写需要加锁
+glovar_profile_image_version: int = 0  # 每下载一张新头像+1  用于判断缓存的图片是否需要重新生成
+
+PROFILE_IMAGE_URL = "http://q1.qlogo.cn/g?b=qq&nk={}&s=1"
+DOWNLOAD_CONCURRENCY = 8  # 同时进行的图片下载数
+profile_image_ttl: float = 7 * 86400  # 头像文件超过此时间(秒)后在下次使用时刷新
+
+_http_clients: Dict[Optional[str], httpx.AsyncClient] = {}  # {代理地址: 连接池}
+_download_semaphore: Optional[asyncio.Semaphore] = None
+_inflight_downloads: Dict[Path, "asyncio.Future[Optional[Path]]"] = {}
 
 
-def image_engine_init():
+def image_engine_init(profile_ttl: Optional[float] = None):
+    """
+    :param profile_ttl: 头像文件的有效期(秒)  为None时使用默认值
+    """
+    global profile_image_ttl
+    if profile_ttl is not None:
+        profile_image_ttl = profile_ttl
     if not USER_HEADERS_PATH.is_dir():
         USER_HEADERS_PATH.mkdir()
 
@@ -122,10 +150,23 @@ class BackGroundGenerator:
         raise IndexError("Unknown operation type flag")
 
 
-def get_font_image(text: str, size: int, color: Tuple[int, int, int] = (0, 0, 0)) -> Image.Image:
-    if "\n" in text:
-        return get_font_image_vertical(text, size, color)
-    image_font = ImageFont.truetype(FONTS, size)
+@lru_cache(maxsize=32)
+def get_font(path: str, size: int) -> ImageFont.FreeTypeFont:
+    """
+    获取字体  同一个字体文件的同一字号只解析一次
+
+    :param path: 字体文件路径
+    :param size: 字号
+    """
+    return ImageFont.truetype(path, size)
+
+
+@lru_cache(maxsize=1024)
+def _render_text(text: str, size: int, color: Tuple[int, int, int]) -> Image.Image:
+    """
+    渲染单行文字  结果会被缓存  不可修改或关闭  使用时需要复制
+    """
+    image_font = get_font(FONTS, size)
     font_box = image_font.getbbox(text=text)
     background = Image.new("RGBA", (font_box[2] - font_box[0], font_box[3] - font_box[1]), (255, 255, 255, 0))
     background_draw = ImageDraw.Draw(background)
@@ -133,6 +174,12 @@ def get_font_image(text: str, size: int, color: Tuple[int, int, int] = (0, 0, 0)
     return background
 
 
+def get_font_image(text: str, size: int, color: Tuple[int, int, int] = (0, 0, 0)) -> Image.Image:
+    if "\n" in text:
+        return get_font_image_vertical(text, size, color)
+    return _render_text(text, size, tuple(color)).copy()
+
+
 def get_font_image_vertical(text: str, size: int, color: Tuple[int, int, int] = (0, 0, 0)) -> Image.Image:
     VERTICAL_PIXEL = round(size / 3)
     background = BackGroundGenerator(color=(255, 255, 255, 0))
@@ -154,9 +201,17 @@ def center(source_image: Image.Image, target_image: Image.Image) -> Tuple[int, i
     return tuple(result)
 
 
-def round_corner(image: Image.Image, radius: Optional[int] = None) -> Image.Image:
+@lru_cache(maxsize=64)
+def _corner_mask(image_size: Tuple[int, int], radius: Optional[int]) -> Image.Image:
+    """
+    生成圆角蒙版  结果会被缓存  不可修改或关闭
+
+    :param image_size: 图片大小
+    :param radius: 圆角半径  为None时两端为半圆
+    """
+    width, height = image_size
     if radius is None:
-        size = image.height
+        size = height
     else:
         size = radius * 2
 
@@ -169,9 +224,9 @@ def round_corner(image: Image.Image, radius: Optional[int] = None) -> Image.Imag
         circle_split_cursor_x = round(circle_bg.size[0] / 2)
         circle_split = (circle_bg.crop((0, 0, circle_split_cursor_x, size)), circle_bg.crop((circle_split_cursor_x, 0, size, size)))
 
-        mask = Image.new("L", image.size, 255)  # 已确保关闭
+        mask = Image.new("L", image_size, 255)
         mask.paste(circle_split[0], (0, 0))
-        mask.paste(circle_split[1], (image.width - circle_split[1].width, 0))
+        mask.paste(circle_split[1], (width - circle_split[1].width, 0))
     else:
         circle_split = (
             circle_bg.crop((0, 0, radius, radius)),
@@ -179,35 +234,103 @@ def round_corner(image: Image.Image, radius: Optional[int] = None) -> Image.Imag
             circle_bg.crop((0, radius, radius, radius * 2)),
             circle_bg.crop((radius, radius, radius * 2, radius * 2)),
         )
-        mask = Image.new("L", image.size, 255)  # 已确保关闭
+        mask = Image.new("L", image_size, 255)
         mask.paste(circle_split[0], (0, 0))
-        mask.paste(circle_split[1], (image.width - radius, 0))
-        mask.paste(circle_split[2], (0, image.height - radius))
-        mask.paste(circle_split[3], (image.width - radius, image.height - radius))
+        mask.paste(circle_split[1], (width - radius, 0))
+        mask.paste(circle_split[2], (0, height - radius))
+        mask.paste(circle_split[3], (width - radius, height - radius))
+
+    circle_bg.close()
+    for split in circle_split:
+        split.close()
+
+    return mask
+
 
+def round_corner(image: Image.Image, radius: Optional[int] = None) -> Image.Image:
+    mask = _corner_mask(image.size, radius)
     mask_paste_bg = Image.new("RGBA", image.size, (255, 255, 255, 0))  # 已确保关闭
 
     result = Image.composite(image, mask_paste_bg, mask)
 
-    circle_bg.close()
     mask_paste_bg.close()
-    mask.close()
     image.close()
 
     return result
 
 
+class IconAtlas:
+    """
+    缩放并切好圆角的图标缓存
+    按文件修改时间判断缓存是否过期  超出容量时淘汰最久未使用的图标
+
+    :param capacity: 最多缓存的图标数
+    """
+
+    def __init__(self, capacity: int = 512) -> None:
+        self.capacity = capacity
+        self.__icons: "OrderedDict[Tuple[Path, int, Optional[int]], Tuple[int, Image.Image]]" = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, path: Path, size: int, radius: Optional[int] = None) -> Optional[Image.Image]:
+        """
+        获取图标  返回的图像可以随意修改或关闭
+
+        :param path: 图标文件路径
+        :param size: 缩放后的边长
+        :param radius: 圆角半径  为None时切为圆形
+        :return: 图标  文件不存在时返回None
+        """
+        key = (path, size, radius)
+        try:
+            mtime = path.stat().st_mtime_ns
+        except OSError:
+            with self.__lock:
+                self.__icons.pop(key, None)
+            return None
+        with self.__lock:
+            cached = self.__icons.get(key)
+            if cached is not None and cached[0] == mtime:
+                self.__icons.move_to_end(key)
+                return cached[1].copy()
+        with Image.open(path, "r") as image:
+            icon = round_corner(image.resize((size, size)), radius)
+        with self.__lock:
+            self.__icons[key] = (mtime, icon)
+            self.__icons.move_to_end(key)
+            while len(self.__icons) > self.capacity:
+                self.__icons.popitem(last=False)
+        return icon.copy()
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__icons.clear()
+
+
+icon_atlas = IconAtlas()
+
+
+def _profile_image_stale(path: Path) -> bool:
+    try:
+        return time.time() - path.stat().st_mtime > profile_image_ttl
+    except OSError:
+        return False
+
+
 def user_chips(head_icon: Image.Image, user_name: str, background_color: Tuple[int, int, int] = (189, 189, 189)) -> Image.Image:
+    """
+    生成成员标签
+
+    :param head_icon: 已缩放并切好圆角的头像
+    :param user_name: 成员昵称
+    :param background_color: 标签背景颜色
+    """
     OVERALL_CHIPS_LIST_WITH = 400 - 10  # 左右各5边距
     CHIPS_LIST_WIDTH = OVERALL_CHIPS_LIST_WITH - 29
     TEXT_MAXIMUM_WIDTH = CHIPS_LIST_WIDTH - 35  # 25为chip本身  10为chip自己外边距以及user_chips外边距
-    USER_PROFILE_SIZE = 20
     USER_NICKNAME_FONTSIZE = 20
     CHIPS_HEIGHT = 20
 
-    head_icon = head_icon.resize((USER_PROFILE_SIZE, USER_PROFILE_SIZE))
-    head_icon = round_corner(head_icon)
-
     text_color = (255, 255, 255) if ((background_color[0] * 0.299 + background_color[1] * 0.587 + background_color[2] * 0.114) / 255) < 0.5 else (0, 0, 0)
 
     user_name_image = get_font_image(user_name, USER_NICKNAME_FONTSIZE, text_color)
@@ -291,7 +414,6 @@ def chips_list_sort(source_list: List[int], target_num: int, interval: int) -> L
 
 
 def chips_list(chips_array: Dict[str, Any] = {}, text: str = "内容", background_color: Tuple[int, int, int] = (255, 255, 255)) -> Image.Image:
-    global glovar_missing_user_id
     OVERALL_CHIPS_LIST_WITH = 400 - 10  # 左右各5边距
     CHIPS_LIST_WIDTH = OVERALL_CHIPS_LIST_WITH - 29
     CHIPS_INTERVAL = 5
@@ -317,12 +439,14 @@ def chips_list(chips_array: Dict[str, Any] = {}, text: str = "内容", backgroun
             continue
         if not isinstance(user_nickname, str):
             continue
-        user_profile_path = USER_HEADERS_PATH.joinpath(user_id + ".jpg")
-        if not user_profile_path.is_file():
+        user_profile_image = icon_atlas.get(USER_HEADERS_PATH.joinpath(user_id + ".jpg"), 20)  # 已确保关闭
+        if user_profile_image is None:
             user_profile_image = Image.new("RGBA", (20, 20), (255, 255, 255, 0))  # 已确保关闭
-            glovar_missing_user_id.add(int(user_id))
-        else:
-            user_profile_image = Image.open(USER_HEADERS_PATH.joinpath(user_id + ".jpg"), "r")  # 已确保关闭
+            with _user_id_lock:
+                glovar_missing_user_id.add(int(user_id))
+        elif _profile_image_stale(USER_HEADERS_PATH.joinpath(user_id + ".jpg")):
+            with _user_id_lock:
+                glovar_stale_user_id.add(int(user_id))
         chips_image_list.append(user_chips(user_profile_image, user_nickname, chips_color))
 
     chips_image_list.sort(key=lambda i: i.width, reverse=True)
@@ -395,6 +519,33 @@ def get_process_image(data: List[GroupStateBlock], chips_array: Dict[str, Dict[s
     return overall_image.generate()
 
 
+class GroupProcessImageCore:
+    """
+    公会进度面板  延迟到需要时才生成图像
+
+    :param data: 进度块列表
+    :param chips_array: chips 数据
+    """
+
+    def __init__(self, data: List[GroupStateBlock], chips_array: Dict[str, Dict[str, str]]) -> None:
+        self.data = data
+        self.chips_array = chips_array
+        self.signature = (
+            tuple((i.title_text, i.data_text, i.title_color, i.data_color, i.background_color) for i in data),
+            _chips_signature(chips_array),
+        )
+
+    def generate(self) -> Image.Image:
+        return get_process_image(self.data, self.chips_array)
+
+
+def _chips_signature(chips_array: Dict[str, Dict[str, Any]]) -> Tuple:
+    """
+    chips 数据的摘要  数据相同(且头像没有更新)时生成的图像相同
+    """
+    return glovar_profile_image_version, tuple((title, tuple(chips.items())) for title, chips in chips_array.items())
+
+
 class BossStatusImageCore:
     def __init__(
         self,
@@ -413,6 +564,8 @@ class BossStatusImageCore:
         self.boss_icon_id = boss_icon_id
         self.extra_chips_array = extra_chips_array
         self.is_next = is_next
+        # 生成图像时 chips_list 会取出样式数据  摘要需要提前计算
+        self.signature = (boss_round, current_hp, max_hp, name, boss_icon_id, is_next, _chips_signature(extra_chips_array))
 
     def hp_percent_image(self) -> Image.Image:
         HP_PERCENT_IMAGE_SIZE = (315, 24)
@@ -465,13 +618,9 @@ class BossStatusImageCore:
         background.alpha_composite(self.cycle_round_image(), (BOSS_HEADER_SIZE + 20 + boss_name_image.width, 0))
         background.alpha_composite(self.hp_percent_image(), (BOSS_HEADER_SIZE + 10, 75 - 24))
 
-        if not BOSS_ICON_PATH.joinpath(self.boss_icon_id + ".webp").is_file():
-            boss_icon = Image.new("RGBA", (128, 128), (255, 255, 255, 0))  # 已确保关闭
-        else:
-            boss_icon = Image.open(BOSS_ICON_PATH.joinpath(self.boss_icon_id + ".webp"), "r")  # 已确保关闭
-
-        boss_icon = boss_icon.resize((BOSS_HEADER_SIZE, BOSS_HEADER_SIZE))
-        boss_icon = round_corner(boss_icon, 10)
+        boss_icon = icon_atlas.get(BOSS_ICON_PATH.joinpath(self.boss_icon_id + ".webp"), BOSS_HEADER_SIZE, 10)  # 已确保关闭
+        if boss_icon is None:
+            boss_icon = Image.new("RGBA", (BOSS_HEADER_SIZE, BOSS_HEADER_SIZE), (255, 255, 255, 0))  # 已确保关闭
         background.alpha_composite(boss_icon, (0, 0))
         # background.debug()  ### boss面板调试 ###
         return background.generate()
@@ -497,18 +646,36 @@ def makeShadow(image: Image.Image, iterations: int, border: int, offset: Tuple[i
     # backgroundCOlour: colour of the background
     # shadowColour: colour of the drop shadow
 
+    # The blurred shadow only depends on the image size, reuse it
+    shadow = _shadow_template(image.mode, image.size, iterations, border, tuple(offset), tuple(backgroundColour), tuple(shadowColour)).copy()
+
+    # Paste the original image on top of the shadow
+    imgLeft = border - min(offset[0], 0)  # if the shadow offset was <0, push right
+    imgTop = border - min(offset[1], 0)  # if the shadow offset was <0, push down
+    shadow.alpha_composite(image, (imgLeft, imgTop))
+
+    image.close()
+
+    return shadow
+
+
+@lru_cache(maxsize=16)
+def _shadow_template(mode: str, image_size: Tuple[int, int], iterations: int, border: int, offset: Tuple[int, int], backgroundColour, shadowColour) -> Image.Image:
+    """
+    生成模糊后的阴影底图  结果会被缓存  不可修改或关闭
+    """
     # Calculate the size of the shadow's image
-    fullWidth = image.size[0] + abs(offset[0]) + 2 * border
-    fullHeight = image.size[1] + abs(offset[1]) + 2 * border
+    fullWidth = image_size[0] + abs(offset[0]) + 2 * border
+    fullHeight = image_size[1] + abs(offset[1]) + 2 * border
 
     # Create the shadow's image. Match the parent image's mode.
-    shadow = Image.new(image.mode, (fullWidth, fullHeight), backgroundColour)
+    shadow = Image.new(mode, (fullWidth, fullHeight), backgroundColour)
 
     # Place the shadow, with the required offset
     shadowLeft = border + max(offset[0], 0)  # if <0, push the rest of the image right
     shadowTop = border + max(offset[1], 0)  # if <0, push the rest of the image down
     # Paste in the constant colour
-    shadow.paste(shadowColour, [shadowLeft, shadowTop, shadowLeft + image.size[0], shadowTop + image.size[1]])
+    shadow.paste(shadowColour, [shadowLeft, shadowTop, shadowLeft + image_size[0], shadowTop + image_size[1]])
 
     # Apply the BLUR filter repeatedly
     for i in range(iterations):
@@ -516,17 +683,20 @@ def makeShadow(image: Image.Image, iterations: int, border: int, offset: Tuple[i
 
     # shadow.show()
 
-    # Paste the original image on top of the shadow
-    imgLeft = border - min(offset[0], 0)  # if the shadow offset was <0, push right
-    imgTop = border - min(offset[1], 0)  # if the shadow offset was <0, push down
-    shadow.alpha_composite(image, (imgLeft, imgTop))
-
-    image.close()
-
     return shadow
 
 
-def generate_combind_boss_state_image(image_list: List[Union[Image.Image, BossStatusImageCore]]) -> Image.Image:
+def generate_combind_boss_state_image(
+    image_list: List[Union[Image.Image, BossStatusImageCore, GroupProcessImageCore]],
+    panel_cache: Optional[Dict[int, Tuple[Any, Image.Image, Tuple[int, int]]]] = None,
+) -> Image.Image:
+    """
+    拼接公会状态图
+
+    :param image_list: 面板列表
+    :param panel_cache: 面板缓存 {面板序号: (面板摘要, 带阴影的面板图像, 面板原始大小)}
+                        传入时只重新生成摘要发生变化的面板  并把新生成的面板写入缓存
+    """
     INTERVAL = 20
     SHADOW_BORDER = 5
 
@@ -536,57 +706,184 @@ def generate_combind_boss_state_image(image_list: List[Union[Image.Image, BossSt
     module_count = 0
     format_color_flag = False
 
-    for this_image in image_list:
-        if isinstance(this_image, BossStatusImageCore):
-            this_image = this_image.generate((254, 251, 234))
-        elif isinstance(this_image, Image.Image):
-            pass
+    for index, this_image in enumerate(image_list):
+        signature = getattr(this_image, "signature", None)
+        cached = panel_cache.get(index) if (panel_cache is not None and signature is not None) else None
+        if cached is not None and cached[0] == signature:
+            shadow_image, image_size = cached[1].copy(), cached[2]
         else:
-            raise ValueError(f"Unknown image type: {type(this_image)}")
+            if isinstance(this_image, BossStatusImageCore):
+                this_image = this_image.generate((254, 251, 234))
+            elif isinstance(this_image, GroupProcessImageCore):
+                this_image = this_image.generate()
+            elif isinstance(this_image, Image.Image):
+                pass
+            else:
+                raise ValueError(f"Unknown image type: {type(this_image)}")
+            image_size = this_image.size
+            shadow_image = makeShadow(round_corner(this_image, 10), 1, SHADOW_BORDER, (5, 5), (248, 239, 200), (248 - 20, 239 - 20, 200 - 20))
+            if panel_cache is not None and signature is not None:
+                panel_cache[index] = (signature, shadow_image.copy(), image_size)
 
         background.alpha_composite(
-            makeShadow(round_corner(this_image, 10), 1, SHADOW_BORDER, (5, 5), (248, 239, 200), (248 - 20, 239 - 20, 200 - 20)),
-            # round_corner(this_image, 10),
+            shadow_image,
             (current_x_cursor, current_y_cursor),
         )
-        current_y_cursor += this_image.height + INTERVAL
+        current_y_cursor += image_size[1] + INTERVAL
         format_color_flag = not format_color_flag
         module_count += 1
         if module_count == 3:
-            current_x_cursor += this_image.width + INTERVAL
+            current_x_cursor += image_size[0] + INTERVAL
             current_y_cursor = 0
             format_color_flag = True if format_color_flag else False
 
     return background.generate()
 
 
-async def download_pic(url: str, proxies: Optional[str] = None, file_name="") -> Optional[Path]:
+def _encode(image: Image.Image, image_format: str, quality: int, colors: int) -> bytes:
+    bio = BytesIO()
+    if image_format == "png":
+        palette_image = image.quantize(colors)
+        palette_image.save(bio, format="PNG", optimize=True)
+        palette_image.close()
+    elif image_format == "webp":
+        image.save(bio, format="WEBP", quality=quality)
+    else:
+        image.save(bio, format="JPEG", quality=quality)
+    return bio.getvalue()
+
+
+def encode_image(image: Image.Image, image_format: str = "jpeg", quality: int = 95, scale: float = 1, max_bytes: int = 0) -> Tuple[bytes, str]:
+    """
+    编码输出图片  传入的图像会被关闭
+
+    :param image_format: jpeg  webp  png(256色调色板)
+    :param quality: jpeg与webp的压缩质量
+    :param scale: 缩放比例  小于1时先缩小再编码
+    :param max_bytes: 编码结果的大小上限  超出时依次降低质量(png为颜色数)、缩小图片  0为不限制
+    :return: (编码后的数据, 文件扩展名)
+    """
+    if image_format not in IMAGE_FORMATS:
+        _logger.warning(f"未知的图片格式{image_format}  使用jpeg")
+        image_format = "jpeg"
+    if image.mode != "RGB":
+        rgb_image = image.convert("RGB")
+        image.close()
+        image = rgb_image
+    if scale < 1:
+        image = _downscale(image, scale)
+
+    colors = 256
+    data = _encode(image, image_format, quality, colors)
+    while max_bytes and len(data) > max_bytes:
+        if image_format == "png" and colors > 32:
+            colors //= 2
+        elif image_format != "png" and quality > 50:
+            quality = max(quality - 15, 50)
+        elif min(image.size) > 200:
+            image = _downscale(image, 0.8)
+        else:
+            break
+        data = _encode(image, image_format, quality, colors)
+    image.close()
+    return data, IMAGE_FORMATS[image_format]
+
+
+def _downscale(image: Image.Image, scale: float) -> Image.Image:
+    resized_image = image.resize((max(round(image.width * scale), 1), max(round(image.height * scale), 1)), Image.LANCZOS)
+    image.close()
+    return resized_image
+
+
+def _http_client(proxies: Optional[str] = None) -> httpx.AsyncClient:
+    client = _http_clients.get(proxies)
+    if client is None:
+        client = _http_clients[proxies] = httpx.AsyncClient(
+            proxies=proxies,
+            timeout=15,
+            limits=httpx.Limits(max_connections=DOWNLOAD_CONCURRENCY, max_keepalive_connections=DOWNLOAD_CONCURRENCY),
+        )
+    return client
+
+
+async def download_pic(url: str, proxies: Optional[str] = None, file_name="", max_age: Optional[float] = None) -> Optional[Path]:
+    """
+    下载图片到头像目录  同一个文件同时只会下载一次
+
+    :param url: 图片地址
+    :param proxies: 代理地址
+    :param file_name: 保存的文件名
+    :param max_age: 本地文件未超过此时间(秒)时不下载  为None时总是请求
+    :return: 图片路径  下载失败时返回None
+    """
     image_path = USER_HEADERS_PATH.joinpath(file_name)
-    client = httpx.AsyncClient(proxies=proxies, timeout=5)
-    try:
-        async with client.stream(method="GET", url=url, timeout=15) as response:  # type: ignore # params={"proxies": [proxies]}
-            if response.status_code != 200:
-                raise ValueError(f"Image respond status code error: {response.status_code}")
-            with open(image_path, "wb") as f:
-                async for chunk in response.aiter_bytes():
-                    f.write(chunk)
-    except Exception:
-        return None
-    finally:
-        await client.aclose()
+    if max_age is not None:
+        try:
+            if time.time() - image_path.stat().st_mtime < max_age:
+                return image_path
+        except OSError:
+            pass
+    future = _inflight_downloads.get(image_path)
+    if future is None:
+        future = _inflight_downloads[image_path] = asyncio.ensure_future(_download_pic(url, proxies, image_path))
+        future.add_done_callback(lambda _: _inflight_downloads.pop(image_path, None))
+    return await asyncio.shield(future)
+
+
+async def _download_pic(url: str, proxies: Optional[str], image_path: Path) -> Optional[Path]:
+    global glovar_profile_image_version, _download_semaphore
+    if _download_semaphore is None:
+        _download_semaphore = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+    headers = {}
+    if image_path.exists():  # 已有头像时带上修改时间  没有变化时服务器返回304
+        headers["If-Modified-Since"] = formatdate(image_path.stat().st_mtime, usegmt=True)
+    # 先写入临时文件再改名  绘图时不会读到写了一半的图片
+    temp_path = image_path.with_name(f"{image_path.name}.{os.getpid()}.tmp")
+    async with _download_semaphore:
+        try:
+            async with _http_client(proxies).stream(method="GET", url=url, headers=headers) as response:
+                if response.status_code == 304:
+                    os.utime(image_path)
+                    return image_path
+                if response.status_code != 200:
+                    raise ValueError(f"Image respond status code error: {response.status_code}")
+                with open(temp_path, "wb") as f:
+                    async for chunk in response.aiter_bytes():
+                        f.write(chunk)
+            os.replace(temp_path, image_path)
+        except Exception as e:
+            _logger.debug(f"图片下载失败 {url} {e}")
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return None
+    glovar_profile_image_version += 1
     return image_path
 
 
-async def download_user_profile_image(user_id_list: List[int]) -> None:
-    task_list = []
-    for this_user_id in user_id_list:
-        task_list.append(download_pic(f"http://q1.qlogo.cn/g?b=qq&nk={this_user_id}&s=1", file_name=f"{this_user_id}.jpg"))
-    await asyncio.gather(*task_list)
+async def download_user_profile_image(user_id_list: List[int], max_age: Optional[float] = None) -> None:
+    """
+    下载QQ头像  同时进行的下载数不超过 DOWNLOAD_CONCURRENCY
+
+    :param user_id_list: QQ号列表
+    :param max_age: 本地头像未超过此时间(秒)时不下载  为None时总是请求
+    """
+    await asyncio.gather(*(
+        download_pic(PROFILE_IMAGE_URL.format(this_user_id), file_name=f"{this_user_id}.jpg", max_age=max_age)
+        for this_user_id in user_id_list
+    ))
 
 
 async def download_missing_user_profile() -> None:
-    global glovar_missing_user_id
-    if not glovar_missing_user_id:
-        return
-    await download_user_profile_image(list(glovar_missing_user_id))
-    glovar_missing_user_id = set()
+    """
+    下载绘图时缺少的头像  并在后台刷新过期的头像
+    """
+    global glovar_missing_user_id, glovar_stale_user_id
+    with _user_id_lock:
+        missing_user_id, glovar_missing_user_id = glovar_missing_user_id, set()
+        stale_user_id, glovar_stale_user_id = glovar_stale_user_id - missing_user_id, set()
+    await asyncio.gather(
+        download_user_profile_image(list(missing_user_id)),
+        download_user_profile_image(list(stale_user_id), max_age=profile_image_ttl),
+    )
@@ -0,0 +1,94 @@
+import threading
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from ...cache_util import cache_events
+from ...ybdata import Clan_member, User
+from .worker import ensure_future
+
+REFRESH_INTERVAL = 600  # 同一个公会两次刷新名字的最短间隔（秒）
+
+
+class NicknameService:
+    """
+    公会成员名字
+
+    第一次用到某个公会时用一次查询读出所有成员的名字，之后直接从内存中取；
+    收到 clan_member 缓存失效事件时丢弃该公会的名字重新读取。
+    没有名字的成员合并为一次群成员列表请求来刷新
+
+    :param refresh: 刷新名字的协程函数，参数为QQ群号和需要刷新的QQ号列表
+    """
+
+    def __init__(self, refresh: Callable[[int, List[int]], Awaitable]) -> None:
+        self._refresh = refresh
+        self._groups: Dict[int, Dict[int, Optional[str]]] = {}
+        self._generation = 0
+        self._refreshed_at: Dict[int, float] = {}
+        self._lock = threading.Lock()
+        cache_events.subscribe("clan_member", self.invalidate)
+
+    def group_names(self, group_id: int) -> Dict[int, Optional[str]]:
+        """
+        获取公会所有成员的名字
+
+        :param group_id: QQ群号
+        :return: {QQ号:名字}，没有名字的成员为None
+        """
+        names = self._groups.get(group_id)
+        if names is not None:
+            return names
+        generation = self._generation
+        names = dict(
+            User.select(User.qqid, User.nickname)
+            .join(Clan_member, on=(User.qqid == Clan_member.qqid))
+            .where(Clan_member.group_id == group_id)
+            .tuples()
+        )
+        with self._lock:
+            # 读取期间名字有变化时不保存，下次重新读取
+            if generation == self._generation:
+                self._groups[group_id] = names
+        missing = [qqid for qqid, nickname in names.items() if nickname is None]
+        if missing:
+            self._request_refresh(group_id, missing)
+        return names
+
+    def get(self, group_id: int, qqid: int) -> Optional[str]:
+        """
+        获取公会成员的名字
+
+        :return: 名字，没有名字时为QQ号，不是公会成员时为None
+        """
+        names = self.group_names(group_id)
+        if qqid not in names:
+            return None
+        return names[qqid] or str(qqid)
+
+    @property
+    def generation(self) -> int:
+        """
+        名字的版本，每次有名字失效时递增（用作缓存键）
+        """
+        return self._generation
+
+    def invalidate(self, group_id: Optional[int] = None) -> None:
+        """
+        丢弃公会的名字
+
+        :param group_id: QQ群号，None为所有公会
+        """
+        with self._lock:
+            self._generation += 1
+            if group_id is None:
+                self._groups.clear()
+            else:
+                self._groups.pop(group_id, None)
+
+    def _request_refresh(self, group_id: int, qqids: List[int]) -> None:
+        now = time.monotonic()
+        with self._lock:
+            if now - self._refreshed_at.get(group_id, -REFRESH_INTERVAL) < REFRESH_INTERVAL:
+                return
+            self._refreshed_at[group_id] = now
+        ensure_future(self._refresh(group_id, qqids))
@@ -0,0 +1,78 @@
+import asyncio
+import logging
+from typing import Dict, List
+
+from aiocqhttp.api import Api
+
+from ... import dispatcher
+from .multi_cq_utils import who_am_i
+
+_logger = logging.getLogger(__name__)
+
+SEPARATOR = "\n==========\n"
+MAX_LENGTH = 3000  # 合并后单条消息的最大长度，超过时先发出已合并的部分
+
+
+class GroupNotifier:
+    """
+    网页操作的群通知
+
+    同一个公会在合并时间窗口内产生的通知合并为一条消息发送，
+    窗口从该公会的第一条通知开始计算
+
+    :param api: 机器人API
+    :param window: 合并时间窗口（秒），为0时每条通知立即发送
+    """
+
+    def __init__(self, api: Api, window: float = 3) -> None:
+        self.api = api
+        self.window = window
+        self._buffers: Dict[int, List[str]] = {}
+        self._handles: Dict[int, asyncio.TimerHandle] = {}
+
+    def notify(self, group_id: int, message: str) -> None:
+        """
+        发送一条群通知（需要在事件循环中调用）
+
+        :param group_id: QQ群号
+        :param message: 通知内容
+        """
+        if self.window <= 0:
+            self._send(group_id, message)
+            return
+        buffer = self._buffers.get(group_id)
+        if buffer is None:
+            self._buffers[group_id] = [message]
+            self._handles[group_id] = asyncio.get_event_loop().call_later(
+                self.window, self.flush, group_id)
+            return
+        if sum(map(len, buffer)) + len(message) > MAX_LENGTH:
+            self._send(group_id, SEPARATOR.join(buffer))
+            buffer.clear()
+        buffer.append(message)
+
+    def flush(self, group_id: int) -> None:
+        """
+        立即发出公会已合并的通知
+        """
+        handle = self._handles.pop(group_id, None)
+        if handle is not None:
+            handle.cancel()
+        buffer = self._buffers.pop(group_id, None)
+        if buffer:
+            self._send(group_id, SEPARATOR.join(buffer))
+
+    def _send(self, group_id: int, message: str) -> None:
+        future = asyncio.ensure_future(dispatcher.send(
+            self.api.send_group_msg,
+            who_am_i(group_id),
+            dispatcher.REPLY,
+            group_id=group_id,
+            message=message,
+        ))
+        future.add_done_callback(self._log_failure)
+
+    @staticmethod
+    def _log_failure(future: asyncio.Future) -> None:
+        if not future.cancelled() and future.exception() is not None:
+            _logger.error(f'群通知发送失败 {future.exception()}')
@@ -2,33 +2,38 @@ import math
 import os
 import sys
 import json
+import time
+import hashlib
 import peewee
 import base64
-import random
 import string
 import asyncio
 import logging
+import threading
 from pathlib import Path
 from io import BytesIO
+from urllib.parse import urljoin
 from PIL import Image, ImageFont, ImageDraw
 from typing import Any, Dict, List, Optional, Union, Tuple
 
 from .handler import SubscribeHandler
+from .group_state import GroupState, safe_load_json
 
 from ..typing import ClanBattleReport, Groupid, Pcr_date, QQid
-from ...web_util import async_cached_func
-from ..util import atqq, pcr_datetime, pcr_timestamp, timed_cached_func
+from ... import dispatcher
+from ...cache_util import async_cached_func, cache_events, cached_func
+from ..util import atqq, pcr_datetime, pcr_timestamp
 
-from ...ybdata import Clan_challenge, Clan_group, Clan_member, User, Clan_group_backups
+from ...ybdata import Clan_challenge, Clan_challenge_daily, Clan_group, Clan_member, User, Clan_group_backups
 from ..exception import GroupError, GroupNotExist, InputError, UserError, UserNotInGroup
 from .multi_cq_utils import who_am_i
-from .image_engine import download_user_profile_image, generate_combind_boss_state_image, BossStatusImageCore, get_process_image, GroupStateBlock
+from .worker import call_soon, ensure_future
+from . import image_engine
+from .image_engine import download_user_profile_image, encode_image, get_font, generate_combind_boss_state_image, BossStatusImageCore, GroupProcessImageCore, GroupStateBlock
 
 _logger = logging.getLogger(__name__)
 FILE_PATH = Path(sys._MEIPASS).resolve() if "_MEIPASS" in dir(sys) else Path(__file__).resolve().parent
-
-def safe_load_json(text, back = None):
-	return text and json.loads(text) or back
+_group_list_lock = threading.RLock()	#事件循环与工作线程都会创建实例
 
 def text_2_pic(self, text:string, weight:int, height:int, bg_color:Tuple, text_color:string, font_size:int, text_offset:Tuple):
 	im = Image.new("RGB", (weight, height), bg_color)
@@ -37,7 +42,7 @@ def text_2_pic(self, text:string, weight:int, height:int, bg_color:Tuple, text_c
 	FONTS = os.path.join(FONTS_PATH,'msyh.ttf')
 	try:
     # 尝试使用指定的字体加载
-		font = ImageFont.truetype(FONTS, font_size)
+		font = get_font(FONTS, font_size)
 	except OSError:
     # 加载失败时使用默认字体
 		font = ImageFont.load_default()
@@ -48,20 +53,38 @@ def text_2_pic(self, text:string, weight:int, height:int, bg_color:Tuple, text_c
 	return f"[CQ:image,file={base64_str}]"
 
 def future_operation(self, group, msg):
-	self._boss_status[group.group_id].set_result((self._boss_data_dict(group), group.boss_cycle, msg))
-	del self._boss_status[group.group_id]
-	self._boss_status[group.group_id] = asyncio.get_event_loop().create_future()
+	#数据在当前线程中生成，推送给网页端交给事件循环
+	call_soon(self._boss_status.publish, group.group_id, {
+		'bossData': self._boss_data_dict(group),
+		'base_cycle': group.boss_cycle,
+		'notice': msg,
+	})
 
 #获取公会数据实例，确保每次获取的都是同一个
 def get_clan_group(self, group_id):
 	if group_id in self.group_data_list:
 		return self.group_data_list[group_id]
-	else:
+	with _group_list_lock:
+		if group_id in self.group_data_list:
+			return self.group_data_list[group_id]
 		group:Clan_group = Clan_group.get_or_none(group_id=group_id)
 		if group is not None:
 			self.group_data_list[group_id] = group
 		return group
 
+#获取公会实时状态实例，确保每次获取的都是同一个
+def get_group_state(self, group_id) -> Optional[GroupState]:
+	if group_id in self.group_state_list:
+		return self.group_state_list[group_id]
+	with _group_list_lock:
+		if group_id in self.group_state_list:
+			return self.group_state_list[group_id]
+		group:Clan_group = get_clan_group(self, group_id)
+		if group is None: return None
+		state = GroupState(group)
+		self.group_state_list[group_id] = state
+		return state
+
 #阶段周目
 def _level_by_cycle(self, cycle, game_server=None):
 	level = 0
@@ -71,11 +94,23 @@ def _level_by_cycle(self, cycle, game_server=None):
 	return level
 
 #通过qq号获取名字
-@timed_cached_func(128, 3600, ignore_self=True)
-def _get_nickname_by_qqid(self, qqid) -> Union[str, None]:
+def _get_nickname_by_qqid(self, qqid, group_id = None, nocache = False) -> str:
+	"""
+	Args:
+		qqid: QQ号
+		group_id: 所在的QQ群号，给出时从公会成员名字中获取（整个公会只查询一次）
+		nocache: 是否跳过缓存
+	"""
+	if group_id is not None and not nocache:
+		nickname = self._nicknames.get(group_id, int(qqid))
+		if nickname is not None: return nickname
+	return _get_user_nickname(self, qqid, nocache = nocache)
+
+@cached_func(1024, 3600, ignore_self=True)
+def _get_user_nickname(self, qqid) -> str:
 	user = User.get_or_create(qqid=qqid)[0]
 	if user.nickname is None:
-		asyncio.ensure_future(self._update_user_nickname_async(
+		ensure_future(self._update_user_nickname_async(
 			qqid = qqid, group_id = None))
 	return user.nickname or str(qqid)
 
@@ -101,20 +136,20 @@ async def _update_group_list_async(self):
 		return False
 
 	for group_info in group_list:
-		group:Clan_group = get_clan_group(self, group_info['group_id'],)
-		if group is None : continue
-		group.group_name = group_info['group_name']
-		group.save()
+		state = get_group_state(self, group_info['group_id'])
+		if state is None : continue
+		state.group.group_name = group_info['group_name']
+		self.group_queue.save_later(state)
 	return True
 
 #获取群成员列表
-@async_cached_func(16)
+@async_cached_func(16, 60, ignore_self=True)
 async def _fetch_member_list_async(self, group_id):
 	try:
 		group_member_list = await self.api.get_group_member_list(group_id=group_id)
 	except Exception as e:
 		_logger.exception('获取群成员列表错误' + str(type(e)) + str(e))
-		asyncio.ensure_future(self.api.send_group_msg(
+		ensure_future(self.api.send_group_msg(
 			# FIXME:多CQ
 			group_id = group_id, message = '获取群成员错误，这可能是缓存问题，请重启go-cqhttp后再试'))
 		return []
@@ -135,7 +170,20 @@ async def _update_all_group_members_async(self, group_id):
 		membership.save()
 
 	# refresh member list
-	self.get_member_list(group_id, nocache = True)
+	cache_events.publish('clan_member', group_id)
+
+#批量更新公会成员名字（只请求一次群成员列表）
+async def _refresh_nicknames_async(self, group_id, qqids):
+	qqids = set(qqids)
+	group_member_list = await self._fetch_member_list_async(group_id)
+	for member in group_member_list:
+		if member['user_id'] not in qqids: continue
+		nickname = member.get('card') or member['nickname']
+		if nickname:
+			User.update(nickname = nickname).where(User.qqid == member['user_id']).execute()
+
+	# refresh
+	cache_events.publish('clan_member', group_id)
 
 #更新成员名字
 async def _update_user_nickname_async(self, qqid, group_id = None):
@@ -151,6 +199,7 @@ async def _update_user_nickname_async(self, qqid, group_id = None):
 
 		# refresh
 		if user.nickname is not None : self._get_nickname_by_qqid(qqid, nocache=True)
+		cache_events.publish('clan_member', group_id)
 	except Exception as e : _logger.exception(e)
 
 def _update_user_profile_image(self, user_id: Optional[Union[int,List[int]]] = None, group_id: Optional[int] = None) -> None:
@@ -167,29 +216,32 @@ def _update_user_profile_image(self, user_id: Optional[Union[int,List[int]]] = N
 	if group_id:
 		for this_user in Clan_member.select().where(Clan_member.group_id == group_id):
 			update_qqid_list.add(this_user.qqid)
-	asyncio.ensure_future(download_user_profile_image(list(update_qqid_list)))
+	ensure_future(download_user_profile_image(list(update_qqid_list)))
 
 #获取boss当前数据
 def _boss_data_dict(self, group: Clan_group) -> Dict[str, Any]:
 	cycle = group.boss_cycle
-	now_health = safe_load_json(group.now_cycle_boss_health, {})
-	next_health = safe_load_json(group.next_cycle_boss_health, {})
-	challenging_member_list = safe_load_json(group.challenging_member_list, {})
+	state = get_group_state(self, group.group_id)
+	now_health = state.now_health
+	challenging_member_list = state.challengers
+	level = self._level_by_cycle(cycle, group.game_server)
 
 	back_data = {}
+	#出刀信息复制一份，发布出去的状态不随之后的修改而变化
 	for i in range(5):
 		str_boss_num = str(i + 1)
 		num_boss_num = i + 1
 		next_flag = now_health[str_boss_num] == 0
-		level = self._level_by_cycle(cycle, group.game_server)
 		icon_id = self.setting['boss_id'][group.game_server][i]
 		back_data[num_boss_num] = {
 			'is_next': next_flag,
 			'cycle': next_flag and cycle+1 or cycle,
-			'health': 0 if now_health[str_boss_num] == 0 and not check_next_boss(self, group.group_id, str_boss_num)
-						else next_flag and next_health[str_boss_num] or now_health[str_boss_num],
+			'health': 0 if next_flag and not check_next_boss(self, group.group_id, str_boss_num)
+						else state.real_health(str_boss_num),
 			'full_health': self.bossinfo[group.game_server][level][i],
-			'challenger': str_boss_num in challenging_member_list and challenging_member_list[str_boss_num] or 0,
+			'challenger': str_boss_num in challenging_member_list and {
+				qqid: dict(info) for qqid, info in challenging_member_list[str_boss_num].items()
+			} or 0,
 			'icon_id': icon_id,
 			'name': self.boss_id_name[str_boss_num][icon_id]
 		}
@@ -228,10 +280,9 @@ def create_group(self, group_id: Groupid, game_server, group_name=None) -> None:
 		group.game_server = game_server
 		group.save()
 	else : raise GroupError('群已经存在')
-	self._boss_status[group_id] = asyncio.get_event_loop().create_future()
 
 	# refresh group list
-	asyncio.ensure_future(self._update_group_list_async())
+	ensure_future(self._update_group_list_async())
 
 #加入公会
 async def bind_group(self, group_id:Groupid, qqid:QQid, nickname:str):
@@ -258,9 +309,9 @@ async def bind_group(self, group_id:Groupid, qqid:QQid, nickname:str):
 	user.save()
 
 	# refresh
-	self.get_member_list(group_id, nocache=True)
+	cache_events.publish('clan_member', group_id)
 	if nickname is None:
-		asyncio.ensure_future(self._update_user_nickname_async(qqid = qqid, group_id = group_id))
+		ensure_future(self._update_user_nickname_async(qqid = qqid, group_id = group_id))
 	return membership
 
 #删除成员
@@ -285,7 +336,7 @@ def drop_member(self, group_id: Groupid, member_list: List[QQid]):
 			user.save()
 
 	# refresh member list
-	self.get_member_list(group_id, nocache=True)
+	cache_events.publish('clan_member', group_id)
 	return delete_count
 
 #修改boss状态
@@ -301,12 +352,13 @@ def modify(self, group_id: Groupid, cycle=None, bossData=None):
 	if cycle and cycle < 1:
 		raise InputError('周目数不能为负')
 
-	group:Clan_group = get_clan_group(self, group_id)
-	if group is None: raise GroupNotExist
+	state = get_group_state(self, group_id)
+	if state is None: raise GroupNotExist
+	group = state.group
 
 	next_cycle_level = self._level_by_cycle(cycle and cycle+1 or group.boss_cycle+1, group.game_server)
-	now_health = safe_load_json(group.now_cycle_boss_health, {})
-	next_health = safe_load_json(group.next_cycle_boss_health, {})
+	now_health = dict(state.now_health)
+	next_health = dict(state.next_health)
 	now_cycle_level = self._level_by_cycle(cycle or group.boss_cycle, group.game_server)
 
 	for boss_num, data in bossData.items():
@@ -321,11 +373,12 @@ def modify(self, group_id: Groupid, cycle=None, bossData=None):
 			now_health[boss_num] = data["health"]
 			next_health[boss_num] = next_cycle_full_boss_health
 	
-	group.now_cycle_boss_health = json.dumps(now_health)
-	group.next_cycle_boss_health = json.dumps(next_health)
+	state.now_health = now_health
+	state.next_health = next_health
+	state.mark('health')
 	group.boss_cycle = cycle
 
-	group.save()
+	state.save()	#boss血量立即写入，只有群名、设置等数据延迟写入
 
 	msg = 'boss状态已修改'
 	future_operation(self, group, msg)
@@ -342,10 +395,35 @@ def change_game_server(self, group_id: Groupid, game_server):
 	"""
 	if game_server not in ("jp", "tw", "cn", "kr"):
 		raise InputError(f'不存在{game_server}游戏服务器')
-	group:Clan_group = get_clan_group(self, group_id)
-	if group is None: raise GroupNotExist
+	state = get_group_state(self, group_id)
+	if state is None: raise GroupNotExist
+	state.group.game_server = game_server
+	state.mark()
+	self.group_queue.save_later(state)
+	cache_events.publish('clan_battle', group_id, None)
+
+#修改公会设置
+def put_group_setting(self, group_id: Groupid, game_server, notification, privacy):
+	"""
+	在调用此函数之前，要先检查操作者权限。
+
+	Args:
+		group_id: QQ群号
+		game_server: 服务器名("jp" "tw" "cn" "kr")
+		notification: 群通知开关
+		privacy: 隐私设置
+	"""
+	state = get_group_state(self, group_id)
+	if state is None: raise GroupNotExist
+	group = state.group
+	server_changed = group.game_server != game_server
 	group.game_server = game_server
-	group.save()
+	group.notification = notification
+	group.privacy = privacy
+	state.mark()
+	self.group_queue.save_later(state)
+	if server_changed:
+		cache_events.publish('clan_battle', group_id, None)
 
 #获取当期会战数据记录档案的编号
 def get_data_slot_record_count(self, group_id: Groupid):
@@ -378,29 +456,33 @@ def clear_data_slot(self, group_id: Groupid, battle_id: Optional[int] = None):
 		group_id: QQ群号
 		battle_id: 选择的档案号
 	"""
-	group:Clan_group = get_clan_group(self, group_id)
-	if group is None:
+	state = get_group_state(self, group_id)
+	if state is None:
 		raise GroupNotExist
+	group = state.group
 
 	now_cycle_boss_health = {}
 	level = self._level_by_cycle(1, group.game_server)
 	for boss_num, health in enumerate(self.bossinfo[group.game_server][level]):
-		now_cycle_boss_health[boss_num+1] = health
+		now_cycle_boss_health[str(boss_num+1)] = health
 	next_cycle_boss_health = {}
 	level = self._level_by_cycle(2, group.game_server)
 	for boss_num, health in enumerate(self.bossinfo[group.game_server][level]):
-		next_cycle_boss_health[boss_num+1] = health
+		next_cycle_boss_health[str(boss_num+1)] = health
 
-	group.now_cycle_boss_health = json.dumps(now_cycle_boss_health)
-	group.next_cycle_boss_health = json.dumps(next_cycle_boss_health)
+	state.now_health = now_cycle_boss_health
+	state.next_health = next_cycle_boss_health
+	state.clear_challengers()
+	state.clear_subscribes()
+	state.mark('health')
 	group.boss_cycle = 1
-	group.challenging_member_list = None
-	group.subscribe_list = None
 	group.challenging_start_time = 0
 
-	group.save()
+	state.save()
 	if battle_id is None: battle_id = group.battle_id
 	Clan_challenge.delete().where(Clan_challenge.gid == group_id, Clan_challenge.bid == battle_id).execute()
+	Clan_challenge_daily.delete().where(Clan_challenge_daily.gid == group_id, Clan_challenge_daily.bid == battle_id).execute()
+	cache_events.publish('clan_battle', group_id, battle_id)
 	_logger.info(f'群{group_id}的{battle_id}号存档已清空')
 
 #切换会战数据记录档案
@@ -414,8 +496,10 @@ def switch_data_slot(self, group_id: Groupid, battle_id: int):
 		group_id: QQ群号
 		battle_id：选择的档案号
 	"""
-	group:Clan_group = get_clan_group(self, group_id)
-	if group is None: raise GroupNotExist
+	state = get_group_state(self, group_id)
+	if state is None: raise GroupNotExist
+	state.save()	#确保json文本与内存中的状态一致
+	group = state.group
 	backups:Clan_group_backups = Clan_group_backups.get_or_create(
 		group_id = group_id, 
 		battle_id = group.battle_id)[0]
@@ -434,8 +518,8 @@ def switch_data_slot(self, group_id: Groupid, battle_id: int):
 		"boss_cycle": group.boss_cycle,
 		"now_cycle_boss_health": group.now_cycle_boss_health,
 		"next_cycle_boss_health": group.next_cycle_boss_health,
-		"challenging_member_list": group.challenging_member_list,
-		"subscribe_list": group.subscribe_list,
+		"challenging_member_list": json.dumps(state.challengers) if state.challengers else None,
+		"subscribe_list": json.dumps(state.subscribes) if state.subscribes else None,
 		"challenging_start_time": group.challenging_start_time,
 	}
 	backups.group_data = json.dumps(backups_group_data)
@@ -452,8 +536,8 @@ def switch_data_slot(self, group_id: Groupid, battle_id: int):
 		group.boss_cycle = data["boss_cycle"]
 		group.now_cycle_boss_health = data["now_cycle_boss_health"]
 		group.next_cycle_boss_health = data["next_cycle_boss_health"]
-		group.challenging_member_list = data["challenging_member_list"]
-		group.subscribe_list = data["subscribe_list"]
+		challengers = safe_load_json(data["challenging_member_list"], {})
+		subscribes = safe_load_json(data["subscribe_list"], {})
 		group.challenging_start_time = data["challenging_start_time"]
 	else:	#没有备份数据则新建
 		now_cycle_boss_health = {}
@@ -468,11 +552,15 @@ def switch_data_slot(self, group_id: Groupid, battle_id: int):
 		group.now_cycle_boss_health = json.dumps(now_cycle_boss_health)
 		group.next_cycle_boss_health = json.dumps(next_cycle_boss_health)
 		group.boss_cycle = 1
-		group.challenging_member_list = None
-		group.subscribe_list = None
+		challengers = {}
+		subscribes = {}
 		group.challenging_start_time = 0
 
 	group.save()
+	state.replace_challengers(challengers)
+	state.replace_subscribes(subscribes)
+	state.load()
+	cache_events.publish('clan_battle', group_id, None)
 	_logger.info(f'群{group_id}切换至{battle_id}号存档')
 
 def _get_available_empty_battle_id(self, group_id: int) -> int:
@@ -495,18 +583,26 @@ def _get_available_empty_battle_id(self, group_id: int) -> int:
 	return counts # 档案都已按照顺序使用，则返回顺序下新档案编号，因档案编号从0开始所以无需+1
 
 #向指定个人私聊发送提醒
-async def send_private_remind(self, member_list:List[QQid] = None, member_id:QQid = None, content: str = None):
+async def send_private_remind(self, member_list:List[QQid] = None, member_id:QQid = None, content: str = None, group_id:Groupid = None):
+	"""
+	提醒经过发送队列限速发送，多人提醒同时入队
+
+	Args:
+		group_id: 所在的QQ群号，给出时使用该群的机器人账号发送
+	"""
+	try: self_id = group_id and who_am_i(group_id)
+	except Exception: self_id = None
 	if member_list:
-		for qqid in member_list:
-			await asyncio.sleep(random.randint(3, 10))
-			try:
-				await self.api.send_private_msg(user_id=qqid, message=content)
-				_logger.info(f'向{qqid}发送出刀提醒')
-			except Exception as e:
-				_logger.exception(e)
+		results = await asyncio.gather(*(
+			dispatcher.send(self.api.send_private_msg, self_id or None, user_id=qqid, message=content)
+			for qqid in member_list
+		), return_exceptions=True)
+		for qqid, result in zip(member_list, results):
+			if isinstance(result, Exception): _logger.error(f'向{qqid}发送出刀提醒失败 {result}')
+			else: _logger.info(f'向{qqid}发送出刀提醒')
 	elif member_id and member_id > 0:
 		try:
-			await self.api.send_private_msg(user_id=member_id, message=content)
+			await dispatcher.send(self.api.send_private_msg, self_id or None, user_id=member_id, message=content)
 			_logger.info(f'向{member_id}发送代刀提醒')
 		except Exception as e:
 			_logger.exception(e)
@@ -526,23 +622,25 @@ def send_remind(self,
 		sender: 发送者QQ号
 		send_private_msg: 是否私聊发送
 	"""
-	sender_name = self._get_nickname_by_qqid(sender)
+	sender_name = self._get_nickname_by_qqid(sender, group_id)
 	if send_private_msg:
-		asyncio.ensure_future(self.send_private_remind(
+		ensure_future(self.send_private_remind(
 			member_list=member_list,
 			content=f'{sender_name}提醒您及时完成今日出刀',
+			group_id=group_id,
 		))
 	else:
 		message = ' '.join(atqq(qqid) for qqid in member_list)
-		asyncio.ensure_future(self.api.send_group_msg(
-			self_id = who_am_i(group_id), 
+		ensure_future(dispatcher.send(
+			self.api.send_group_msg,
+			who_am_i(group_id),
 			group_id=group_id,
 			message=message+f'\n=======\n{sender_name}提醒您及时完成今日出刀',
 		))
 
 #发送代刀提醒给被代刀的玩家
 def behelf_remind(self, member_id, msg):
-	asyncio.ensure_future(self.send_private_remind(member_id = member_id,content = msg))
+	ensure_future(self.send_private_remind(member_id = member_id,content = msg))
 #当前的boss状态
 def boss_status_summary(self, group_id:Groupid) -> str:
 	boss_summary = self.challenger_info(group_id)
@@ -587,12 +685,16 @@ def challenge(self,
 	membership = Clan_member.get_or_none(group_id=group_id, qqid=qqid)
 	if membership is None: raise UserNotInGroup
 
+	state = get_group_state(self, group_id)
+	if state is None: raise GroupNotExist
+	group = state.group
+
 	#若已申请出刀且指定报刀boss，优先选择指定报刀boss
 	if boss_num and self.check_blade(group_id, qqid):
 		self.cancel_blade(group_id, qqid, send_web = False)
 	#若已申请出刀未指定报刀boss，自动选择申请出刀的boss
 	if not boss_num and self.check_blade(group_id, qqid):
-		boss_num = self.get_in_boss_num(group_id, qqid)
+		boss_num = state.challenger_boss(qqid)
 
 	if not boss_num:
 		raise GroupError('又不申请出刀又不说打哪个王，报啥子刀啊 (╯‵□′)╯︵┻━┻')
@@ -601,17 +703,16 @@ def challenge(self,
 			self.apply_for_challenge(is_continue, group_id, behalf, boss_num, qqid, False)
 		else:
 			self.apply_for_challenge(is_continue, group_id, qqid, boss_num, behalf, False)
-
-	group:Clan_group = get_clan_group(self, group_id)
-	if group is None: raise GroupNotExist
-
 	boss_num = str(boss_num)
+	application = state.challenger(qqid)
+
+	#以下所有修改都先在副本上进行，最后在一个事务中写入
 	boss_cycle = group.boss_cycle
-	challenging_member_list = safe_load_json(group.challenging_member_list, {})
-	now_cycle_boss_health = safe_load_json(group.now_cycle_boss_health, {})
-	next_cycle_boss_health = safe_load_json(group.next_cycle_boss_health, {})
+	new_boss_cycle = group.boss_cycle
+	now_cycle_boss_health = dict(state.now_health)
+	next_cycle_boss_health = dict(state.next_health)
 	real_cycle_boss_health = now_cycle_boss_health
-	is_continue = is_continue or (boss_num in challenging_member_list and challenging_member_list[boss_num][str(qqid)]['is_continue'] or False)
+	is_continue = is_continue or (application is not None and application['is_continue'])
 	if now_cycle_boss_health[boss_num] == 0 and next_cycle_boss_health[boss_num] != 0:
 		boss_cycle += 1
 		real_cycle_boss_health = next_cycle_boss_health
@@ -619,37 +720,23 @@ def challenge(self,
 		raise InputError('只能挑战2个周目内的同个boss')
 	if (not defeat) and (damage >= real_cycle_boss_health[boss_num]):
 		raise InputError('伤害超出剩余血量，如击败请使用尾刀')
-	# if damage == 0:
-	# 	damage = challenging_member_list[boss_num][str(qqid)]['damage']
 
 	d, t = pcr_datetime(area = group.game_server)
 	if previous_day:
-		today_count = Clan_challenge.select().where(
-			Clan_challenge.gid == group_id,
-			Clan_challenge.bid == group.battle_id,
-			Clan_challenge.challenge_pcrdate == d,
+		today_count = Clan_challenge_daily.select().where(
+			Clan_challenge_daily.gid == group_id,
+			Clan_challenge_daily.bid == group.battle_id,
+			Clan_challenge_daily.pcrdate == d,
 		).count()
 
 		if today_count != 0: raise GroupError('今日报刀记录不为空，无法将记录添加到昨日')
 		d -= 1
 		t += 86400
 
-	challenges = Clan_challenge.select().where(
-		Clan_challenge.gid == group_id,
-		Clan_challenge.qqid == qqid,
-		Clan_challenge.bid == group.battle_id,
-		Clan_challenge.challenge_pcrdate == d,
-	).order_by(Clan_challenge.cid)
-
-	challenges = list(challenges)
-	finished = sum(bool(c.boss_health_remain or c.is_continue) for c in challenges)
+	finished, _, _, cont_blade = _blade_stat(_get_daily_stat(group_id, group.battle_id, qqid, d))
 	if finished >= 3:
 		if previous_day: raise InputError('昨日上报次数已达到3次')
 		raise InputError('今日上报次数已达到3次')
-	#出了多少刀补偿
-	all_cont_blade = sum(bool(c.is_continue) for c in challenges)
-	#剩余多少刀补偿
-	cont_blade = len(challenges) - finished - all_cont_blade
 	if is_continue and cont_blade == 0:
 		raise GroupError('您没有补偿刀')
 
@@ -662,51 +749,68 @@ def challenge(self,
 		challenge_damage = damage
 		real_cycle_boss_health[boss_num] -= damage
 
-	challenge:Clan_challenge = Clan_challenge.create(
-		gid=group_id,
-		qqid=qqid,
-		bid=group.battle_id,
-		challenge_pcrdate=d,
-		challenge_pcrtime=t,
-		boss_cycle=boss_cycle,
-		boss_num=boss_num,
-		boss_health_remain=boss_health_remain,
-		challenge_damage=challenge_damage,
-		is_continue=is_continue,
-		behalf=behalf,
-	)
-
+	remind_boss_nums = []
 	if defeat:
 		all_clear = 0
 		for _, _health in now_cycle_boss_health.items():
 			if _health == 0: all_clear += 1
 		if all_clear == 5:			# 检查当前周目的boss是否已经全部击杀
-			group.boss_cycle += 1	# 进入下一周目
-			next_cycle_level = self._level_by_cycle(group.boss_cycle+1, group.game_server)
+			new_boss_cycle += 1	# 进入下一周目
+			next_cycle_level = self._level_by_cycle(new_boss_cycle+1, group.game_server)
 			for _boss_num, _health in next_cycle_boss_health.items():# 血量数据挪移
 				now_cycle_boss_health[_boss_num] = _health
-				if _health == 0: subscribe_remind(self, group_id, _boss_num)# 如果挪过来的血量为0，则发送预约提醒
+				if _health == 0: remind_boss_nums.append(_boss_num)# 如果挪过来的血量为0，则发送预约提醒
 			for boss_num_, health_ in enumerate(self.bossinfo[group.game_server][next_cycle_level]):# 获取新血量数据放到下周目
 				next_cycle_boss_health[str(boss_num_+1)] = health_
 		else: real_cycle_boss_health[boss_num] = 0
 
-	group.now_cycle_boss_health = json.dumps(now_cycle_boss_health)
-	group.next_cycle_boss_health = json.dumps(next_cycle_boss_health)
-	challenge.save()
-	group.save()
-
-	# 取消申请出刀
-	if defeat: 
-		self.take_it_of_the_tree(group_id, qqid, boss_num, 1, send_web = False)#只是通知下树而已
-		self.cancel_blade(group_id, qqid, boss_num, 2, False)
-		if check_next_boss(self, group_id, boss_num):
-			subscribe_remind(self, group_id, boss_num)
-	else:
-		try:self.cancel_blade(group_id, qqid, send_web = False)
-		except:pass
-
-	nik = self._get_nickname_by_qqid(qqid)
-	behalf_nik = behalf and f'（{self._get_nickname_by_qqid(behalf)}代）' or ''
+	tree_members = []
+	reminds = []
+	with state.transaction():
+		new_challenge = Clan_challenge.create(
+			gid=group_id,
+			qqid=qqid,
+			bid=group.battle_id,
+			challenge_pcrdate=d,
+			challenge_pcrtime=t,
+			boss_cycle=boss_cycle,
+			boss_num=boss_num,
+			boss_health_remain=boss_health_remain,
+			challenge_damage=challenge_damage,
+			is_continue=is_continue,
+			behalf=behalf,
+		)
+		_update_daily_stat(new_challenge, 1)
+		group.boss_cycle = new_boss_cycle
+		state.now_health = now_cycle_boss_health
+		state.next_health = next_cycle_boss_health
+		state.mark('health')
+		state.save()
+
+		# 取消申请出刀
+		if defeat:
+			tree_members = [challenger for challenger, info in state.challengers.get(boss_num, {}).items() if info['tree']]
+			state.remove_boss_challengers(boss_num)
+		state.remove_challenger(qqid)
+
+		# 取出需要提醒的预约
+		if defeat and check_next_boss(self, group_id, boss_num):
+			remind_boss_nums.append(boss_num)
+		for _boss_num in remind_boss_nums:
+			subscribers = dict(state.subscribes.get(int(_boss_num), {}))
+			if not subscribers: continue
+			state.remove_boss_subscribes(int(_boss_num))
+			reminds.append((_boss_num, subscribers))
+	cache_events.publish('clan_battle', group_id, group.battle_id)
+
+	#写入完成后再发送提醒
+	if tree_members:
+		_send_tree_notice(self, group_id, tree_members)
+	for _boss_num, subscribers in reminds:
+		_send_subscribe_remind(self, group_id, _boss_num, subscribers)
+
+	nik = self._get_nickname_by_qqid(qqid, group_id)
+	behalf_nik = behalf and f'（{self._get_nickname_by_qqid(behalf, group_id)}代）' or ''
 	if defeat:
 		# 击败boss，补偿+1，已完成刀数需分情况
 		msg = '{}{}对{}号boss造成了{:,}点伤害，击败了boss\n（今日已完成{}刀，还有补偿刀{}刀，本刀是{}）\n'.format(
@@ -745,8 +849,9 @@ def undo(self, group_id: Groupid, qqid: QQid) :
 	last_cycle = last_challenge.boss_cycle	#上一刀的周目数
 	level = self._level_by_cycle(last_cycle, group.game_server)#阶段
 
-	now_cycle_boss_health = safe_load_json(group.now_cycle_boss_health, {})
-	next_cycle_boss_health = safe_load_json(group.next_cycle_boss_health, {})
+	state = get_group_state(self, group_id)
+	now_cycle_boss_health = state.now_health
+	next_cycle_boss_health = state.next_health
 	real_cycle_boss_health = now_cycle_boss_health #用来记录上一刀打的是哪个周目的boss
 
 	if last_cycle < group.boss_cycle:	# 判断被撤销的一刀是否是切换周目的一刀
@@ -761,12 +866,14 @@ def undo(self, group_id: Groupid, qqid: QQid) :
 		full_health = self.bossinfo[group.game_server][level][int(last_num)-1]
 		if real_cycle_boss_health[last_num] > full_health: real_cycle_boss_health[last_num] = full_health
 
-	last_challenge.delete_instance()
-	group.now_cycle_boss_health = json.dumps(now_cycle_boss_health)
-	group.next_cycle_boss_health = json.dumps(next_cycle_boss_health)
-	group.save()
+	with state.transaction():
+		last_challenge.delete_instance()
+		_update_daily_stat(last_challenge, -1)
+		state.mark('health')
+		state.save()
+	cache_events.publish('clan_battle', group_id, last_challenge.bid)
 
-	nik = self._get_nickname_by_qqid(last_challenge.qqid)
+	nik = self._get_nickname_by_qqid(last_challenge.qqid, group_id)
 	msg = f'{nik}的出刀记录已被撤销'
 	future_operation(self, group, msg)
 	return msg
@@ -782,7 +889,7 @@ def subscribe(self, group_id:Groupid, qqid:QQid, msg, note):
 	group:Clan_group = get_clan_group(self, group_id)
 	if group is None: raise GroupNotExist
 	if not msg: GroupError('您预约了一个空气')
-	subscribe_handler = SubscribeHandler(group=group)
+	subscribe_handler = SubscribeHandler(get_group_state(self, group_id))
 	if msg == '表':
 		back_msg = []
 		if not subscribe_handler.have_subscribe:
@@ -791,7 +898,7 @@ def subscribe(self, group_id:Groupid, qqid:QQid, msg, note):
 		for boss_num, subscribe_data in subscribe_handler.data.items():
 			back_msg.append(f'==={boss_num}号Boss===')
 			for boss_qqid, qqid_note in subscribe_data.items():
-				back_msg.append(f'{self._get_nickname_by_qqid(boss_qqid)}' + (f'：{qqid_note}' if qqid_note else ''))
+				back_msg.append(f'{self._get_nickname_by_qqid(boss_qqid, group_id)}' + (f'：{qqid_note}' if qqid_note else ''))
 		back_msg.append('='*12)
 		return '\n'.join(back_msg)
 	else:
@@ -799,29 +906,39 @@ def subscribe(self, group_id:Groupid, qqid:QQid, msg, note):
 		if subscribe_handler.is_subscribed(qqid, boss_num):
 			raise GroupError('你已经预约过这个boss啦 (╯‵□′)╯︵┻━┻')
 		subscribe_handler.subscribe(qqid, boss_num, note)
-		subscribe_handler.save()
 		return f'预约{boss_num}王成功！下个{boss_num}王出现时会at提醒。'
 
 #预约提醒
 def subscribe_remind(self, group_id:Groupid, boss_num):
-	group:Clan_group = get_clan_group(self, group_id)
-	subscribe_handler = SubscribeHandler(group=group)
+	state = get_group_state(self, group_id)
+	if state is None: return
+	subscribe_handler = SubscribeHandler(state)
 	boss_num = int(boss_num)
 	if not subscribe_handler.get_subscribe_list(boss_num):
 		return
+	_send_subscribe_remind(self, group_id, boss_num, dict(subscribe_handler.data[boss_num]))
+	subscribe_cancel(self, group_id, boss_num)
+
+#发送预约提醒
+def _send_subscribe_remind(self, group_id:Groupid, boss_num, subscribers:Dict[int, str]):
+	"""
+	Args:
+		group_id: QQ群号
+		boss_num: 几王
+		subscribers: 预约了这个boss的成员 {qqid:留言, }
+	"""
 	hint_message = f'船新的{boss_num}王来惹~ _(:з)∠)_\n'
-	for user_id in subscribe_handler.get_subscribe_list(boss_num):
+	for user_id, note in subscribers.items():
 		hint_message += atqq(user_id)
-		note = subscribe_handler.get_note(user_id, boss_num)
 		hint_message += ('：' + note) if note else ''
 		hint_message += '\n'
 	hint_message = hint_message[:-1]
-	asyncio.ensure_future(self.api.send_group_msg(
-		self_id = who_am_i(group_id), 
+	ensure_future(dispatcher.send(
+		self.api.send_group_msg,
+		who_am_i(group_id),
 		group_id = group_id,
 		message = hint_message,
 	))
-	subscribe_cancel(self, group_id, boss_num)
 
 #取消预约
 def subscribe_cancel(self, group_id:Groupid, boss_num, qqid = None):
@@ -832,9 +949,10 @@ def subscribe_cancel(self, group_id:Groupid, boss_num, qqid = None):
 		boss_num: 几王
 		qqid: 不填为删除特定boss的整个预约记录，填则删除特定用户的单个预约记录
 	'''
-	group:Clan_group = get_clan_group(self, group_id)
+	state = get_group_state(self, group_id)
+	if state is None: raise GroupNotExist
 	if not boss_num: raise GroupError('您取消了个寂寞')
-	subscribe_handler = SubscribeHandler(group=group)
+	subscribe_handler = SubscribeHandler(state)
 	boss_num = int(boss_num)
 	if not qqid:
 		subscribe_handler.unsubscribe_all(boss_num)
@@ -842,7 +960,6 @@ def subscribe_cancel(self, group_id:Groupid, boss_num, qqid = None):
 		if not subscribe_handler.is_subscribed(qqid, boss_num):
 			raise GroupError('您还没有预约这个boss')
 		subscribe_handler.unsubscribe(qqid, boss_num)
-	subscribe_handler.save()
 	return '取消成功~'
 
 #获取预约列表
@@ -853,8 +970,9 @@ def get_subscribe_list(self, group_id: Groupid):
 	Args:
 		group_id: QQ群号
 	"""
-	group:Clan_group = get_clan_group(self, group_id)
-	subscribe_handler = SubscribeHandler(group=group)
+	state = get_group_state(self, group_id)
+	if state is None: raise GroupNotExist
+	subscribe_handler = SubscribeHandler(state)
 	back_info = []
 	for boss_num, qqid_list in subscribe_handler.data.items():
 		for qqid, msg in qqid_list.items():
@@ -890,13 +1008,13 @@ def put_on_the_tree(self, group_id: Groupid, qqid: QQid, message=None, boss_num=
 			behalf = None
 		else:
 			behalf_is_member = True
-			behalf_nickname = self._get_nickname_by_qqid(behalf)
+			behalf_nickname = self._get_nickname_by_qqid(behalf, group_id)
 	else:
 		behalf = None
 
 	if User.get_or_none(qqid=challenger) is None:
 		raise GroupError('请挂树者先加入公会')
-	challenger_nickname = self._get_nickname_by_qqid(challenger)
+	challenger_nickname = self._get_nickname_by_qqid(challenger, group_id)
 
 	if boss_num == False:
 		if not self.check_blade(group_id, challenger):
@@ -929,21 +1047,18 @@ def put_on_the_tree(self, group_id: Groupid, qqid: QQid, message=None, boss_num=
 		if str(self.get_in_boss_num(group_id, challenger)) != str(boss_num):
 			raise GroupError('你申请的王和挂树的王不一样，怎么挂树啊 (╯‵□′)╯︵┻━┻')
 
-	challenging_member_list = safe_load_json(group.challenging_member_list, {})
+	state = get_group_state(self, group_id)
+	challenging_member_list = state.challengers
 	for item in challenging_member_list.values():
 		if item.get(str(challenger)) != None and item.get(str(challenger)).get('tree'):
 			raise GroupError('您已经在树上了')
 
 
 	if (behalf is None) and (behalf_is_member is None):
-		challenging_member_list[boss_num][str(challenger)]['tree'] = True
-		challenging_member_list[boss_num][str(challenger)]['msg'] = message
+		state.update_challenger(challenger, tree = True, msg = message)
 	else:
-		challenging_member_list[boss_num][str(challenger)]['tree'] = True
-		challenging_member_list[boss_num][str(challenger)]['msg'] = f'[「{behalf_nickname}」代挂]' + str(message)
+		state.update_challenger(challenger, tree = True, msg = f'[「{behalf_nickname}」代挂]' + str(message))
 
-	group.challenging_member_list = json.dumps(challenging_member_list)
-	group.save()
 	msg = f'{challenger_nickname}挂树惹~ (っ °Д °;)っ'
 	future_operation(self, group, msg)
 	return msg
@@ -961,7 +1076,7 @@ def query_tree(self, group_id: Groupid, user_id: QQid, boss_id=0) -> dict:
 	if group is None: raise GroupNotExist
 	user = User.get_or_none(qqid=user_id)
 	if user is None: raise GroupError('请先加入公会')
-	challenging_member_list = safe_load_json(group.challenging_member_list, {})
+	challenging_member_list = get_group_state(self, group_id).challengers
 	result = {"1": [], "2": [], "3": [], "4": [], "5": []}
 	if boss_id == 0:
 		for i in range(1, 6):
@@ -993,7 +1108,7 @@ def check_tree(self, group_id: Groupid, user_id: QQid):
 	if group is None: raise GroupNotExist
 	user = User.get_or_none(qqid=user_id)
 	if user is None: raise GroupError('请先加入公会')
-	challenging_member_list = safe_load_json(group.challenging_member_list, {})
+	challenging_member_list = get_group_state(self, group_id).challengers
 	for i in range(1, 6):
 		try:
 			for qid in challenging_member_list[str(i)]:
@@ -1022,7 +1137,8 @@ def take_it_of_the_tree(self, group_id: Groupid, qqid: QQid, boss_num=0, take_it
 	user = User.get_or_none(qqid=qqid)
 	if user is None: raise GroupError('请先加入公会')
 
-	challenging_member_list = safe_load_json(group.challenging_member_list, {})
+	state = get_group_state(self, group_id)
+	challenging_member_list = state.challengers
 
 	if take_it_type == 0:
 		boss_num = self.get_in_boss_num(group_id, qqid)
@@ -1031,31 +1147,82 @@ def take_it_of_the_tree(self, group_id: Groupid, qqid: QQid, boss_num=0, take_it
 		qqid = str(qqid)
 		if not challenging_member_list[boss_num][qqid]['tree']:
 			raise GroupError('你都没挂树，下啥子树啊 (╯‵□′)╯︵┻━┻')
-		challenging_member_list[boss_num][qqid]['tree'] = False
-		challenging_member_list[boss_num][qqid]['msg'] = None
-		group.challenging_member_list = json.dumps(challenging_member_list)
-		group.save()
+		state.update_challenger(qqid, tree = False, msg = None)
 	elif take_it_type == 1:
-		notice = []
-		for challenger, info in challenging_member_list[boss_num].items():
-			if info['tree']: notice.append(atqq(challenger))
+		notice = [challenger for challenger, info in challenging_member_list[boss_num].items() if info['tree']]
 		if len(notice) > 0:
-			asyncio.ensure_future(self.api.send_group_msg(
-				self_id = who_am_i(group_id), 
-				group_id = group_id,
-				message = '可以下树惹~ _(:з)∠)_\n'+'\n'.join(notice),
-			))
+			_send_tree_notice(self, group_id, notice)
 	msg = '下树惹~ _(:з)∠)_'
 	if send_web: future_operation(self, group, msg)
 	return msg
 
+#统计当日出刀情况
+def _blade_stat(stat:Optional[Clan_challenge_daily]) -> Tuple[int, int, int, int]:
+	"""
+	Args:
+		stat: 成员当日的出刀统计
+
+	Returns:
+		(已出完整刀数, 收尾且不是补偿的刀数, 已出补偿刀数, 剩余补偿刀数)
+	"""
+	if stat is None:
+		return 0, 0, 0, 0
+	finished = stat.full_blade + stat.continue_blade
+	#收尾且不是补偿
+	tail_blade = stat.tail_blade
+	#出了多少刀补偿
+	all_cont_blade = stat.continue_blade
+	#剩余多少刀补偿
+	cont_blade = stat.blade - finished - all_cont_blade
+	return finished, tail_blade, all_cont_blade, cont_blade
+
+#获取成员某天的出刀统计
+def _get_daily_stat(group_id:Groupid, battle_id:int, qqid:QQid, pcrdate:Pcr_date) -> Optional[Clan_challenge_daily]:
+	return Clan_challenge_daily.get_or_none(
+		Clan_challenge_daily.gid == group_id,
+		Clan_challenge_daily.bid == battle_id,
+		Clan_challenge_daily.pcrdate == pcrdate,
+		Clan_challenge_daily.qqid == qqid,
+	)
+
+#出刀记录写入或删除后同步更新每日出刀统计
+def _update_daily_stat(c:Clan_challenge, sign:int):
+	"""
+	Args:
+		c: 写入或删除的出刀记录
+		sign: 写入为1，删除为-1
+	"""
+	stat = _get_daily_stat(c.gid, c.bid, c.qqid, c.challenge_pcrdate)
+	if stat is None:
+		stat = Clan_challenge_daily(gid=c.gid, bid=c.bid, pcrdate=c.challenge_pcrdate, qqid=c.qqid)
+	stat.blade += sign
+	if c.is_continue:
+		stat.continue_blade += sign
+	elif c.boss_health_remain == 0:
+		stat.tail_blade += sign
+	else:
+		stat.full_blade += sign
+	stat.damage += sign * c.challenge_damage
+	if stat.blade <= 0:
+		if stat.rid is not None: stat.delete_instance()
+	else:
+		stat.save()
+
+#发送下树提醒
+def _send_tree_notice(self, group_id:Groupid, qqids:List[QQid]):
+	ensure_future(dispatcher.send(
+		self.api.send_group_msg,
+		who_am_i(group_id),
+		group_id = group_id,
+		message = '可以下树惹~ _(:з)∠)_\n'+'\n'.join(atqq(qqid) for qqid in qqids),
+	))
+
 #检查能否继续挑战下个boss
 def check_next_boss(self, group_id:Groupid, boss_num):
-	group:Clan_group = get_clan_group(self, group_id)
+	state = get_group_state(self, group_id)
+	group = state.group
 	boss_cycle = group.boss_cycle
-	now_cycle_boss_health = safe_load_json(group.now_cycle_boss_health, {})
-	next_cycle_boss_health = safe_load_json(group.next_cycle_boss_health, {})
-	if now_cycle_boss_health[boss_num] == 0 and next_cycle_boss_health[boss_num] == 0:
+	if state.now_health[boss_num] == 0 and state.next_health[boss_num] == 0:
 		return False
 	if self._level_by_cycle(boss_cycle, group.game_server) != self._level_by_cycle(boss_cycle+1, group.game_server):
 		return False
@@ -1071,8 +1238,10 @@ def apply_for_challenge(self, is_continue, group_id:Groupid, qqid:QQid, boss_num
 		boss_num: 几王
 		behalfed: 被代刀人的qq号
 	"""
-	group:Clan_group = get_clan_group(self, group_id)
-	if group is None:raise GroupNotExist
+	state = get_group_state(self, group_id)
+	if state is None:raise GroupNotExist
+	group = state.group
+	boss_num = str(boss_num)
 
 	behalf = None
 	challenger = behalfed and behalfed or qqid
@@ -1083,47 +1252,28 @@ def apply_for_challenge(self, is_continue, group_id:Groupid, qqid:QQid, boss_num
 	if self.check_blade(group_id, challenger):
 		raise GroupError('你已经申请过了 (╯‵□′)╯︵┻━┻')
 
-	now_cycle_boss_health = safe_load_json(group.now_cycle_boss_health, {})
 	if (not check_next_boss(self, group_id, boss_num) 
-		and now_cycle_boss_health[boss_num] == 0):
+		and state.now_health[boss_num] == 0):
 		raise GroupError('只能挑战2个周目内且不跨阶段的同个boss，请等待该周目的boss全部击杀完毕')
 
 	d, _ = pcr_datetime(area = group.game_server)
-	challenges:List[Clan_challenge] = Clan_challenge.select().where(
-		Clan_challenge.gid == group_id,
-		Clan_challenge.qqid == challenger,
-		Clan_challenge.bid == group.battle_id,
-		Clan_challenge.challenge_pcrdate == d,
-	).order_by(Clan_challenge.cid)
-	challenges = list(challenges)
-	finished = sum(bool(c.boss_health_remain or c.is_continue) for c in challenges)
+	finished, tail_blade, all_cont_blade, cont_blade = _blade_stat(_get_daily_stat(group_id, group.battle_id, challenger, d))
 	if finished >= 3: raise GroupError('今日已出了3次完整刀')
-	#收尾且不是补偿
-	tail_blade = sum(bool(c.boss_health_remain == 0 and (not c.is_continue)) for c in challenges)
-	#出了多少刀补偿
-	all_cont_blade = sum(bool(c.is_continue) for c in challenges)
-	#剩余多少刀补偿
-	cont_blade = len(challenges) - finished - all_cont_blade
 	if is_continue and cont_blade == 0:
 		raise GroupError('您没有补偿刀')
 	if finished + tail_blade - all_cont_blade >= 3 and cont_blade != 0:
 		is_continue = True
 	
-	nik = self._get_nickname_by_qqid(challenger)
+	nik = self._get_nickname_by_qqid(challenger, group_id)
 	info = [f'{nik}已开始挑战boss，剩最后几秒的时候记得暂停报伤害哦~']
-	challenging_list = safe_load_json(group.challenging_member_list, {})
-	if boss_num not in challenging_list:
-		challenging_list[boss_num] = {}
-	challenging_list[boss_num][challenger] = {
+	state.add_challenger(boss_num, challenger, {
 		'is_continue' : is_continue, 
 		'behalf' : behalf, 
 		's' : 0,
 		'damage' : 0,
 		'tree' : False,
 		'msg' : None,
-	}
-	group.challenging_member_list = json.dumps(challenging_list)
-	group.save()
+	})
 
 	self.challenger_info_small(group, boss_num, info)
 	info = '\n'.join(info)
@@ -1139,31 +1289,26 @@ def cancel_blade(self, group_id: Groupid, qqid: QQid, boss_num=0, cancel_type=1,
 		cancel_type: 取消类型：0取消全部 1取消特定qq号 2取消特定boss
 		send_web:是否更新web面板数据
 	"""
-	group:Clan_group = get_clan_group(self, group_id)
-	if group is None: raise GroupNotExist
+	state = get_group_state(self, group_id)
+	if state is None: raise GroupNotExist
+	group = state.group
 	msg = '？'
-	if group.challenging_member_list == None:
+	challenging_list = state.challengers
+	if not challenging_list:
 		raise GroupError('目前没有人正在挑战这个boss')
 	if cancel_type == 0 :
-		group.challenging_member_list = None
+		state.clear_challengers()
 		msg = '已取消所有'
 	elif cancel_type == 1 :
-		_boss_num = self.get_in_boss_num(group_id, qqid)
+		_boss_num = state.challenger_boss(qqid)
 		if not _boss_num : raise GroupError('你都没申请出刀，取啥子消啊 (╯‵□′)╯︵┻━┻')
-		challenging_list = safe_load_json(group.challenging_member_list, {})
-		del challenging_list[_boss_num][str(qqid)]
-		if len(challenging_list[_boss_num]) == 0: del challenging_list[_boss_num]
-		if len(challenging_list) == 0: group.challenging_member_list = None
-		else: group.challenging_member_list = json.dumps(challenging_list)
+		state.remove_challenger(qqid)
 		msg = '取消申请出刀成功'
 	elif boss_num != 0 and cancel_type == 2:
-		challenging_list = safe_load_json(group.challenging_member_list, {})
 		if boss_num not in challenging_list: return
-		del challenging_list[boss_num]
-		group.challenging_member_list = json.dumps(challenging_list)
+		state.remove_boss_challengers(boss_num)
 
 	if send_web: future_operation(self, group, msg)
-	group.save()
 	return msg
 
 #检查是否已申请出刀
@@ -1174,13 +1319,9 @@ def check_blade(self, group_id: Groupid, qqid: QQid):
 		group_id: QQ群号
 		qqid: 需要进行操作的QQ号
 	"""
-	group:Clan_group = get_clan_group(self, group_id)
-	if group is None: raise GroupNotExist
-	challenging_list = safe_load_json(group.challenging_member_list, {})
-	for _, infos in challenging_list.items():
-		for challenger in infos.keys():
-			if str(qqid) == challenger : return True
-	return False
+	state = get_group_state(self, group_id)
+	if state is None: raise GroupNotExist
+	return state.challenger_boss(qqid) is not None
 
 #获取boss_num
 def get_in_boss_num(self, group_id, qqid):
@@ -1190,12 +1331,7 @@ def get_in_boss_num(self, group_id, qqid):
 		group: 公会群对象
 		qqid: 需要进行操作的QQ号
 	"""
-	group:Clan_group = get_clan_group(self, group_id)
-	challenging_list = safe_load_json(group.challenging_member_list, {})
-	for boss_num, infos in challenging_list.items():
-		for challenger in infos.keys():
-			if str(qqid) == challenger : return boss_num
-	return False
+	return get_group_state(self, group_id).challenger_boss(qqid) or False
 
 
 #SL
@@ -1221,6 +1357,7 @@ def save_slot(self, group_id: Groupid, qqid: QQid,
 		if membership.last_save_slot != today: raise UserError('您今天还没有SL过')
 		membership.last_save_slot = 0
 		membership.save()
+		cache_events.publish('clan_member', group_id)
 		return '已取消SL。若已申请/挂树，需重新报告。'
 	if only_check:
 		return (membership.last_save_slot == today)
@@ -1244,7 +1381,7 @@ def save_slot(self, group_id: Groupid, qqid: QQid,
 	membership.save()
 
 	# refresh
-	self.get_member_list(group_id, nocache = True)
+	cache_events.publish('clan_member', group_id)
 	return '已记录SL。若已申请/挂树，需重新报告。 Σ(っ °Д °;)っ'
 
 #记录伤害/清空伤害
@@ -1259,30 +1396,26 @@ def report_hurt(self, s, hurt, group_id:Groupid, qqid:QQid, clean_type = 0):
 		qqid: 需要进行操作的QQ号
 		clean_type: 清理类型 0不清理(记录伤害) 1清特定玩家
 	"""
-	group:Clan_group = get_clan_group(self, group_id)
-	if group is None: raise GroupNotExist
-	boss_num = self.get_in_boss_num(group_id, qqid)
+	state = get_group_state(self, group_id)
+	if state is None: raise GroupNotExist
+	boss_num = state.challenger_boss(qqid)
 	if clean_type != 2 and not boss_num:
 		raise GroupError('你都没申请出刀，报啥子伤害啊 (╯‵□′)╯︵┻━┻')
 
 	ret_msg = ''
-	challenging_member_list = safe_load_json(group.challenging_member_list, {})
+	challenging_member_list = state.challengers
 
 	str_qqid = str(qqid)
 	if clean_type == 0:
-		challenging_member_list[boss_num][str_qqid]['s'] = s
-		challenging_member_list[boss_num][str_qqid]['damage'] = hurt
+		state.update_challenger(qqid, s = s, damage = hurt)
 		ret_msg = '已记录伤害，小心不要手滑哦~ ♪(´▽｀)'
 	elif clean_type == 1:
 		if challenging_member_list[boss_num][str_qqid]['damage'] == 0:
 			ret_msg = '您还没有报伤害呢'
 		else:
-			challenging_member_list[boss_num][str_qqid]['s'] = 0
-			challenging_member_list[boss_num][str_qqid]['damage'] = 0
+			state.update_challenger(qqid, s = 0, damage = 0)
 			ret_msg = '取消成功~'
 
-	group.challenging_member_list = json.dumps(challenging_member_list)
-	group.save()
 	return ret_msg
 
 #单个boss信息
@@ -1292,16 +1425,11 @@ def challenger_info_small(self, group:Clan_group, boss_num, msg:List = None):
 		group: 公会信息对象
 		boss_num: 几王
 	"""
-	now_health = safe_load_json(group.now_cycle_boss_health)[boss_num]
-	next_health = safe_load_json(group.next_cycle_boss_health)[boss_num]
+	state = get_group_state(self, group.group_id)
+	now_health = state.now_health[boss_num]
+	challenging_list = state.challengers.get(boss_num)
 
-	challenging_list = safe_load_json(group.challenging_member_list)
-	if challenging_list and (boss_num in challenging_list): 
-		challenging_list = challenging_list[boss_num]
-	else:
-		challenging_list = None
-
-	real_health = next_health if now_health == 0 else now_health
+	real_health = state.real_health(boss_num)
 	real_health_str = '{:,}'.format(real_health)
 	cycle = group.boss_cycle + 1 if now_health == 0 else group.boss_cycle
 	if not msg: msg = []
@@ -1318,11 +1446,11 @@ def challenger_info_small(self, group:Clan_group, boss_num, msg:List = None):
 	if challenging_list:
 		msg.append('--------------------')
 		for challenger, info in challenging_list.items():
-			temp_msg = f'->{self._get_nickname_by_qqid(int(challenger))}'
+			temp_msg = f'->{self._get_nickname_by_qqid(int(challenger), group.group_id)}'
 			if info['is_continue']:
 				temp_msg += '(补偿)'
 			if info['behalf']:
-				behalf = self._get_nickname_by_qqid(info['behalf'])
+				behalf = self._get_nickname_by_qqid(info['behalf'], group.group_id)
 				temp_msg += f'({behalf}代刀)'
 			if (0 if info['damage'] is None else info['damage']) > 0:
 				temp_msg += f', 剩{info["s"]}秒，打了{info["damage"]}万伤害'
@@ -1339,38 +1467,38 @@ def challenger_info(self, group_id):
 	Args:
 		group: 公会信息对象
 	"""
-	group:Clan_group = get_clan_group(self, group_id)
-	if group is None : raise GroupNotExist
+	state = get_group_state(self, group_id)
+	if state is None : raise GroupNotExist
+	group = state.group
 	date, _ = pcr_datetime(area = group.game_server)
-	challenges:List[Clan_challenge] = Clan_challenge.select().where(
-		Clan_challenge.gid == group_id,
-		Clan_challenge.bid == group.battle_id,
-		Clan_challenge.challenge_pcrdate == date,
-	).order_by(Clan_challenge.cid)
-	end_blade_qqid = {}         #保存有尾刀未出的人的qq
-	for c in challenges:
-		#如果出完这刀时boss的血量为0，且不是收尾刀
-		if c.boss_health_remain == 0 and not c.is_continue:
-			if c.qqid not in end_blade_qqid:
-				end_blade_qqid[c.qqid] = 1
-			else:
-				end_blade_qqid[c.qqid] += 1
-		if c.is_continue and c.qqid in end_blade_qqid:
-			end_blade_qqid[c.qqid] -= 1
-			if end_blade_qqid[c.qqid] == 0: del end_blade_qqid[c.qqid]
-
-	finish_challenge_count = sum(bool(c.boss_health_remain or c.is_continue) for c in challenges)
+	#公会数据没有变化时直接使用上次生成的图片
+	cache_key = (state.version, date, group.battle_id, image_engine.glovar_profile_image_version, self._nicknames.generation)
+	cached = self.status_image_cache.get(group_id)
+	if cached is not None and cached[0] is state and cached[1] == cache_key:
+		return cached[2]
+
+	stats:List[Clan_challenge_daily] = Clan_challenge_daily.select().where(
+		Clan_challenge_daily.gid == group_id,
+		Clan_challenge_daily.bid == group.battle_id,
+		Clan_challenge_daily.pcrdate == date,
+	).order_by(Clan_challenge_daily.rid)
+	end_blade_qqid = {}         #保存有尾刀未出的人的qq（尾刀数减去已出的补偿刀数）
+	finish_challenge_count = 0
+	for stat in stats:
+		if stat.tail_blade > stat.continue_blade:
+			end_blade_qqid[stat.qqid] = stat.tail_blade - stat.continue_blade
+		finish_challenge_count += stat.full_blade + stat.continue_blade
 
 	half_challenge_list:Dict[str, Any] = {"style-background-color": (240,240,240)}
 	for qqid, num in end_blade_qqid.items() :
 		if num < 0:
 			continue
-		half_challenge_list[str(qqid)] = f'{self._get_nickname_by_qqid(qqid)[:4]}'+ (f' x {num}' if num else '')
+		half_challenge_list[str(qqid)] = f'{self._get_nickname_by_qqid(qqid, group_id)[:4]}'+ (f' x {num}' if num else '')
 
-	challenging_list = safe_load_json(group.challenging_member_list)
+	challenging_list = state.challengers
 	group_boss_data = self._boss_data_dict(group)
 	boss_state_image_list:List[Union[Image.Image, BossStatusImageCore]] = []
-	subscribe_handler = SubscribeHandler(group=group)
+	subscribe_handler = SubscribeHandler(state)
 	
 	for boss_num in range(1,6):
 		this_boss_data = group_boss_data[boss_num]
@@ -1382,12 +1510,12 @@ def challenger_info(self, group_id):
 		if challenging_list and boss_num_str in challenging_list:
 			for challenger, info in challenging_list[boss_num_str].items():
 				challenger = str(challenger)
-				challenger_nickname = self._get_nickname_by_qqid(challenger)[:4]
+				challenger_nickname = self._get_nickname_by_qqid(challenger, group_id)[:4]
 				challenger_msg = challenger_nickname
 				if info['is_continue']:
 					challenger_msg += '(补)'
 				if info['behalf']:
-					behalf = self._get_nickname_by_qqid(info['behalf'])[:4]
+					behalf = self._get_nickname_by_qqid(info['behalf'], group_id)[:4]
 					challenger_msg += f'({behalf}代)'
 				if (0 if info['damage'] is None else info['damage']) > 0:
 					challenger_msg += f'@{info["s"]}s,{info["damage"]}w'
@@ -1401,7 +1529,7 @@ def challenger_info(self, group_id):
 		if boss_num in subscribe_handler.data:
 			subscribe_list = subscribe_handler.data[boss_num]
 			for user_id, note in subscribe_list.items():
-				extra_info["预约"][str(user_id)] = self._get_nickname_by_qqid(user_id)[:4] + (f":{note}" if note else "")
+				extra_info["预约"][str(user_id)] = self._get_nickname_by_qqid(user_id, group_id)[:4] + (f":{note}" if note else "")
 
 		boss_state_image_list.append(BossStatusImageCore(
 			this_boss_data['cycle'], 
@@ -1417,7 +1545,7 @@ def challenger_info(self, group_id):
 		_bg_color = [(132, 1, 244), (115, 166, 231), (206, 105, 165), (206, 80, 66), (181, 105, 206)][level_cycle]
 	except IndexError:
 		_bg_color = (181, 105, 206)
-	process_image = get_process_image(
+	process_image = GroupProcessImageCore(
 		[
 			GroupStateBlock(
 				title_text="完整刀",
@@ -1436,15 +1564,43 @@ def challenger_info(self, group_id):
 		],
 		{"补偿": half_challenge_list}
 	)
-	result_image = generate_combind_boss_state_image([process_image, *boss_state_image_list])
-	if result_image.mode != "RGB":
-		result_image = result_image.convert("RGB")
-	bio = BytesIO()
-	result_image.save(bio, format='JPEG', quality=95)
-	result_image.close()
-	base64_str = 'base64://' + base64.b64encode(bio.getvalue()).decode()
-	bio.close()
-	return f"[CQ:image,file={base64_str}]"
+	#只重新生成数据发生变化的面板
+	panel_cache = self.status_panel_cache.setdefault(group_id, {})
+	result_image = generate_combind_boss_state_image([process_image, *boss_state_image_list], panel_cache)
+	result = _image_message(self, group_id, result_image)
+	self.status_image_cache[group_id] = (state, cache_key, result)
+	return result
+
+#编码状态图并生成CQ码
+def _image_message(self, group_id:Groupid, image:Image.Image) -> str:
+	"""
+	Args:
+		image: 状态图，编码后会被关闭
+	"""
+	start = time.perf_counter()
+	data, ext = encode_image(
+		image,
+		image_format = self.setting.get('status_image_format', 'jpeg'),
+		quality = self.setting.get('status_image_quality', 95),
+		scale = self.setting.get('status_image_scale', 1),
+		max_bytes = self.setting.get('status_image_max_bytes', 0),
+	)
+	_logger.info(f'状态图 {group_id} {ext} {len(data)}字节 编码{(time.perf_counter()-start)*1000:.0f}ms')
+	if not self.setting.get('status_image_by_url', False):
+		return f"[CQ:image,file=base64://{base64.b64encode(data).decode()}]"
+	#写入output目录，用链接发送
+	output_path = os.path.join(self.setting['dirname'], 'output', 'clan_status')
+	os.makedirs(output_path, exist_ok=True)
+	file_name = f'{group_id}-{hashlib.md5(data).hexdigest()[:16]}.{ext}'
+	for old_file in os.listdir(output_path):
+		if old_file.startswith(f'{group_id}-') and old_file != file_name:
+			os.remove(os.path.join(output_path, old_file))
+	with open(os.path.join(output_path, file_name), 'wb') as f:
+		f.write(data)
+	url = urljoin(
+		self.setting['public_address'],
+		'{}output/clan_status/{}'.format(self.setting['public_basepath'], file_name))
+	return f"[CQ:image,file={url}]"
 
 #出刀记录
 def challenge_record(self, group_id):
@@ -1452,29 +1608,23 @@ def challenge_record(self, group_id):
 	if group is None : raise GroupNotExist
 	date, _ = pcr_datetime(area = group.game_server)
 	members:List[Clan_member] = Clan_member.select().where(Clan_member.group_id == group_id)
+	stats = {stat.qqid: stat for stat in Clan_challenge_daily.select().where(
+		Clan_challenge_daily.gid == group_id,
+		Clan_challenge_daily.bid == group.battle_id,
+		Clan_challenge_daily.pcrdate == date,
+	)}
 
 	total_blade_num = 0				#总出刀数
 	total_continue_blade_num = 0	#总补偿刀数量
 	zero_blade_members = []			#一刀没出的成员
 	blade_list = {}
 	for member in members:
-		challenge_records:List[Clan_challenge] = Clan_challenge.select().where(
-			Clan_challenge.gid == group_id,
-			Clan_challenge.bid == group.battle_id,
-			Clan_challenge.challenge_pcrdate == date,
-			Clan_challenge.qqid == member.qqid
-		).order_by(Clan_challenge.cid)
-		if len(challenge_records) != 0:
-			member_num = 0			#单个成员出刀数
-			continue_blade_num = 0	#单个成员剩余补偿刀数量
-			for c in challenge_records:
-				if c.boss_health_remain == 0 and not c.is_continue:	#完整刀收尾算0.5刀
-					member_num += 0.5
-					continue_blade_num += 1
-				elif c.is_continue:	#补偿刀算0.5刀
-					member_num += 0.5
-					continue_blade_num -= 1
-				else: member_num += 1
+		stat:Clan_challenge_daily = stats.get(member.qqid)
+		if stat is not None:
+			#完整刀收尾与补偿刀各算0.5刀
+			half_blade = stat.tail_blade + stat.continue_blade
+			member_num = stat.full_blade + half_blade / 2 if half_blade else stat.full_blade	#单个成员出刀数
+			continue_blade_num = stat.tail_blade - stat.continue_blade	#单个成员剩余补偿刀数量
 			total_blade_num += member_num
 			total_continue_blade_num += continue_blade_num
 			if member_num not in blade_list: blade_list[member_num] = 1
@@ -1486,7 +1636,7 @@ def challenge_record(self, group_id):
 	back_msg.append(f"待出补偿刀数量：{total_continue_blade_num}")
 	back_msg.append(f"已出0刀的成员数量：{len(zero_blade_members)}")
 	for i in range(len(zero_blade_members)):
-		name = self._get_nickname_by_qqid(zero_blade_members[i])
+		name = self._get_nickname_by_qqid(zero_blade_members[i], group_id)
 		back_msg.append(f"{i == len(zero_blade_members)-1 and '┖' or '┣'}{name}")
 	for blade_num in blade_list.keys():
 		back_msg.append(f"已出{blade_num}刀：{blade_list[blade_num]}")
@@ -1495,7 +1645,7 @@ def challenge_record(self, group_id):
 
 
 ##获取报告
-@timed_cached_func(max_len=64, max_age_seconds=10, ignore_self=True)
+@cached_func(64, ignore_self=True)
 def get_report(self,
 				group_id: Groupid,
 				battle_id: Union[str, int, None],
@@ -1533,28 +1683,76 @@ def get_report(self,
 	for c in Clan_challenge.select().where(
 		*expressions
 	):
-		report.append({
-			'battle_id': c.bid,
-			'qqid': c.qqid,
-			'challenge_time': pcr_timestamp(
-				c.challenge_pcrdate,
-				c.challenge_pcrtime,
-				group.game_server,
-			),
-			'challenge_pcrdate': c.challenge_pcrdate,
-			'challenge_pcrtime': c.challenge_pcrtime,
-			'cycle': c.boss_cycle,
-			'boss_num': c.boss_num,
-			'health_remain': c.boss_health_remain,
-			'damage': c.challenge_damage,
-			'is_continue': c.is_continue,
-			'message': c.message,
-			'behalf': c.behalf,
-		})
+		report.append(_report_row(c, group.game_server))
+	return report
+
+#分页获取出刀记录，用于流式导出
+def get_report_page(self,
+				group_id: Groupid,
+				battle_id: Union[str, int, None],
+				after_cid: int = 0,
+				since: Optional[int] = None,
+				limit: int = 1000,
+				) -> ClanBattleReport:
+	"""
+	Args:
+		group_id: QQ群号
+		battle_id: 档案号，"all"为所有档案，None为当前档案
+		after_cid: 只获取cid大于此值的记录（上一页最后一条记录的cid）
+		since: 只获取此时间戳之后的记录
+		limit: 最多获取的记录数
+	"""
+	group:Clan_group = get_clan_group(self, group_id)
+	if group is None: raise GroupNotExist
+	expressions = [
+		Clan_challenge.gid == group_id,
+		Clan_challenge.cid > after_cid,
+	]
+	if battle_id is None:
+		battle_id = group.battle_id
+	if isinstance(battle_id, str):
+		if battle_id != 'all':
+			raise InputError(
+				f'unexceptd value "{battle_id}" for battle_id')
+	else:
+		expressions.append(Clan_challenge.bid == battle_id)
+	if since is not None:
+		since_date, since_time = pcr_datetime(group.game_server, since)
+		expressions.append(
+			(Clan_challenge.challenge_pcrdate > since_date) |
+			((Clan_challenge.challenge_pcrdate == since_date) & (Clan_challenge.challenge_pcrtime >= since_time))
+		)
+	report = []
+	for c in Clan_challenge.select().where(
+		*expressions
+	).order_by(Clan_challenge.cid).limit(limit):
+		row = _report_row(c, group.game_server)
+		row['cid'] = c.cid
+		report.append(row)
 	return report
 
+def _report_row(c:Clan_challenge, game_server) -> Dict[str, Any]:
+	return {
+		'battle_id': c.bid,
+		'qqid': c.qqid,
+		'challenge_time': pcr_timestamp(
+			c.challenge_pcrdate,
+			c.challenge_pcrtime,
+			game_server,
+		),
+		'challenge_pcrdate': c.challenge_pcrdate,
+		'challenge_pcrtime': c.challenge_pcrtime,
+		'cycle': c.boss_cycle,
+		'boss_num': c.boss_num,
+		'health_remain': c.boss_health_remain,
+		'damage': c.challenge_damage,
+		'is_continue': c.is_continue,
+		'message': c.message,
+		'behalf': c.behalf,
+	}
+
 #从会战记录里获取成员列表
-@timed_cached_func(max_len=64, max_age_seconds=10, ignore_self=True)
+@cached_func(64, ignore_self=True)
 def get_battle_member_list(self,
 							group_id: Groupid,
 							battle_id: Union[str, int, None],
@@ -1597,7 +1795,7 @@ def get_battle_member_list(self,
 	return member_list
 
 #获取并刷新成员列表
-@timed_cached_func(max_len=16, max_age_seconds=3600, ignore_self=True)
+@cached_func(16, ignore_self=True)
 def get_member_list(self, group_id: Groupid) -> List[Dict[str, Any]]:
 	"""
 	获取并刷新成员列表
@@ -1622,3 +1820,23 @@ def get_member_list(self, group_id: Groupid) -> List[Dict[str, Any]]:
 			'sl': user.clan_member.last_save_slot,
 		})
 	return member_list
+
+#会战记录变化（出刀、撤销、清空或切换档案等）后使相关缓存失效
+#battle_id为None时表示该公会的所有档案
+@cache_events.subscribe('clan_battle')
+def _on_battle_changed(group_id: Groupid, battle_id: Optional[int]):
+	def affected(key):
+		return key[0] == group_id and (battle_id is None or key[1] in (None, 'all', battle_id))
+	get_report.invalidate_if(affected)
+	get_battle_member_list.invalidate_if(affected)
+
+#成员变化（加入、退出、改名或SL）后使相关缓存失效
+#group_id为None时表示所有公会
+@cache_events.subscribe('clan_member')
+def _on_member_changed(group_id: Optional[Groupid]):
+	if group_id is None:
+		get_member_list.cache_clear()
+		get_battle_member_list.cache_clear()
+		return
+	get_member_list.invalidate(group_id)
+	get_battle_member_list.invalidate_if(lambda key: key[0] == group_id)
@@ -1,6 +1,8 @@
 import os
 import string
 
+from peewee import Case, fn
+
 from ..exception import GroupNotExist
 from ...ybdata import Clan_challenge, Clan_group, Clan_member
 
@@ -23,14 +25,35 @@ def score_table(self, group_id):
 		Clan_member.group_id == group_id,
 	)
 
+	#整刀算1分，尾刀和补偿刀伤害达到阈值算1分，否则算0.5分
+	#按出刀人和代刀人一次性汇总当期所有出刀记录
+	full = (Clan_challenge.boss_health_remain > 0) & (Clan_challenge.is_continue == False)
+	end = (Clan_challenge.boss_health_remain == 0) & (Clan_challenge.is_continue == False)
+	summary = Clan_challenge.select(
+		Clan_challenge.qqid,
+		Clan_challenge.behalf,
+		fn.COUNT(Clan_challenge.cid).alias('blade'),
+		fn.SUM(Case(None, [(full, 1)], 0)).alias('full_blade'),
+		fn.SUM(Case(None, [(end, 1)], 0)).alias('end_blade'),
+		fn.SUM(Case(None, [(Clan_challenge.is_continue == True, 1)], 0)).alias('small_end_blade'),
+		fn.SUM(Case(None, [(full | (Clan_challenge.challenge_damage >= group.threshold), 1)], 0)).alias('whole_score'),
+	).where(
+		Clan_challenge.gid == group_id,
+		Clan_challenge.bid == group.battle_id,
+		Clan_challenge.qqid.in_(members.select(Clan_member.qqid)),
+	).group_by(
+		Clan_challenge.qqid,
+		Clan_challenge.behalf,
+	).order_by(
+		fn.MIN(Clan_challenge.challenge_pcrdate),
+		fn.MIN(Clan_challenge.cid),
+	).dicts()
+	member_summary = {}
+	for row in summary:
+		member_summary.setdefault(row['qqid'], []).append(row)
+
 	member_score_dict = {}
 	for member in members:
-		challenges = Clan_challenge.select().where(
-			Clan_challenge.gid == group_id,
-			Clan_challenge.bid == group.battle_id,
-			Clan_challenge.qqid == member.qqid
-		).order_by(Clan_challenge.challenge_pcrdate)
-		challenges = list(challenges)
 		if member.qqid not in member_score_dict:
 			member_score_dict[member.qqid] = {
 				'score' : 0,
@@ -38,39 +61,27 @@ def score_table(self, group_id):
 				'end_blade' : 0,
 				'small_end_blade' : 0,
 			}
-
-		full_blade = sum(bool(c.boss_health_remain and not c.is_continue) for c in challenges)
-		for info in challenges:
-			score, full_blade, end_blade, small_end_blade = 0, 0, 0, 0
-			if info.boss_health_remain > 0 and not info.is_continue: 
-				full_blade += 1
-				score += 1
-			elif info.boss_health_remain == 0 and not info.is_continue: 
-				end_blade += 1
-				if info.challenge_damage >= group.threshold: score += 1
-				else: score += 0.5
-			elif info.is_continue:
-				small_end_blade += 1
-				if info.challenge_damage >= group.threshold: score += 1
-				else: score += 0.5
-			score_member = info.behalf and info.behalf or member.qqid
+		for row in member_summary.get(member.qqid, []):
+			half_score = row['blade'] - row['whole_score']
+			score = row['whole_score'] + half_score * 0.5 if half_score else row['whole_score']
+			score_member = row['behalf'] and row['behalf'] or member.qqid
 			if score_member not in member_score_dict:
 				member_score_dict[score_member] = {
 					'score' : score, 
-					'full_blade' : full_blade,
-					'end_blade' : end_blade,
-					'small_end_blade' : small_end_blade,
+					'full_blade' : row['full_blade'],
+					'end_blade' : row['end_blade'],
+					'small_end_blade' : row['small_end_blade'],
 				}
 			else:
 				member_score_dict[score_member]['score'] += score
-				member_score_dict[score_member]['full_blade'] += full_blade
-				member_score_dict[score_member]['end_blade'] += end_blade
-				member_score_dict[score_member]['small_end_blade'] += small_end_blade
+				member_score_dict[score_member]['full_blade'] += row['full_blade']
+				member_score_dict[score_member]['end_blade'] += row['end_blade']
+				member_score_dict[score_member]['small_end_blade'] += row['small_end_blade']
 
 	member_score_dict = dict(sorted(member_score_dict.items(), key=lambda item: item[1]['score'], reverse=True))
 	back_msg = []
 	for qqid, info in member_score_dict.items():
-		name:string = list(self._get_nickname_by_qqid(qqid))
+		name:string = list(self._get_nickname_by_qqid(qqid, group_id))
 		while len(name) > 5:name.pop()
 		a = ''
 		if len(name) < 5:
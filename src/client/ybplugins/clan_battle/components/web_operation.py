@@ -1,4 +1,5 @@
 import asyncio
+import json
 import logging
 from urllib.parse import urljoin
 
@@ -9,10 +10,14 @@ from ...templating import render_template
 from ...ybdata import Clan_group, Clan_member, User
 from ..exception import ClanBattleError
 from ..util import pcr_datetime, atqq
-from .multi_cq_utils import who_am_i
+from .boss_status import merge_delta
+from . import worker
 
 _logger = logging.getLogger(__name__)
 
+SSE_PING = 15	#推送连接的心跳间隔（秒）
+STATISTICS_PAGE = 1000	#统计数据导出时每次读取的记录数
+
 def register_routes(self, app: Quart):
 	@app.route(
 		urljoin(self.setting['public_basepath'], 'clan/<int:group_id>/'),
@@ -52,6 +57,63 @@ def register_routes(self, app: Quart):
 			'clan/subscribers.html',
 		)
 
+	@app.route(
+		urljoin(self.setting['public_basepath'],
+				'clan/<int:group_id>/status/'),
+		methods=['GET'])
+	async def yobot_clan_status(group_id):
+		group = self.get_clan_group(group_id=group_id)
+		if group is None:
+			return jsonify(code=20, message='Group not exists'), 404
+		if 'yobot_user' not in session:
+			if not(group.privacy & 0x1):
+				return jsonify(code=10, message='Not logged in'), 403
+		else:
+			user = User.get_by_id(session['yobot_user'])
+			is_member = Clan_member.get_or_none(
+				group_id=group_id, qqid=session['yobot_user'])
+			if (not is_member and user.authority_group >= 10):
+				return jsonify(code=11, message='Insufficient authority'), 403
+		#断线重连时浏览器会带上收到的最后一个版本号，首次连接时由网页带上get_data取到的版本号
+		last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+		last_seq = self._boss_status.parse_version(last_event_id)
+
+		async def stream():
+			yield 'retry: 3000\n\n'.encode()
+			seq = self._boss_status.last_seq(group_id)
+			if last_seq is None or not self._boss_status.complete_after(group_id, last_seq):
+				#没有版本号、服务重启过或落后太多，先推送一次完整状态
+				bossData = await self.group_queue.read(group_id, self._boss_data_dict, group)
+				yield _sse_message(self._boss_status.version(seq), {
+					'version': self._boss_status.version(seq),
+					'bossData': bossData,
+					'base_cycle': group.boss_cycle,
+					'notice': None,
+				})
+			else:
+				seq = last_seq
+			while True:
+				events = await self._boss_status.wait(group_id, seq, SSE_PING)
+				if not events:
+					yield ': ping\n\n'.encode()
+					continue
+				if self._boss_status.complete_after(group_id, seq):
+					for event in events:
+						yield _sse_event(self._boss_status, event)
+				else:
+					#连接太慢，错过的变化已被丢弃，直接推送最新的完整状态
+					update = _status_update(self._boss_status, group_id, seq, events)
+					yield _sse_message(update['version'], update)
+				seq = events[-1].seq
+
+		response = await make_response(stream(), 200, {
+			'Content-Type': 'text/event-stream',
+			'Cache-Control': 'no-cache',
+			'X-Accel-Buffering': 'no',
+		})
+		response.timeout = None
+		return response
+
 	@app.route(
 		urljoin(self.setting['public_basepath'],
 				'clan/<int:group_id>/api/'),
@@ -114,22 +176,40 @@ def register_routes(self, app: Quart):
 						'game_server': group.game_server,
 						'cycle': group.boss_cycle,
 					},
-					bossData=self._boss_data_dict(group),
+					bossData=await self.group_queue.read(group_id, self._boss_data_dict, group),
 					base_cycle = group.boss_cycle,
+					version = self._boss_status.version(self._boss_status.last_seq(group_id)),
 					selfData={
 						'is_admin': (is_member and user.authority_group < 100),
 						'user_id': user_id,
 					}
 				)
 			elif action == 'update_boss_data':
+				#带上版本号时只返回之后的变化
+				version = self._boss_status.parse_version(payload.get('version'))
+				if version is not None and self._boss_status.complete_after(group_id, version):
+					events = self._boss_status.events_after(group_id, version)
+					if not events:
+						return jsonify(
+							code = 0,
+							bossDelta = {},
+							base_cycle = group.boss_cycle,
+							version = self._boss_status.version(version),
+						)
+					return jsonify(
+						code = 0,
+						**_status_update(self._boss_status, group_id, version, events),
+					)
 				return jsonify(
 					code = 0,
-					bossData = self._boss_data_dict(group),
+					bossData = await self.group_queue.read(group_id, self._boss_data_dict, group),
 					base_cycle = group.boss_cycle,
+					version = self._boss_status.version(self._boss_status.last_seq(group_id)),
 				)
 			elif action == 'get_challenge':
 				d, _ = pcr_datetime(group.game_server)
-				report = self.get_report(
+				report = await worker.run(
+					self.get_report,
 					group_id,
 					None,
 					None,
@@ -141,7 +221,8 @@ def register_routes(self, app: Quart):
 					today=d,
 				)
 			elif action == 'get_user_challenge':
-				report = self.get_report(
+				report = await worker.run(
+					self.get_report,
 					group_id,
 					None,
 					payload['qqid'],
@@ -161,26 +242,34 @@ def register_routes(self, app: Quart):
 					}
 				)
 			elif action == 'update_boss':
-				try:
-					bossData, base_cycle, notice = await asyncio.wait_for(
-						asyncio.shield(
-							self._boss_status[group_id]),
-							timeout=30
+				#带上版本号时返回之后的变化，不带时等待下一次变化并返回完整状态
+				version = self._boss_status.parse_version(payload.get('version'))
+				full = version is None
+				if full:
+					version = self._boss_status.last_seq(group_id)
+					if payload.get('version') is not None:
+						#服务重启前的版本号，网页上的状态已无法补齐，立即返回完整状态
+						return jsonify(
+							code = 0,
+							bossData = await self.group_queue.read(group_id, self._boss_data_dict, group),
+							base_cycle = group.boss_cycle,
+							notice = None,
+							version = self._boss_status.version(version),
 						)
-					return jsonify(
-						code = 0,
-						bossData = bossData,
-						base_cycle = base_cycle,
-						notice = notice,
-					)
-				except asyncio.TimeoutError:
+				events = await self._boss_status.wait(group_id, version, 30)
+				if not events:
 					return jsonify(
 						code=1,
 						message='not changed',
+						version=self._boss_status.version(version),
 					)
+				return jsonify(
+					code = 0,
+					**_status_update(self._boss_status, group_id, version, events, full),
+				)
 			elif action == 'addrecord':
 				try:
-					status = self.challenge(group_id, user_id,
+					status, bossData = await self.group_queue.run(group_id, _with_boss_data(self, group, self.challenge), group_id, user_id,
 					payload['defeat'],
 					payload['damage'],
 					payload['behalf'],
@@ -196,20 +285,14 @@ def register_routes(self, app: Quart):
 				_logger.info('网页 成功 {} {} {}'.format(
 					user_id, group_id, action))
 				if group.notification & 0x01:
-					asyncio.ensure_future(
-						self.api.send_group_msg(
-							self_id = who_am_i(group_id),
-							group_id=group_id,
-							message=str(status),
-						)
-					)
+					self.group_notifier.notify(group_id, str(status))
 				return jsonify(
 					code=0,
-					bossData=self._boss_data_dict(group),
+					bossData=bossData,
 				)
 			elif action == 'undo':
 				try:
-					status = self.undo(group_id, user_id)
+					status, bossData = await self.group_queue.run(group_id, _with_boss_data(self, group, self.undo), group_id, user_id)
 				except ClanBattleError as e:
 					_logger.info('网页 失败 {} {} {}'.format(
 						user_id, group_id, action))
@@ -220,16 +303,10 @@ def register_routes(self, app: Quart):
 				_logger.info('网页 成功 {} {} {}'.format(
 					user_id, group_id, action))
 				if group.notification & 0x02:
-					asyncio.ensure_future(
-						self.api.send_group_msg(
-							self_id = who_am_i(group_id),
-							group_id=group_id,
-							message=str(status),
-						)
-					)
+					self.group_notifier.notify(group_id, str(status))
 				return jsonify(
 					code=0,
-					bossData=self._boss_data_dict(group),
+					bossData=bossData,
 				)
 			elif action == 'apply':
 				try:
@@ -237,7 +314,7 @@ def register_routes(self, app: Quart):
 					behalf = payload['behalf']
 					boss_num = payload['boss_num']
 					if behalf == user_id: behalf = None
-					status = self.apply_for_challenge(is_continue, group_id, user_id, boss_num, behalf)
+					status, bossData = await self.group_queue.run(group_id, _with_boss_data(self, group, self.apply_for_challenge), is_continue, group_id, user_id, boss_num, behalf)
 				except ClanBattleError as e:
 					_logger.info('网页 失败 {} {} {}'.format(user_id, group_id, action))
 					return jsonify(
@@ -246,82 +323,58 @@ def register_routes(self, app: Quart):
 					)
 				_logger.info('网页 成功 {} {} {}'.format(user_id, group_id, action))
 				if group.notification & 0x04:
-					asyncio.ensure_future(
-						self.api.send_group_msg(
-							self_id = who_am_i(group_id),
-							group_id = group_id,
-							message = atqq(behalf)+status,
-						)
-					)
+					self.group_notifier.notify(group_id, atqq(behalf)+status)
 				return jsonify(
 					code = 0,
-					bossData = self._boss_data_dict(group),
+					bossData = bossData,
 				)
 			elif action == 'cancelapply':
 				try:
 					behalf = payload['behalf'] and int(payload['behalf']) or user_id
-					status = self.cancel_blade(group_id, behalf)
+					status, bossData = await self.group_queue.run(group_id, _with_boss_data(self, group, self.cancel_blade), group_id, behalf)
 				except ClanBattleError as e:
 					_logger.info('网页 失败 {} {} {}'.format(user_id, group_id, action))
 					return jsonify(code=10, message=str(e))
 				_logger.info('网页 成功 {} {} {}'.format(user_id, group_id, action))
 				if group.notification & 0x08:
-					asyncio.ensure_future(
-						self.api.send_group_msg(
-							self_id = who_am_i(group_id),
-							group_id = group_id,
-							message = atqq(behalf)+status,
-						)
-					)
+					self.group_notifier.notify(group_id, atqq(behalf)+status)
 				return jsonify(
 					code=0,
-					bossData=self._boss_data_dict(group),
+					bossData=bossData,
 				)
 			elif action == 'put_on_the_tree':
 				try:
 					behalf = payload['behalf'] and int(payload['behalf']) or user_id
-					status = self.put_on_the_tree(group_id, behalf)
+					status, bossData = await self.group_queue.run(group_id, _with_boss_data(self, group, self.put_on_the_tree), group_id, behalf)
 				except ClanBattleError as e:
 					_logger.info('网页 失败 {} {} {}'.format(user_id, group_id, action))
 					return jsonify(code=10, message=str(e))
 				_logger.info('网页 成功 {} {} {}'.format(user_id, group_id, action))
 				if group.notification & 0x08:
-					asyncio.ensure_future(
-						self.api.send_group_msg(
-							self_id = who_am_i(group_id),
-							group_id = group_id,
-							message = atqq(behalf)+status,
-						)
-					)
+					self.group_notifier.notify(group_id, atqq(behalf)+status)
 				return jsonify(
 					code=0,
-					bossData=self._boss_data_dict(group),
+					bossData=bossData,
 				)
 			elif action == 'take_it_of_the_tree':
 				try:
 					behalf = payload['behalf'] and int(payload['behalf']) or user_id
-					status = self.take_it_of_the_tree(group_id, behalf)
+					status, bossData = await self.group_queue.run(group_id, _with_boss_data(self, group, self.take_it_of_the_tree), group_id, behalf)
 				except ClanBattleError as e:
 					_logger.info('网页 失败 {} {} {}'.format(user_id, group_id, action))
 					return jsonify(code=10, message=str(e))
 				_logger.info('网页 成功 {} {} {}'.format(user_id, group_id, action))
 				if group.notification & 0x08:
-					asyncio.ensure_future(
-						self.api.send_group_msg(
-							self_id = who_am_i(group_id),
-							group_id = group_id,
-							message = atqq(behalf)+status,
-						)
-					)
+					self.group_notifier.notify(group_id, atqq(behalf)+status)
 				return jsonify(
 					code=0,
-					bossData=self._boss_data_dict(group),
+					bossData=bossData,
 				)
 			elif action == 'save_slot':
 				sl_member_qqid = payload['member']
 				status = payload['status']
 				try:
-					self.save_slot(group_id, sl_member_qqid, clean_flag = not status)
+					await self.group_queue.run(group_id, self.save_slot, group_id, sl_member_qqid, clean_flag = not status)
 				except ClanBattleError as e:
 					_logger.info('网页 失败 {} {} {}'.format(user_id, group_id, action))
 					return jsonify(
@@ -331,16 +384,10 @@ def register_routes(self, app: Quart):
 				sw = '添加' if status else '取消'
 				_logger.info('网页 成功 {} {} {}'.format(user_id, group_id, action))
 				if group.notification & 0x200:
-					asyncio.ensure_future(
-						self.api.send_group_msg(
-							self_id = who_am_i(group_id),
-							group_id=group_id,
-							message=(self._get_nickname_by_qqid(sl_member_qqid) + f'已{sw}SL记录'),
-						)
-					)
+					self.group_notifier.notify(group_id, (self._get_nickname_by_qqid(sl_member_qqid) + f'已{sw}SL记录'))
 				return jsonify(code=0, notice=f'已{sw}SL记录')
 			elif action == 'get_subscribers':
-				subscribers = self.get_subscribe_list(group_id)
+				subscribers = await self.group_queue.read(group_id, self.get_subscribe_list, group_id)
 				return jsonify(
 					code=0,
 					group_name=group.group_name,
@@ -348,7 +395,7 @@ def register_routes(self, app: Quart):
 			elif action == 'add_subscribe':
 				boss_num = payload['boss_num']
 				message = payload.get('message')
-				try:self.subscribe(group_id, user_id, str(boss_num), message)
+				try:await self.group_queue.run(group_id, self.subscribe, group_id, user_id, str(boss_num), message)
 				except ClanBattleError as e:
 					_logger.info('网页 失败 {} {} {}'.format(user_id, group_id, action))
 					return jsonify(code = 10, message = str(e))
@@ -360,36 +407,25 @@ def register_routes(self, app: Quart):
 						boss_num,
 					)
 					if message: notice_message += '\n留言：' + message
-					asyncio.ensure_future(
-						self.api.send_group_msg(
-							self_id = who_am_i(group_id),
-							group_id = group_id,
-							message = notice_message,
-						)
-					)
+					self.group_notifier.notify(group_id, notice_message)
 				return jsonify(code=0, notice=notice)
 			elif action == 'cancel_subscribe':
 				boss_num = payload['boss_num']
-				try:self.subscribe_cancel(group_id, str(boss_num), user_id)
+				try:await self.group_queue.run(group_id, self.subscribe_cancel, group_id, str(boss_num), user_id)
 				except ClanBattleError as e:
 					_logger.info('网页 失败 {} {} {}'.format(user_id, group_id, action))
 					return jsonify(code = 10, message = str(e))
 				_logger.info('网页 成功 {} {} {}'.format(user_id, group_id, action))
 				notice = '取消预约成功'
 				if group.notification & 0x80:
-					asyncio.ensure_future(
-						self.api.send_group_msg(
-							self_id = who_am_i(group_id),
-							group_id = group_id,
-							message = '{}已取消预约{}号boss'.format(user.nickname, boss_num),
-						)
-					)
+					self.group_notifier.notify(group_id, '{}已取消预约{}号boss'.format(user.nickname, boss_num))
 				return jsonify(code = 0, notice = notice)
 			elif action == 'modify':
 				if user.authority_group >= 100:
 					return jsonify(code=11, message='Insufficient authority')
 				try:
-					status = self.modify(
+					status, bossData = await self.group_queue.run(
+						group_id, _with_boss_data(self, group, self.modify),
 						group_id,
 						cycle=payload['cycle'],
 						bossData=payload['bossData'],
@@ -401,16 +437,10 @@ def register_routes(self, app: Quart):
 				_logger.info('网页 成功 {} {} {}'.format(
 					user_id, group_id, action))
 				if group.notification & 0x100:
-					asyncio.ensure_future(
-						self.api.send_group_msg(
-							self_id = who_am_i(group_id),
-							group_id=group_id,
-							message=str(status),
-						)
-					)
+					self.group_notifier.notify(group_id, str(status))
 				return jsonify(
 					code=0,
-					bossData=self._boss_data_dict(group),
+					bossData=bossData,
 				)
 			elif action == 'send_remind':
 				if user.authority_group >= 100:
@@ -433,7 +463,7 @@ def register_routes(self, app: Quart):
 			elif action == 'drop_member':
 				if user.authority_group >= 100:
 					return jsonify(code=11, message='Insufficient authority')
-				count = self.drop_member(group_id, payload['memberlist'])
+				count = await self.group_queue.run(group_id, self.drop_member, group_id, payload['memberlist'])
 				return jsonify(
 					code=0,
 					notice=f'已删除{count}条记录',
@@ -557,10 +587,13 @@ def register_routes(self, app: Quart):
 					notification=group.notification,
 				)
 			elif action == 'put_setting':
-				group.game_server = payload['game_server']
-				group.notification = payload['notification']
-				group.privacy = payload['privacy']
-				group.save()
+				await self.group_queue.run(
+					group_id, self.put_group_setting,
+					group_id,
+					payload['game_server'],
+					payload['notification'],
+					payload['privacy'],
+				)
 				_logger.info('网页 成功 {} {} {}'.format(
 					user_id, group_id, action))
 				return jsonify(code=0, message='success')
@@ -571,13 +604,13 @@ def register_routes(self, app: Quart):
 				return jsonify(code=0, message='success', counts=counts)
 			elif action == 'clear_data_slot':
 				battle_id = payload.get('battle_id')
-				self.clear_data_slot(group_id, battle_id)
+				await self.group_queue.run(group_id, self.clear_data_slot, group_id, battle_id)
 				_logger.info('网页 成功 {} {} {}'.format(
 					user_id, group_id, action))
 				return jsonify(code=0, message='success')
 			elif action == 'switch_data_slot':
 				battle_id = payload['battle_id']
-				self.switch_data_slot(group_id, battle_id)
+				await self.group_queue.run(group_id, self.switch_data_slot, group_id, battle_id)
 				_logger.info('网页 成功 {} {} {}'.format(
 					user_id, group_id, action))
 				return jsonify(code=0, message='success')
@@ -666,22 +699,67 @@ def register_routes(self, app: Quart):
 				battle_id = None
 			else:
 				return jsonify(code=20, message=f'unexceptd value "{battle_id}" for battle_id')
-		report = self.get_report(group_id, battle_id, None, None)
-		member_list = self.get_battle_member_list(group_id, battle_id)
+		#cursor: 只导出cid大于此值的记录，配合返回的next_cursor增量同步
+		#since: 只导出此时间戳之后的记录
+		#limit: 最多导出的记录数
+		try:
+			cursor = int(request.args.get('cursor', 0))
+			since = request.args.get('since')
+			since = None if since is None else int(since)
+			limit = request.args.get('limit')
+			limit = None if limit is None else int(limit)
+		except ValueError:
+			return jsonify(code=20, message='invalid cursor, since or limit')
+		#format=ndjson时每行一个json：第一行为公会信息，之后每行一条记录，最后一行为next_cursor
+		ndjson = request.args.get('format') == 'ndjson'
+		member_list = await worker.run(self.get_battle_member_list, group_id, battle_id)
 		groupinfo = {
 			'group_id': group.group_id,
 			'group_name': group.group_name,
 			'game_server': group.game_server,
 			'battle_id': group.battle_id,
 		},
-		response = await make_response(jsonify(
-			code=0,
-			message='OK',
-			api_version=1,
-			challenges=report,
-			groupinfo=groupinfo,
-			members=member_list,
-		))
+		head = {
+			'code': 0,
+			'message': 'OK',
+			'api_version': 1,
+			'groupinfo': groupinfo,
+			'members': member_list,
+		}
+
+		async def stream():
+			#分页读取记录，边读边发送，不把所有记录放进内存
+			if ndjson:
+				yield (json.dumps(head, ensure_ascii=False) + '\n').encode()
+			else:
+				yield (json.dumps(head, ensure_ascii=False)[:-1] + ', "challenges": [').encode()
+			last_cid = cursor
+			remain = limit
+			first = True
+			while remain is None or remain > 0:
+				page_size = STATISTICS_PAGE if remain is None else min(remain, STATISTICS_PAGE)
+				rows = await worker.run(self.get_report_page, group_id, battle_id, last_cid, since, page_size)
+				if not rows:
+					break
+				last_cid = rows[-1]['cid']
+				if remain is not None:
+					remain -= len(rows)
+				if ndjson:
+					yield ''.join(json.dumps(row, ensure_ascii=False) + '\n' for row in rows).encode()
+				else:
+					yield (('' if first else ', ') + ', '.join(json.dumps(row, ensure_ascii=False) for row in rows)).encode()
+				first = False
+				if len(rows) < page_size:
+					break
+			if ndjson:
+				yield (json.dumps({'next_cursor': last_cid}) + '\n').encode()
+			else:
+				yield '], "next_cursor": {}}}'.format(last_cid).encode()
+
+		response = await make_response(stream(), 200, {
+			'Content-Type': 'application/x-ndjson' if ndjson else 'application/json',
+		})
+		response.timeout = None
 		if (group.privacy & 0x2):
 			response.headers['Access-Control-Allow-Origin'] = '*'
 		return response
@@ -724,4 +802,46 @@ def register_routes(self, app: Quart):
 				return await render_template('clan/unauthorized.html')
 		return await render_template(
 			'clan/clan-rank.html',
-		)
\ No newline at end of file
+		)
+
+def _with_boss_data(self, group, func):
+	#修改与生成boss数据在同一次排队中完成，返回的boss数据不会被其他命令改到一半
+	def run(*args, **kwargs):
+		return func(*args, **kwargs), self._boss_data_dict(group)
+	return run
+
+
+def _status_update(channel, group_id, version, events, full=False):
+	"""
+	把版本号之后的事件合并为一次更新，能只发送变化时只发送变化，否则发送最新的完整状态
+
+	Args:
+		channel: BossStatusChannel实例
+		version: 客户端已有的版本号
+		events: 版本号之后的事件
+		full: 是否总是发送完整状态
+	"""
+	update = None
+	if not full and channel.complete_after(group_id, version):
+		update = merge_delta(events)
+	if update is None:
+		latest = events[-1].data
+		update = {
+			'bossData': latest['bossData'],
+			'base_cycle': latest['base_cycle'],
+			'notice': '\n'.join(event.data['notice'] for event in events if event.data['notice']) or None,
+		}
+	update['version'] = channel.version(events[-1].seq)
+	return update
+
+def _sse_event(channel, event):
+	#同一个事件的推送内容只编码一次，所有连接共用
+	if event.encoded is None:
+		version = channel.version(event.seq)
+		data = event.data if event.delta is None else event.delta
+		event.encoded = _sse_message(version, {**data, 'version': version})
+	return event.encoded
+
+def _sse_message(version, data):
+	return 'id: {}\nevent: status\ndata: {}\n\n'.format(
+		version, json.dumps(data, ensure_ascii=False)).encode()
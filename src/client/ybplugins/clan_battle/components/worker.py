@@ -0,0 +1,89 @@
+"""
+工作线程池
+
+数据库查询与图片绘制都是同步阻塞的，放到线程池中执行以免卡住事件循环；
+在工作线程中需要与事件循环交互（发送消息、唤醒网页长轮询）时，
+使用这里的 ensure_future、call_soon
+"""
+import asyncio
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+_logger = logging.getLogger(__name__)
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_thread: Optional[int] = None
+_executor: Optional[ThreadPoolExecutor] = None
+
+LAG_CHECK_INTERVAL = 1  # 事件循环延迟的检测间隔（秒）
+LAG_WARNING = 0.5  # 事件循环延迟超过此值时记录日志（秒）
+
+
+def init(workers: int = 4) -> None:
+    """
+    绑定当前事件循环并创建线程池
+
+    :param workers: 工作线程数，为0时所有函数直接在事件循环中执行
+    """
+    global _loop, _loop_thread, _executor
+    _loop = asyncio.get_event_loop()
+    _loop_thread = threading.get_ident()
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+    _executor = ThreadPoolExecutor(workers, thread_name_prefix="clan_battle") if workers > 0 else None
+    asyncio.ensure_future(_watch_loop_lag())
+
+
+def in_loop_thread() -> bool:
+    return _loop is None or threading.get_ident() == _loop_thread
+
+
+async def run(func: Callable, *args, **kwargs) -> Any:
+    """
+    在线程池中执行同步函数
+
+    :param func: 要执行的函数
+    :return: 函数的返回值
+    """
+    if _executor is None:
+        return func(*args, **kwargs)
+    return await _loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+
+def ensure_future(coro) -> None:
+    """
+    在任意线程中把协程交给事件循环执行，没有人等待结果，出错时记录日志
+    """
+    if in_loop_thread():
+        future = asyncio.ensure_future(coro)
+    else:
+        future = asyncio.run_coroutine_threadsafe(coro, _loop)
+    future.add_done_callback(_log_failure)
+
+
+def _log_failure(future) -> None:
+    if not future.cancelled() and future.exception() is not None:
+        _logger.error(f'后台任务失败 {future.exception()!r}')
+
+
+def call_soon(func: Callable, *args) -> None:
+    """
+    在任意线程中让事件循环执行函数（工作线程中调用时不等待执行完成）
+    """
+    if in_loop_thread():
+        func(*args)
+    else:
+        _loop.call_soon_threadsafe(func, *args)
+
+
+async def _watch_loop_lag() -> None:
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(LAG_CHECK_INTERVAL)
+        lag = time.perf_counter() - start - LAG_CHECK_INTERVAL
+        if lag > LAG_WARNING:
+            _logger.warning(f'事件循环阻塞了{lag:.2f}秒')
@@ -3,8 +3,6 @@ import time
 from functools import lru_cache
 from typing import Tuple, Union
 
-from expiringdict import ExpiringDict
-
 from .typing import Pcr_date, Pcr_time
 
 pcr_time_offset = {
@@ -39,21 +37,3 @@ def pcr_timestamp(d: Pcr_date, t: Pcr_time, area) -> int:
 
 def atqq(qqid):
     return '[CQ:at,qq={}]'.format(qqid)
-
-
-def timed_cached_func(max_len, max_age_seconds, ignore_self=False):
-    cache = ExpiringDict(max_len, max_age_seconds)
-
-    def decorator(fn):
-        def wrapper(*args, nocache=False):  # args must be hashable
-            if ignore_self:
-                key = tuple(args[1:])
-            else:
-                key = tuple(args)
-            value = cache.get(key)
-            if nocache or value is None:
-                value = fn(*args)
-                cache[key] = value
-            return value
-        return wrapper
-    return decorator
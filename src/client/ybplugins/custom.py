@@ -29,6 +29,10 @@ from .clan_battle.components.multi_cq_utils import refresh
 
 
 class Custom:
+    # 这里处理的所有命令的开头，不以其中任何一个开头的消息不会交给插件处理
+    # 增加命令时记得加上它的开头，设为None则接收所有消息
+    Prefixes = ("手动添加群记录", "修复网页催刀")
+
     def __init__(self,
                  glo_setting: Dict[str, Any],
                  scheduler: AsyncIOScheduler,
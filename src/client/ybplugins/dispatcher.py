@@ -0,0 +1,159 @@
+"""
+消息发送队列
+
+所有主动发送的消息（提醒、定时消息、网页操作的群通知）都经过这里：
+每个机器人账号（self_id）一个队列，按令牌桶限制发送频率，账号之间互不影响；
+回复类消息优先于提醒类消息发送；确定没有送达的消息按指数退避重试
+"""
+import asyncio
+import itertools
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import httpx
+from aiocqhttp.exceptions import ApiNotAvailable, NetworkError
+
+_logger = logging.getLogger(__name__)
+
+REPLY = 0  # 回复与通知，优先发送
+REMIND = 1  # 提醒与定时消息
+
+RETRY_DELAY = 1  # 第一次重试的等待时间（秒），之后每次翻倍
+
+_rate: float = 1
+_burst: int = 5
+_retries: int = 3
+_accounts: Dict[Optional[int], "_Account"] = {}
+_seq = itertools.count()
+
+
+class _Message:
+    __slots__ = ("func", "params", "future", "queued_at", "tries")
+
+    def __init__(self, func: Callable[..., Awaitable], params: Dict[str, Any], future: asyncio.Future) -> None:
+        self.func = func
+        self.params = params
+        self.future = future
+        self.queued_at = time.monotonic()
+        self.tries = 0
+
+
+class _Account:
+    def __init__(self, self_id: Optional[int]) -> None:
+        self.self_id = self_id
+        self.queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        self.tokens = float(_burst)
+        self.updated_at = time.monotonic()
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.task = asyncio.ensure_future(self._run())
+
+    async def _take_token(self) -> None:
+        while True:
+            now = time.monotonic()
+            self.tokens = min(_burst, self.tokens + (now - self.updated_at) * _rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / _rate)
+
+    async def _run(self) -> None:
+        while True:
+            priority, _, message = await self.queue.get()
+            await self._take_token()
+            message.tries += 1
+            try:
+                result = await message.func(**message.params)
+            except Exception as e:
+                if _retryable(e) and message.tries <= _retries:
+                    self.retried += 1
+                    delay = RETRY_DELAY * 2 ** (message.tries - 1)
+                    _logger.warning(f'账号{self.self_id}{_target(message.params)}发送消息失败，{delay}秒后重试 {e}')
+                    asyncio.get_event_loop().call_later(
+                        delay, self.queue.put_nowait, (priority, next(_seq), message))
+                    continue
+                self.failed += 1
+                _logger.error(f'账号{self.self_id}{_target(message.params)}发送消息失败 {e}')
+                if not message.future.done():
+                    message.future.set_exception(e)
+                continue
+            latency = time.monotonic() - message.queued_at
+            self.sent += 1
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+            if not message.future.done():
+                message.future.set_result(result)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queue": self.queue.qsize(),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "latency_avg": self.latency_total / self.sent if self.sent else 0.0,
+            "latency_max": self.latency_max,
+        }
+
+
+def _target(params: Dict[str, Any]) -> str:
+    if params.get("group_id") is not None:
+        return f'向群{params["group_id"]}'
+    if params.get("user_id") is not None:
+        return f'向{params["user_id"]}'
+    return ''
+
+
+def _retryable(e: Exception) -> bool:
+    # 只重试确定没有送达的消息：没有可用的连接，或HTTP连接没有建立起来；
+    # 响应超时的消息可能已经发出，与禁言、被移出群等API错误一样记录后丢弃
+    if isinstance(e, ApiNotAvailable):
+        return True
+    return (isinstance(e, NetworkError)
+            and isinstance(e.__context__, (httpx.ConnectError, httpx.ConnectTimeout)))
+
+
+def init(rate: float = 1, burst: int = 5, retries: int = 3) -> None:
+    """
+    设置发送频率
+
+    :param rate: 每个账号每秒最多发送的消息数
+    :param burst: 每个账号短时间内最多连续发送的消息数
+    :param retries: 发送失败后的重试次数
+    """
+    global _rate, _burst, _retries
+    _rate = rate
+    _burst = max(1, burst)
+    _retries = retries
+
+
+async def send(func: Callable[..., Awaitable], self_id: Optional[int] = None,
+               priority: int = REMIND, **params) -> Any:
+    """
+    把消息加入发送队列并等待发送完成
+
+    :param func: 发送消息的API，如 api.send_group_msg
+    :param self_id: 发送消息的机器人账号，None为默认账号
+    :param priority: REPLY 或 REMIND
+    :param params: API的参数
+    :return: API的返回值，重试后仍然失败时抛出最后一次的异常
+    """
+    account = _accounts.get(self_id)
+    if account is None:
+        account = _accounts[self_id] = _Account(self_id)
+    if self_id is not None:
+        params["self_id"] = self_id
+    future = asyncio.get_event_loop().create_future()
+    account.queue.put_nowait((priority, next(_seq), _Message(func, params, future)))
+    return await future
+
+
+def stats() -> Dict[Optional[int], Dict[str, Any]]:
+    """
+    各账号的队列长度、发送数与发送延迟（入队到发送完成，秒）
+    """
+    return {self_id: account.stats() for self_id, account in _accounts.items()}
@@ -5,6 +5,8 @@ from .web_util import rand_string
 
 
 class GroupLeave:
+    Prefixes = ("退出此群",)
+
     def __init__(self,
                  glo_setting: Dict[str, Any],
                  bot_api: Api,
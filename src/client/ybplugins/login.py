@@ -10,6 +10,7 @@ from apscheduler.triggers.cron import CronTrigger
 from quart import (Quart, Response, jsonify, make_response, redirect, request,
                    send_from_directory, session, url_for)
 
+from .cache_util import cache_events
 from .templating import render_template, template_folder
 from .web_util import rand_string
 from .ybdata import MAX_TRY_TIMES, Clan_group, Clan_member, User, User_login
@@ -36,6 +37,7 @@ class Login:
     Passive = True
     Active = True
     Request = True
+    Prefixes = ("登录", "登陆", "重置密码")
 
     def __init__(self,
                  glo_setting,
@@ -474,6 +476,7 @@ class Login:
                 return jsonify(code=32, message='消息体内容错误')
             user_data.nickname = new_nickname
             user_data.save()
+            cache_events.publish('clan_member', None)
             return jsonify(code=0, message='success')
 
         @app.route(
@@ -16,6 +16,7 @@ class Marionette:
     Passive = True
     Active = False
     Request = True
+    Prefixes = ("人偶",)
 
     def __init__(self,
                  glo_setting,
@@ -0,0 +1,135 @@
+"""
+远程资源的本地缓存
+
+网页用到的图片等资源第一次访问时从镜像站下载到本地，之后直接使用本地文件：
+同一个文件同时只下载一次，下载内容边接收边写入临时文件，完成后改名；
+不存在的资源在一段时间内不再请求；本地缓存目录的总大小有上限
+"""
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional
+
+import aiohttp
+
+from .cache_util import LRUCache
+
+_logger = logging.getLogger(__name__)
+
+UPSTREAM = "https://redive.estertion.win/"
+CHUNK_SIZE = 64 * 1024
+NOT_FOUND_TTL = 3600  # 不存在的资源在此时间（秒）内不再请求
+
+_session: Optional[aiohttp.ClientSession] = None
+_inflight: Dict[str, "asyncio.Future[int]"] = {}
+_not_found = LRUCache(1024, NOT_FOUND_TTL)
+
+
+def _get_session() -> aiohttp.ClientSession:
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=16),
+            timeout=aiohttp.ClientTimeout(total=60),
+        )
+    return _session
+
+
+async def download(url: str, local_path: str) -> int:
+    """
+    把远程文件下载到本地，同一个本地文件同时只会下载一次
+
+    :param url: 远程地址
+    :param local_path: 保存路径
+    :return: HTTP状态码，200为下载成功，失败时不会留下文件
+    """
+    if _not_found.get(url):
+        return 404
+    future = _inflight.get(local_path)
+    if future is None:
+        future = _inflight[local_path] = asyncio.ensure_future(_download(url, local_path))
+        future.add_done_callback(lambda _: _inflight.pop(local_path, None))
+    return await asyncio.shield(future)
+
+
+async def _download(url: str, local_path: str) -> int:
+    loop = asyncio.get_event_loop()
+    temp_path = f"{local_path}.{os.getpid()}.tmp"
+    async with _get_session().get(url) as response:
+        if response.status != 200:
+            if response.status == 404:
+                _not_found.set(url, True)
+            return response.status
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        f = await loop.run_in_executor(None, open, temp_path, "wb")
+        try:
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                await loop.run_in_executor(None, f.write, chunk)
+        except BaseException:
+            f.close()
+            os.remove(temp_path)
+            raise
+        f.close()
+    os.replace(temp_path, local_path)
+    return 200
+
+
+class ResourceDirectory:
+    """
+    资源缓存目录，总大小超过上限时删除最久未使用的文件
+
+    :param root: 目录路径
+    :param max_bytes: 总大小上限（字节），为0时不限制
+    :param keep: 不会被删除的文件（相对路径）
+    """
+
+    def __init__(self, root: str, max_bytes: int = 0, keep: Iterable[str] = ()) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self.keep = {os.path.join(root, name) for name in keep}
+        self.total_bytes = 0
+        self._files: "OrderedDict[str, int]" = OrderedDict()  # {路径: 大小}，按使用时间排序
+        files = []
+        for dirpath, _, filenames in os.walk(root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if name.endswith(".tmp"):  # 上次运行时没有下载完的文件
+                    os.remove(path)
+                    continue
+                stat = os.stat(path)
+                files.append((stat.st_mtime, path, stat.st_size))
+        for _, path, size in sorted(files):
+            self._add(path, size)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    def touch(self, path: str) -> None:
+        """
+        记录一次使用
+        """
+        if path in self._files:
+            self._files.move_to_end(path)
+
+    def add(self, path: str) -> None:
+        """
+        记录一个新下载的文件，超过上限时删除最久未使用的文件
+        """
+        self._add(path, os.path.getsize(path))
+        if not self.max_bytes:
+            return
+        for old_path in list(self._files):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if old_path == path or old_path in self.keep:
+                continue
+            self.total_bytes -= self._files.pop(old_path)
+            try:
+                os.remove(old_path)
+            except OSError as e:
+                _logger.warning(f"删除缓存文件失败 {old_path} {e}")
+
+    def _add(self, path: str, size: int) -> None:
+        self.total_bytes += size - self._files.pop(path, 0)
+        self._files[path] = size
@@ -9,6 +9,8 @@ from urllib.parse import urljoin
 from playhouse.shortcuts import model_to_dict
 from quart import Quart, jsonify, redirect, request, session, url_for
 
+from . import resource_cache
+from .cache_util import cache_events
 from .templating import render_template
 from .ybdata import Clan_group, User
 
@@ -286,6 +288,7 @@ class Setting:
                     for key in data.keys():
                         setattr(m_user, key, data[key])
                     m_user.save()
+                    cache_events.publish('clan_member', None)
                     return jsonify(code=0, message='success')
                 elif action == 'delete_user':
                     user = User.get_or_none(qqid=req['data']['qqid'])
@@ -296,6 +299,7 @@ class Setting:
                     user.password = None
                     user.deleted = True
                     user.save()
+                    cache_events.publish('clan_member', None)
                     return jsonify(code=0, message='success')
                 else:
                     return jsonify(code=32, message='unknown action')
@@ -369,6 +373,8 @@ class Setting:
                     Clan_group.delete().where(
                         Clan_group.group_id == req['group_id'],
                     ).execute()
+                    cache_events.publish('clan_member', req['group_id'])
+                    cache_events.publish('clan_battle', req['group_id'], None)
                     return jsonify(code=0, message='ok')
                 else:
                     return jsonify(code=32, message='unknown action')
@@ -454,9 +460,13 @@ class Setting:
             )
 
 async def download_icon(icon_path, boss_id):
-    async with aiohttp.ClientSession() as ses:
-        async with ses.get(f'https://redive.estertion.win/icon/unit/{boss_id}.webp') as resp:
-            data = await resp.read()
-    with open(icon_path, 'wb') as img:
-        img.write(data)
+    try:
+        status = await resource_cache.download(
+            f'{resource_cache.UPSTREAM}icon/unit/{boss_id}.webp', icon_path)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.warning(f'{boss_id}.webp下载失败: {e}')
+        return
+    if status != 200:
+        logger.warning(f'{boss_id}.webp下载失败: http code {status}')
+        return
     logger.info(f'{boss_id}.webp下载成功')
@@ -0,0 +1,176 @@
+"""
+预压缩的静态文件
+
+为目录下的文本文件预先生成 gzip 与 brotli（安装了brotli时）压缩版本，
+并把每个文件的内容哈希记录到 manifest 中；
+响应使用内容哈希作为ETag，支持304，带有版本的URL可以被浏览器永久缓存。
+启动时只压缩有变化的文件，也可以离线执行：
+
+    python -m ybplugins.static_assets
+"""
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import re
+import threading
+from typing import Any, Dict, Optional
+
+from quart import make_response, request, send_file
+from werkzeug.utils import safe_join
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+_logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = ".manifest.json"
+COMPRESSIBLE = {".js", ".css", ".html", ".json", ".svg", ".map", ".txt", ".xml"}
+MIN_SIZE = 1024  # 小于此大小的文件不压缩
+BROTLI_QUALITY = 11
+ENCODINGS = {"br": ".br", "gzip": ".gz"}  # 按优先级排列
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+
+class StaticAssets:
+    """
+    预压缩的静态文件目录
+
+    :param root: 目录路径
+    :param gzip_level: gzip压缩等级，为0时不压缩
+    :param versioned: 匹配这个正则的路径本身带有版本号（如 vue@2.6.11/），总是可以永久缓存
+    """
+
+    def __init__(self, root: str, gzip_level: int = 6, versioned: Optional[str] = None) -> None:
+        self.root = root
+        self.gzip_level = gzip_level
+        self.versioned = re.compile(versioned) if versioned else None
+        self._manifest_path = os.path.join(root, MANIFEST_NAME)
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        try:
+            with open(self._manifest_path, "r", encoding="utf-8") as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def build(self) -> None:
+        """
+        为有变化的文件重新计算哈希并生成压缩版本，然后保存 manifest
+        """
+        with self._lock:
+            entries = {}
+            for dirpath, _, filenames in os.walk(self.root):
+                for name in filenames:
+                    if name == MANIFEST_NAME or name.endswith((".gz", ".br", ".tmp")):
+                        continue
+                    path = os.path.join(dirpath, name)
+                    filename = os.path.relpath(path, self.root).replace(os.sep, "/")
+                    try:
+                        entries[filename] = self._build_file(path, self._entries.get(filename))
+                    except OSError as e:
+                        _logger.warning(f"静态文件预压缩失败 {filename} {e}")
+                        continue
+                    self._entries[filename] = entries[filename]
+            self._entries = entries
+            try:
+                with open(self._manifest_path + ".tmp", "w", encoding="utf-8") as f:
+                    json.dump(entries, f, indent=1, sort_keys=True)
+                os.replace(self._manifest_path + ".tmp", self._manifest_path)
+            except OSError as e:
+                _logger.warning(f"保存静态文件manifest失败 {e}")
+
+    def build_in_background(self) -> None:
+        threading.Thread(target=self.build, name="static_assets", daemon=True).start()
+
+    def _build_file(self, path: str, entry: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        stat = os.stat(path)
+        if (entry is not None
+                and entry["size"] == stat.st_size
+                and entry["mtime"] == stat.st_mtime_ns
+                and all(os.path.exists(path + ENCODINGS[e]) for e in entry["encodings"])):
+            return entry
+        with open(path, "rb") as f:
+            data = f.read()
+        encodings = []
+        if (self.gzip_level > 0
+                and len(data) >= MIN_SIZE
+                and os.path.splitext(path)[1].lower() in COMPRESSIBLE):
+            if brotli is not None:
+                _write_atomic(path + ".br", brotli.compress(data, quality=BROTLI_QUALITY))
+                encodings.append("br")
+            _write_atomic(path + ".gz", gzip.compress(data, compresslevel=self.gzip_level, mtime=0))
+            encodings.append("gzip")
+        return {
+            "hash": hashlib.sha256(data).hexdigest()[:16],
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "encodings": encodings,
+        }
+
+    def version(self, filename: Optional[str]) -> Optional[str]:
+        """
+        文件的内容哈希，用作URL中的版本号
+
+        :return: 哈希值，文件不在 manifest 中时为None
+        """
+        entry = self._entries.get(filename)
+        return entry and entry["hash"]
+
+    async def send(self, filename: str):
+        """
+        发送文件，按 Accept-Encoding 选择压缩版本
+
+        URL参数 v 与内容哈希一致，或路径本身带有版本号时允许永久缓存，否则每次使用前向服务器确认
+        """
+        path = safe_join(self.root, filename)
+        if path is None or not os.path.isfile(path):
+            return "404 not found", 404
+        entry = self._entries.get(filename)
+        if entry is not None:
+            stat = os.stat(path)
+            if entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime_ns:
+                entry = None
+        if entry is None:  # 新增或修改过、还没有预压缩的文件
+            return await send_file(path, conditional=True)
+
+        accept_encoding = request.headers.get("Accept-Encoding", "").lower()
+        encoding = next((e for e in entry["encodings"] if e in accept_encoding), None)
+        etag = entry["hash"] + ("-" + encoding if encoding else "")
+        if request.if_none_match.contains(etag):
+            response = await make_response("", 304)
+        else:
+            response = await send_file(
+                path + ENCODINGS[encoding] if encoding else path,
+                mimetype=mimetypes.guess_type(path)[0] or "application/octet-stream",
+                add_etags=False,
+            )
+            if encoding:
+                response.headers["Content-Encoding"] = encoding
+        response.set_etag(etag)
+        response.headers["Vary"] = "Accept-Encoding"
+        immutable = (
+            request.args.get("v") == entry["hash"]
+            or (self.versioned is not None and self.versioned.match(filename))
+        )
+        response.headers["Cache-Control"] = IMMUTABLE if immutable else "no-cache"
+        response.headers.pop("Expires", None)
+        return response
+
+
+def _write_atomic(path: str, data: bytes) -> None:
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    public = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "public")
+    for name in ("libs", "static"):
+        StaticAssets(os.path.join(public, name)).build()
+        _logger.info(f"{name} 预压缩完成")
@@ -7,6 +7,7 @@ class Switcher:
     Passive = True
     Active = False
     Request = False
+    Prefixes = ("设置",)
 
     def __init__(self, glo_setting: dict, *args, **kwargs):
         self.setting = glo_setting
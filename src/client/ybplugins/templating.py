@@ -9,11 +9,12 @@ template_folder = os.path.abspath(os.path.join(
     os.path.dirname(__file__), '../public/template'))
 
 Ver = 'unknown'
+static_assets = None  # 静态文件目录，用内容哈希作为URL中的版本号
 
 
 def _vertioned_url_for(endpoint, *args, **kwargs):
     if endpoint == 'yobot_static':
-        kwargs['v'] = Ver
+        kwargs['v'] = (static_assets and static_assets.version(kwargs.get('filename'))) or Ver
     return url_for(endpoint, *args, **kwargs)
 
 
@@ -1,3 +1,4 @@
+import asyncio
 import os
 import random
 import string
@@ -7,6 +8,8 @@ import aiohttp
 import requests
 from quart import Quart, jsonify, request, send_file, session
 
+from . import resource_cache
+from .cache_util import async_cached_func
 from .yobot_exceptions import ServerError
 
 _rand_string_chaset = (string.ascii_uppercase +
@@ -21,22 +24,7 @@ def rand_string(n=16):
     )
 
 
-def async_cached_func(maxsize=64):
-    cache = {}
-
-    def decorator(fn):
-        async def wrapper(*args, nocache=False):  # args must be hashable
-            key = tuple(args)
-            if nocache or (key not in cache):
-                if len(cache) >= maxsize:
-                    del cache[cache.keys().next()]
-                cache[key] = await fn(*args)
-            return cache[key]
-        return wrapper
-    return decorator
-
-
-@async_cached_func(128)
+@async_cached_func(128, 86400)
 async def _ip_location(ip):
     async with aiohttp.request("GET", url=f'http://freeapi.ipip.net/{ip}') as response:
         if response.status != 200:
@@ -58,6 +46,11 @@ class WebUtil:
             glo_setting['dirname'], 'output', 'resource')
         if not os.path.exists(self.resource_path):
             os.makedirs(self.resource_path)
+        self.resources = resource_cache.ResourceDirectory(
+            self.resource_path,
+            glo_setting.get('resource_cache_max_bytes', 536870912),
+            keep=('background.jpg',),
+        )
 
         if not os.path.exists(os.path.join(self.resource_path, 'background.jpg')):
             try:
@@ -109,23 +102,19 @@ class WebUtil:
                     "resource/<path:filename>"),
             methods=["GET"])
         async def yobot_resource(filename):
-            localfile = os.path.join(self.resource_path, filename)
-            if not os.path.exists(localfile):
-                if filename.endswith('.jpg'):
-                    filename = filename[:-4] + '.webp@w400'
-                try:
-                    async with aiohttp.request(
-                        "GET",
-                        url=f'https://redive.estertion.win/{filename}'
-                    ) as response:
-                        res = await response.read()
-                        if response.status != 200:
-                            return res, response.status
-                except aiohttp.ClientError as e:
-                    print(e)
-                    return '404: Not Found', 404
-                if not os.path.exists(os.path.dirname(localfile)):
-                    os.makedirs(os.path.dirname(localfile))
-                with open(localfile, 'wb') as f:
-                    f.write(res)
+            localfile = self.resources.path(filename)
+            if os.path.exists(localfile):
+                self.resources.touch(localfile)
+                return await send_file(localfile)
+            if filename.endswith('.jpg'):
+                filename = filename[:-4] + '.webp@w400'
+            try:
+                status = await resource_cache.download(
+                    resource_cache.UPSTREAM + filename, localfile)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(e)
+                return '404: Not Found', 404
+            if status != 200:
+                return f'{status}: upstream error', status
+            self.resources.add(localfile)
             return await send_file(localfile)
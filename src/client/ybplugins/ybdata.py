@@ -6,7 +6,7 @@ from .web_util import rand_string
 
 db_mode = True  # True为本地（原），Flase为为改为mysql（需要在第15行配置使用）
 
-_version = 2  # 目前版本
+_version = 5  # 目前版本
 MAX_TRY_TIMES = 5
 
 if db_mode:
@@ -79,7 +79,7 @@ class Clan_group(_BaseModel):
     # 结构 {boss_num:血量, }
     next_cycle_boss_health = TextField(default="")  # 下周目boss剩余血量（json格式文本）
 
-    # 所有正在出刀的人（json格式文本）
+    # 所有正在出刀的人（json格式文本，已迁移至Clan_challenger表，仅用于升级旧数据库）
     # 结构：{boss_num:{
     #           challenger:{
     #               is_continue:是否是补偿,
@@ -92,7 +92,7 @@ class Clan_group(_BaseModel):
     #       }, }
     challenging_member_list = TextField(null=True)
 
-    # 预约表（json格式文本） 结构：{boss_num:{qqid: message, }, }
+    # 预约表（json格式文本，已迁移至Clan_subscribe表，仅用于升级旧数据库） 结构：{boss_num:{qqid: message, }, }
     subscribe_list = TextField(null=True)
 
     challenging_start_time = BigIntegerField(default=0)
@@ -108,6 +108,41 @@ class Clan_group_backups(_BaseModel):
         primary_key = CompositeKey("group_id", "battle_id")
 
 
+# 正在出刀（已申请出刀/挂树）的成员，每个成员同时只能挑战一个boss
+class Clan_challenger(_BaseModel):
+    cid = AutoField(primary_key=True)  # 自增id，用于保持申请顺序
+    group_id = BigIntegerField()  # 公会qq群号
+    qqid = BigIntegerField()  # 出刀人qq号
+    boss_num = SmallIntegerField()  # 几王
+    is_continue = BooleanField(default=False)  # 是否是补偿刀
+    behalf = BigIntegerField(null=True)  # 代刀人qq号
+    s = IntegerField(default=0)  # 余秒
+    damage = BigIntegerField(default=0)  # 报伤害
+    tree = BooleanField(default=False)  # 是否挂树
+    msg = TextField(null=True)  # 挂树留言
+
+    class Meta:
+        indexes = (
+            (("group_id", "qqid"), True),
+            (("group_id", "boss_num"), False),
+        )
+
+
+# 预约表
+class Clan_subscribe(_BaseModel):
+    sid = AutoField(primary_key=True)  # 自增id，用于保持预约顺序
+    group_id = BigIntegerField()  # 公会qq群号
+    boss_num = SmallIntegerField()  # 几王
+    qqid = BigIntegerField()  # 预约人qq号
+    message = TextField(null=True)  # 留言
+
+    class Meta:
+        indexes = (
+            (("group_id", "boss_num", "qqid"), True),
+            (("group_id", "qqid"), False),
+        )
+
+
 class Clan_member(_BaseModel):
     group_id = BigIntegerField(index=True)
     qqid = BigIntegerField(index=True)
@@ -140,6 +175,27 @@ class Clan_challenge(_BaseModel):
             (("bid", "gid"), False),
             (("qqid", "challenge_pcrdate"), False),
             (("bid", "gid", "challenge_pcrdate"), False),
+            (("gid", "cid"), False),  # 按cid翻页导出
+        )
+
+
+# 每个成员每天的出刀统计，随Clan_challenge的写入与删除同步更新
+class Clan_challenge_daily(_BaseModel):
+    rid = AutoField(primary_key=True)  # 自增id，保持成员当天第一刀的顺序
+    gid = BigIntegerField()  # 公会qq群号
+    bid = IntegerField(default=0)  # 档案号
+    pcrdate = IntegerField()  # 日期
+    qqid = BigIntegerField()  # 出刀人qq号
+    blade = SmallIntegerField(default=0)  # 出刀记录数
+    full_blade = SmallIntegerField(default=0)  # 完整刀（未击败boss且不是补偿刀）
+    tail_blade = SmallIntegerField(default=0)  # 尾刀（击败boss且不是补偿刀）
+    continue_blade = SmallIntegerField(default=0)  # 补偿刀
+    damage = BigIntegerField(default=0)  # 总伤害
+
+    class Meta:
+        indexes = (
+            (("gid", "bid", "pcrdate", "qqid"), True),
+            (("gid", "bid", "qqid"), False),
         )
 
 
@@ -159,6 +215,13 @@ class DB_schema(_BaseModel):
     value = TextField()
 
 
+def atomic():
+    """
+    数据库事务，with代码块中的所有写入一次性提交，出错时全部回滚
+    """
+    return _db.atomic()
+
+
 def init(sqlite_filename):
     if db_mode:
         _db.init(
@@ -184,6 +247,9 @@ def init(sqlite_filename):
         Clan_member.create_table()
         Clan_group_backups.create_table()
         Clan_challenge.create_table()
+        Clan_challenge_daily.create_table()
+        Clan_challenger.create_table()
+        Clan_subscribe.create_table()
         Character.create_table()
         old_version = _version
     if old_version > _version:
@@ -220,5 +286,76 @@ def db_upgrade(old_version):
             new_subscribe_list = json.dumps(new_subscribe_list)
             group.subscribe_list = new_subscribe_list
             group.save()
+    if old_version < 3:
+        """
+        出刀成员表与预约表由Clan_group中的json文本迁移至独立的数据表
+        """
+        Clan_challenger.create_table()
+        Clan_subscribe.create_table()
+        with _db.atomic():
+            for group in Clan_group.select():
+                if group.challenging_member_list:
+                    for boss_num, challengers in json.loads(group.challenging_member_list).items():
+                        for qqid, info in challengers.items():
+                            Clan_challenger.insert(
+                                group_id=group.group_id,
+                                qqid=int(qqid),
+                                boss_num=int(boss_num),
+                                is_continue=bool(info.get("is_continue")),
+                                behalf=info.get("behalf"),
+                                s=int(info.get("s") or 0),
+                                damage=int(info.get("damage") or 0),
+                                tree=bool(info.get("tree")),
+                                msg=info.get("msg"),
+                            ).on_conflict_replace().execute()
+                if group.subscribe_list:
+                    for boss_num, subscribers in json.loads(group.subscribe_list).items():
+                        for qqid, message in subscribers.items():
+                            Clan_subscribe.insert(
+                                group_id=group.group_id,
+                                boss_num=int(boss_num),
+                                qqid=int(qqid),
+                                message=message,
+                            ).on_conflict_replace().execute()
+                group.challenging_member_list = None
+                group.subscribe_list = None
+                group.save()
+    if old_version < 4:
+        """
+        出刀记录按公会与cid翻页导出
+        """
+        migrate(migrator.add_index("clan_challenge", ("gid", "cid"), False))
+    if old_version < 5:
+        """
+        从出刀记录生成每日出刀统计
+        """
+        Clan_challenge_daily.create_table()
+        not_continue = Clan_challenge.is_continue == False
+        query = (Clan_challenge
+                 .select(
+                     Clan_challenge.gid,
+                     Clan_challenge.bid,
+                     Clan_challenge.challenge_pcrdate,
+                     Clan_challenge.qqid,
+                     fn.COUNT(Clan_challenge.cid),
+                     fn.SUM(Case(None, [((Clan_challenge.boss_health_remain > 0) & not_continue, 1)], 0)),
+                     fn.SUM(Case(None, [((Clan_challenge.boss_health_remain == 0) & not_continue, 1)], 0)),
+                     fn.SUM(Case(None, [(Clan_challenge.is_continue == True, 1)], 0)),
+                     fn.SUM(Clan_challenge.challenge_damage),
+                 )
+                 .group_by(Clan_challenge.gid, Clan_challenge.bid, Clan_challenge.challenge_pcrdate, Clan_challenge.qqid)
+                 .order_by(fn.MIN(Clan_challenge.cid)))
+        with _db.atomic():
+            Clan_challenge_daily.insert_from(query, [
+                Clan_challenge_daily.gid,
+                Clan_challenge_daily.bid,
+                Clan_challenge_daily.pcrdate,
+                Clan_challenge_daily.qqid,
+                Clan_challenge_daily.blade,
+                Clan_challenge_daily.full_blade,
+                Clan_challenge_daily.tail_blade,
+                Clan_challenge_daily.continue_blade,
+                Clan_challenge_daily.damage,
+            ]).execute()
 
     DB_schema.replace(key="version", value=str(_version)).execute()
@@ -5,6 +5,7 @@ class Message:
     Passive = True
     Active = False
     Request = False
+    Prefixes = ("ver", "V", "帮助", "help", "手册")
 
     def __init__(self, glo_setting: dict, *args, **kwargs):
         self.version = glo_setting["verinfo"]["ver_name"]
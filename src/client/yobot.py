@@ -9,24 +9,25 @@ import socket
 import sys
 from io import BytesIO
 from functools import reduce
-from typing import Any, Callable, Dict, Iterable, List, Tuple
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
 from urllib.parse import urljoin
 
 import requests
 from aiocqhttp.api import Api
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from quart import Quart, make_response, request, send_file
+from quart import Quart, request, send_file
+from quart.wrappers.response import IterableBody
 
 if __package__:
-    from .ybplugins import (clan_battle, homepage,
+    from .ybplugins import (clan_battle, dispatcher, homepage,
                             login, marionette, settings,
                             switcher, templating, web_util, ybdata,
-                            yobot_msg, custom, group_leave)
+                            yobot_msg, custom, group_leave, static_assets)
 else:
-    from ybplugins import (clan_battle, homepage,
+    from ybplugins import (clan_battle, dispatcher, homepage,
                            login, marionette, settings,
                            switcher, templating, web_util, ybdata,
-                           yobot_msg, custom, group_leave)
+                           yobot_msg, custom, group_leave, static_assets)
 
 # 本项目构建的框架非常粗糙，不建议各位把时间浪费本项目上
 # 如果想开发自己的机器人，建议直接使用 nonebot 框架
@@ -121,9 +122,10 @@ class Yobot:
                 accept_encoding = request.headers.get('Accept-Encoding', '')
                 if (response.status_code < 200 or
                     response.status_code >= 300 or
-                    len(await response.get_data()) < 1024 or
+                    'Content-Encoding' in response.headers or
+                    isinstance(response.response, IterableBody) or
                     'gzip' not in accept_encoding.lower() or
-                        'Content-Encoding' in response.headers):
+                        len(await response.get_data()) < 1024):
                     return response
 
                 gzip_buffer = BytesIO()
@@ -183,34 +185,25 @@ class Yobot:
         mimetypes.add_type('application/javascript', '.js')
         mimetypes.add_type('image/webp', '.webp')
         
+        # precompress js dependencies and static files (changed files only)
+        public_path = os.path.join(os.path.dirname(__file__), "public")
+        self.js_dependencies = static_assets.StaticAssets(
+            os.path.join(public_path, "libs"),
+            self.glo_setting["web_gzip"],
+            versioned=r"[^/]+@\d[^/]*/",  # e.g. vue@2.6.11/
+        )
+        self.static_files = static_assets.StaticAssets(
+            os.path.join(public_path, "static"),
+            self.glo_setting["web_gzip"],
+        )
+        self.js_dependencies.build_in_background()
+        self.static_files.build_in_background()
+        templating.static_assets = self.static_files
+
         # add route for js dependencies
         @quart_app.route("/yobot-depencency/<path:filename>")
         async def yobot_js_dependencies(filename):
-            accept_encoding = request.headers.get('Accept-Encoding', '')
-            origin_file = os.path.join(os.path.dirname(
-                __file__), "public", "libs", filename)
-            if ('gzip' not in accept_encoding.lower()
-                    or self.glo_setting['web_gzip'] == 0):
-                return await send_file(origin_file)
-            gzipped_file = origin_file + ".gz"
-            if not os.path.exists(gzipped_file):
-                if not os.path.exists(origin_file):
-                    return "404 not found", 404
-                with open(origin_file, 'rb') as of, open(gzipped_file, 'wb') as gf:
-                    with gzip.GzipFile(
-                        mode='wb',
-                        compresslevel=self.glo_setting["web_gzip"],
-                        fileobj=gf,
-                    ) as gzip_file:
-                        gzip_file.write(of.read())
-            response = await make_response(await send_file(gzipped_file))
-            response.mimetype = (
-                mimetypes.guess_type(os.path.basename(origin_file))[0]
-                or "application/octet-stream"
-            )
-            response.headers['Content-Encoding'] = 'gzip'
-            response.headers['Vary'] = 'Accept-Encoding'
-            return response
+            return await self.js_dependencies.send(filename)
 
         # add route for static files
         @quart_app.route(
@@ -218,8 +211,7 @@ class Yobot:
                     "assets/<path:filename>"),
             methods=["GET"])
         async def yobot_static(filename):
-            return await send_file(
-                os.path.join(os.path.dirname(__file__), "public", "static", filename))
+            return await self.static_files.send(filename)
 
         # add route for output files
         if not os.path.exists(os.path.join(dirname, "output")):
@@ -230,13 +222,18 @@ class Yobot:
                     "output/<path:filename>"),
             methods=["GET"])
         async def yobot_output(filename):
-            return await send_file(os.path.join(dirname, "output", filename))
+            return await send_file(os.path.join(dirname, "output", filename), conditional=True)
 
         # filter
         self.black_list = set(self.glo_setting["black-list"])
         self.black_list_group = set(self.glo_setting["black-list-group"])
         self.white_list_group = set(self.glo_setting["white-list-group"])
 
+        # outgoing message rate limit
+        dispatcher.init(self.glo_setting.get("send_rate", 1),
+                        self.glo_setting.get("send_burst", 5),
+                        self.glo_setting.get("send_retries", 3))
+
         # update runtime variables
         self.glo_setting.update({
             "dirname": dirname,
@@ -274,6 +271,54 @@ class Yobot:
             custom.Custom(**kwargs),
         ]
 
+        # persist deferred writes on exit
+        @quart_app.after_serving
+        async def yobot_shutdown():
+            for p in plug_all + self.plug_new:
+                if hasattr(p, "shutdown"):
+                    await p.shutdown()
+
+        # command routing table
+        self.routes = self._build_routes(
+            self.plug_new + self.plug_passive)
+        self.message_count = {"filtered": 0, "dispatched": 0}
+
+    @staticmethod
+    def _build_routes(plugins: list) -> Optional[Dict[str, Tuple[Tuple[str, Tuple[Any, ...]], ...]]]:
+        '''
+        index the command prefixes of all plugins by their first character,
+        each prefix mapped to the plugins declaring it;
+        return None if any plugin does not declare its prefixes
+        '''
+        table = {}
+        for plug in plugins:
+            prefixes = getattr(plug, "Prefixes", None)
+            if prefixes is None:
+                return None
+            for prefix in prefixes:
+                table.setdefault(prefix[0], {}).setdefault(prefix, []).append(plug)
+        return {char: tuple((prefix, tuple(plugs)) for prefix, plugs in entries.items())
+                for char, entries in table.items()}
+
+    def route(self, text: str) -> Optional[Set[Any]]:
+        '''
+        the plugins that may handle the message, None for all plugins
+        '''
+        if self.routes is None:
+            return None
+        plugs = set()
+        for prefix, prefix_plugs in self.routes.get(text[:1], ()):
+            if text.startswith(prefix):
+                plugs.update(prefix_plugs)
+        return plugs
+
+    def is_command(self, text: str) -> bool:
+        '''
+        whether the message may be handled by any plugin
+        '''
+        targets = self.route(text)
+        return targets is None or bool(targets)
+
     def active_jobs(self) -> List[Tuple[Any, Callable[[], Iterable[Dict[str, Any]]]]]:
         jobs = [p.jobs() for p in self.plug_active]
         return reduce(lambda x, y: x+y, jobs)
@@ -291,6 +336,13 @@ class Yobot:
                 msg["raw_message"] = (
                     msg["raw_message"][len(preffix):])
 
+        # ordinary chat
+        targets = self.route(msg["raw_message"])
+        if targets is not None and not targets:
+            self.message_count["filtered"] += 1
+            return None
+        self.message_count["dispatched"] += 1
+
         # black-list
         if msg["sender"]["user_id"] in self.black_list:
             return None
@@ -308,6 +360,8 @@ class Yobot:
         # run new
         reply_msg = None
         for plug in self.plug_new:
+            if targets is not None and plug not in targets:
+                continue
             ret = await plug.execute_async(msg)
             if ret is None:
                 continue
@@ -328,6 +382,8 @@ class Yobot:
         # run
         replys = []
         for pitem in self.plug_passive:
+            if targets is not None and pitem not in targets:
+                continue
             if hasattr(pitem, 'match'):
                 func_num = pitem.match(msg["raw_message"])
             else: